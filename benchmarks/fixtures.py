@@ -0,0 +1,120 @@
+"""
+Synthetic, reproducible data for the benchmarks: keys, UTXO sets, signed
+transactions and chains of blocks. Everything is derived from a seeded PRNG,
+so the same sizes always give the same data.
+"""
+from typing import List, Tuple
+from dataclasses import dataclass, field
+import random
+
+from bitcoin_rollup_sim.block import Block, get_genesis_block
+from bitcoin_rollup_sim.keys import KeysAddress
+from bitcoin_rollup_sim.transaction import Transaction, VIn, VOut
+from bitcoin_rollup_sim.utils.common import get_signature
+from bitcoin_rollup_sim.utxo import UtxoSet, connect_block
+
+SEED = 1234
+FUNDING_VALUE = 10**6  # sats in each synthetic utxo
+OUTPUTS_PER_FUNDING_TXN = 2
+
+
+@dataclass
+class Fixtures:
+    keys: List[KeysAddress]
+    utxo_set: UtxoSet
+    mem_pool: List[Transaction]
+    blocks: List[Block]
+    # utxo set after connecting all but the last block in blocks
+    utxo_before_tip: UtxoSet = field(default_factory=UtxoSet)
+
+    @property
+    def tip(self) -> Block:
+        return self.blocks[-1]
+
+
+def make_keys(num_keys: int, rng: random.Random) -> List[KeysAddress]:
+    return [
+        KeysAddress.from_priv_key(rng.randrange(1, 2**255))
+        for _ in range(num_keys)
+    ]
+
+
+def make_utxo_set(num_utxos: int, keys: List[KeysAddress]) -> UtxoSet:
+    utxos = UtxoSet()
+    for i in range(0, num_utxos, OUTPUTS_PER_FUNDING_TXN):
+        vouts = [
+            VOut.get_for_p2pkh(keys[(i + n) % len(keys)].pub_key_hash, FUNDING_VALUE, ind=n)
+            for n in range(min(OUTPUTS_PER_FUNDING_TXN, num_utxos - i))
+        ]
+        txn = Transaction.new(
+            vin=[VIn.get_coinbase_input(f"funding {i}", 1)],
+            vout=vouts,
+        )
+        utxos.add_txn(txn)
+    return utxos
+
+
+def make_spend(
+    txid: str,
+    vout: VOut,
+    owner: KeysAddress,
+    dest: KeysAddress,
+    fee: int = 1000,
+) -> Transaction:
+    """Signed txn spending a single p2pkh output to dest"""
+    vin = VIn(
+        transaction_id=txid,
+        vout=vout.n,
+        script_sig=" ".join([get_signature(vout.serialize(), owner.priv_key), owner.pub_key_hex]),
+        sequence=1,
+    )
+    return Transaction.new([vin], [VOut.get_for_p2pkh(dest.pub_key_hash, vout.value - fee, ind=0)])
+
+
+def spendable(utxos: UtxoSet, keys: List[KeysAddress]) -> List[Tuple[str, VOut, KeysAddress]]:
+    by_hash = {x.pub_key_hash: x for x in keys}
+    return [(txid, vout, by_hash[vout.pub_key_hash]) for (txid, _), vout in utxos.items()]
+
+
+def make_fixtures(
+    num_utxos: int = 10_000,
+    mempool_size: int = 100,
+    num_blocks: int = 10,
+    txns_per_block: int = 100,
+    num_keys: int = 20,
+) -> Fixtures:
+    rng = random.Random(SEED)
+    keys = make_keys(num_keys, rng)
+    utxos = make_utxo_set(num_utxos, keys)
+    coins = spendable(utxos, keys)
+    rng.shuffle(coins)
+    needed = mempool_size + num_blocks * txns_per_block
+    assert needed <= len(coins), "Not enough utxos for the mempool and blocks"
+
+    def spend(coin):
+        txid, vout, owner = coin
+        return make_spend(txid, vout, owner, rng.choice(keys))
+
+    mem_pool = [spend(x) for x in coins[:mempool_size]]
+    coins = coins[mempool_size:]
+
+    genesis = get_genesis_block()
+    blocks = [genesis]
+    chain_utxos = utxos.copy()
+    utxo_before_tip = chain_utxos
+    for height in range(1, num_blocks + 1):
+        txns = [spend(x) for x in coins[:txns_per_block]]
+        coins = coins[txns_per_block:]
+        coinbase = Transaction.create_coinbase(keys[0].pub_key_hash, f"bench {height}", height)
+        block = Block.new(blocks[-1].hash, [coinbase, *txns])
+        utxo_before_tip = chain_utxos.copy()
+        connect_block(chain_utxos, block)
+        blocks.append(block)
+
+    return Fixtures(
+        keys=keys,
+        utxo_set=chain_utxos,
+        mem_pool=mem_pool,
+        blocks=blocks,
+        utxo_before_tip=utxo_before_tip,
+    )
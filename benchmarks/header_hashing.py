@@ -0,0 +1,41 @@
+"""
+Compare header hashing throughput of the JSON header path(get_nonce_for) with
+the packed binary header path(get_nonce_for_prefix).
+
+    python -m benchmarks.header_hashing [num_hashes]
+"""
+import sys
+import time
+
+from bitcoin_rollup_sim.block import get_genesis_block
+from bitcoin_rollup_sim.utils import block as block_utils
+
+IMPOSSIBLE_TARGET = 1  # So that every nonce in the range gets hashed
+
+
+def time_json_path(num_hashes: int) -> float:
+    header = get_genesis_block().block_header
+    inp = header.serialize_without_nonce()
+    started = time.perf_counter()
+    block_utils.get_nonce_for(inp, IMPOSSIBLE_TARGET, num_hashes)
+    return time.perf_counter() - started
+
+
+def time_binary_path(num_hashes: int) -> float:
+    header = get_genesis_block().block_header
+    prefix = header.pack_without_nonce()
+    started = time.perf_counter()
+    block_utils.get_nonce_for_prefix(prefix, IMPOSSIBLE_TARGET, 0, num_hashes)
+    return time.perf_counter() - started
+
+
+def main(num_hashes: int = 200_000):
+    json_time = time_json_path(num_hashes)
+    binary_time = time_binary_path(num_hashes)
+    print(f"json header:   {num_hashes / json_time:12.0f} H/s")
+    print(f"binary header: {num_hashes / binary_time:12.0f} H/s")
+    print(f"speedup:       {json_time / binary_time:12.2f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
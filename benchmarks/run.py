@@ -0,0 +1,381 @@
+"""
+Benchmarks for the chain's hot paths.
+
+    python -m benchmarks.run [--utxos N] [--mempool N] [--blocks N] [--txns-per-block N]
+                             [--repeat N] [--only NAME ...] [--output FILE]
+                             [--baseline FILE] [--threshold FRACTION]
+
+Block connection (node_update_utxo, node_revert_utxo) should not get slower
+with the size of the UTXO set, compare e.g. --utxos 10000 with --utxos 1000000.
+
+Results are written as JSON (to stdout if no --output). With --baseline, the
+results are compared with a previous results file and the exit status is 1 if
+any benchmark got slower by more than --threshold.
+"""
+from typing import Any, Callable, List, Optional
+from dataclasses import dataclass
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from bitcoin_rollup_sim.block import Block
+from bitcoin_rollup_sim.coin_selection import select_coins
+from bitcoin_rollup_sim.mempool import Mempool
+from bitcoin_rollup_sim.storage import ChainStorage
+from bitcoin_rollup_sim.node import ENCODING_JSON, MAX_TXNS_PER_BLOCK, Node, encode_transactions
+from bitcoin_rollup_sim.relay import MAX_RELAY_BATCH, MAX_SEEN_TXNS, RecentSet
+from bitcoin_rollup_sim.transaction import Transaction
+from bitcoin_rollup_sim.utils.block import get_merkle_root, get_nonce_for, get_nonce_for_prefix
+from bitcoin_rollup_sim.utils.node import get_balance_for, get_inputs_for
+from bitcoin_rollup_sim.utxo import AddressIndex, connect_block
+from bitcoin_rollup_sim.validation import BatchValidator, validate_new_transaction
+
+from .fixtures import Fixtures, make_fixtures
+
+NONCES_PER_RUN = 20_000
+IMPOSSIBLE_TARGET = 1
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Called before every timed run with the fixtures, returns what is timed
+    setup: Callable[[Fixtures], Callable[[], Any]]
+    number: int = 1  # calls per timed run
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(name: str, number: int = 1):
+    def register(setup):
+        BENCHMARKS.append(Benchmark(name, setup, number))
+        return setup
+    return register
+
+
+@benchmark("get_nonce_for", number=1)
+def bench_get_nonce_for(fx: Fixtures):
+    inp = fx.tip.block_header.serialize_without_nonce()
+    return lambda: get_nonce_for(inp, IMPOSSIBLE_TARGET, NONCES_PER_RUN)
+
+
+@benchmark("get_nonce_for_prefix", number=1)
+def bench_get_nonce_for_prefix(fx: Fixtures):
+    prefix = fx.tip.block_header.pack_without_nonce()
+    return lambda: get_nonce_for_prefix(prefix, IMPOSSIBLE_TARGET, 0, NONCES_PER_RUN)
+
+
+@benchmark("get_merkle_root", number=10)
+def bench_get_merkle_root(fx: Fixtures):
+    txns = fx.tip.transactions
+    return lambda: get_merkle_root(txns)
+
+
+@benchmark("block_serialize", number=1)
+def bench_block_serialize(fx: Fixtures):
+    # A fresh copy every run, as serialization is memoized on the instance
+    block = Block.deserialize(fx.tip.serialize())
+    return block.serialize
+
+
+@benchmark("block_deserialize", number=10)
+def bench_block_deserialize(fx: Fixtures):
+    data = fx.tip.serialize()
+    return lambda: Block.deserialize(data)
+
+
+@benchmark("block_serialize_binary", number=1)
+def bench_block_serialize_binary(fx: Fixtures):
+    # A fresh copy every run, as serialization is memoized on the instance
+    block = Block.deserialize(fx.tip.serialize())
+    return block.serialize_binary
+
+
+@benchmark("block_deserialize_binary", number=10)
+def bench_block_deserialize_binary(fx: Fixtures):
+    data = fx.tip.serialize_binary()
+    return lambda: Block.deserialize_binary(data)
+
+
+@benchmark("transaction_serialize", number=1000)
+def bench_transaction_serialize(fx: Fixtures):
+    return fx.mem_pool[0].serialize
+
+
+@benchmark("transaction_deserialize", number=1000)
+def bench_transaction_deserialize(fx: Fixtures):
+    data = fx.mem_pool[0].serialize()
+    return lambda: Transaction.deserialize(data)
+
+
+@benchmark("validate_new_transaction", number=1)
+def bench_validate_new_transaction(fx: Fixtures):
+    def run():
+        for txn in fx.mem_pool:
+            assert validate_new_transaction(txn, fx.utxo_set)
+    return run
+
+
+@benchmark("validate_batch_parallel", number=1)
+def bench_validate_batch_parallel(fx: Fixtures):
+    items = [(x, fx.utxo_set) for x in fx.mem_pool]
+    validator = get_validator(items)
+    return lambda: validator.validate(items)
+
+
+@benchmark("mempool_select", number=100)
+def bench_mempool_select(fx: Fixtures):
+    pool = Mempool()
+    for txn in fx.mem_pool:
+        pool.add(txn, fx.utxo_set)
+    return lambda: pool.select(MAX_TXNS_PER_BLOCK)
+
+
+@benchmark("node_update_utxo", number=1)
+def bench_node_update_utxo(fx: Fixtures):
+    node = get_node()
+    node.utxo_set = fx.utxo_before_tip.copy()
+    node.utxo_set.index = AddressIndex.from_utxos(node.utxo_set)
+    return lambda: node.update_utxo(fx.tip)
+
+
+@benchmark("node_revert_utxo", number=1)
+def bench_node_revert_utxo(fx: Fixtures):
+    node = get_node()
+    node.utxo_set = fx.utxo_before_tip.copy()
+    node.utxo_set.index = AddressIndex.from_utxos(node.utxo_set)
+    node.update_utxo(fx.tip)
+    return lambda: node.revert_utxo(fx.tip)
+
+
+@benchmark("storage_update_utxo", number=1)
+def bench_storage_update_utxo(fx: Fixtures):
+    """Connecting the tip to an on disk utxo set, committed"""
+    data_dir = tempfile.mkdtemp(prefix="bench-storage-")
+    atexit.register(shutil.rmtree, data_dir, True)
+    storage = ChainStorage(data_dir)
+    for (txid, _), vout in fx.utxo_before_tip.items():
+        storage.utxos.add(txid, vout)
+    storage.commit()
+
+    def run():
+        connect_block(storage.utxos, fx.tip)
+        storage.commit()
+    return run
+
+
+@benchmark("get_balance_for", number=10)
+def bench_get_balance_for(fx: Fixtures):
+    pkh = fx.keys[0].pub_key_hash
+    return lambda: get_balance_for(pkh, fx.utxo_set)
+
+
+@benchmark("get_inputs_for", number=10)
+def bench_get_inputs_for(fx: Fixtures):
+    pkh = fx.keys[0].pub_key_hash
+    balance = get_balance_for(pkh, fx.utxo_set)
+    # Ask for most of the balance so that most coins are looked at
+    return lambda: get_inputs_for(pkh, balance * 9 // 10, fx.utxo_set)
+
+
+@benchmark("address_index_balance", number=1000)
+def bench_address_index_balance(fx: Fixtures):
+    index = AddressIndex.from_utxos(fx.utxo_set)
+    pkh = fx.keys[0].pub_key_hash
+    return lambda: index.get_balance(pkh)
+
+
+@benchmark("address_index_inputs", number=10)
+def bench_address_index_inputs(fx: Fixtures):
+    index = AddressIndex.from_utxos(fx.utxo_set)
+    pkh = fx.keys[0].pub_key_hash
+    balance = index.get_balance(pkh)
+    return lambda: index.get_inputs_for(pkh, balance * 9 // 10)
+
+
+@benchmark("select_coins", number=10)
+def bench_select_coins(fx: Fixtures):
+    index = AddressIndex.from_utxos(fx.utxo_set)
+    coins = index.get_coins(fx.keys[0].pub_key_hash)
+    balance = sum(vout.value for _, vout in coins)
+    return lambda: select_coins(coins, balance * 9 // 10 + 1)
+
+
+def get_relay_node(fx: Fixtures) -> Node:
+    """get_node receiving fx.mem_pool from a peer as if for the first time"""
+    node = get_node()
+    node.peers = {}
+    node.mem_pool = Mempool()
+    node.seen_txns = RecentSet(MAX_SEEN_TXNS)
+    node.utxo_set = fx.utxo_set
+    node.send = lambda *args, **kwargs: None
+    return node
+
+
+@benchmark("relay_txns_single", number=1)
+def bench_relay_txns_single(fx: Fixtures):
+    """fx.mem_pool arriving one newtxn message per txn"""
+    node = get_relay_node(fx)
+    messages = [f"bench:1 newtxn {x.serialize()}" for x in fx.mem_pool]
+
+    def run():
+        for message in messages:
+            node.on_receive_message(message, None)
+    return run
+
+
+@benchmark("relay_txns_batched", number=1)
+def bench_relay_txns_batched(fx: Fixtures):
+    """fx.mem_pool arriving in txns messages of MAX_RELAY_BATCH txns"""
+    node = get_relay_node(fx)
+    txns = list(fx.mem_pool)
+    messages = [
+        f"bench:1 txns {encode_transactions(txns[i:i + MAX_RELAY_BATCH], ENCODING_JSON)}"
+        for i in range(0, len(txns), MAX_RELAY_BATCH)
+    ]
+
+    def run():
+        for message in messages:
+            node.on_receive_message(message, None)
+    return run
+
+
+_node: Optional[Node] = None
+_validator: Optional[BatchValidator] = None
+
+
+def get_node() -> Node:
+    global _node
+    if _node is None:
+        _node = Node(peers={})
+        _node.socket.close()
+    return _node
+
+
+def get_validator(warmup_items) -> BatchValidator:
+    global _validator
+    if _validator is None:
+        _validator = BatchValidator(os.cpu_count() or 1)
+        # Start the workers outside of the timed runs
+        _validator.validate(warmup_items)
+    return _validator
+
+
+def time_benchmark(bench: Benchmark, fx: Fixtures, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        fn = bench.setup(fx)
+        started = time.perf_counter()
+        for _ in range(bench.number):
+            fn()
+        timings.append((time.perf_counter() - started) / bench.number)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "repeat": repeat,
+        "number": bench.number,
+    }
+
+
+def run_suite(params: dict, repeat: int = 5, only: Optional[List[str]] = None) -> dict:
+    fx = make_fixtures(**params)
+    results = {}
+    for bench in BENCHMARKS:
+        if only and bench.name not in only:
+            continue
+        results[bench.name] = time_benchmark(bench, fx, repeat)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": int(time.time()),
+            "params": params,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[dict]:
+    """
+    Compare medians of benchmarks present in both. ratio > 1 means slower
+    than the baseline.
+    """
+    rows = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["median"] / base["median"]
+        if ratio > 1 + threshold:
+            status = "slower"
+        elif ratio < 1 - threshold:
+            status = "faster"
+        else:
+            status = "same"
+        rows.append({
+            "name": name,
+            "baseline": base["median"],
+            "current": result["median"],
+            "ratio": ratio,
+            "status": status,
+        })
+    return rows
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the chain's hot paths")
+    parser.add_argument("--utxos", type=int, default=10_000)
+    parser.add_argument("--mempool", type=int, default=100)
+    parser.add_argument("--blocks", type=int, default=10)
+    parser.add_argument("--txns-per-block", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="*", help="Names of benchmarks to run")
+    parser.add_argument("--output", help="File to write the results JSON to")
+    parser.add_argument("--baseline", help="Results JSON of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {
+        "num_utxos": args.utxos,
+        "mempool_size": args.mempool,
+        "num_blocks": args.blocks,
+        "txns_per_block": args.txns_per_block,
+    }
+    results = run_suite(params, repeat=args.repeat, only=args.only)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results["comparison"] = compare(results, baseline, args.threshold)
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out)
+    else:
+        print(out)
+
+    for row in results.get("comparison", []):
+        print(
+            f"{row['name']:28} {row['ratio']:6.2f}x {row['status']}",
+            file=sys.stderr,
+        )
+    if any(x["status"] == "slower" for x in results.get("comparison", [])):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
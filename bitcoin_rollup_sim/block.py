@@ -1,15 +1,28 @@
-from typing import List
+from typing import List, Optional, Tuple
 import functools
 import json
 import time
 import hashlib
 import random
-from dataclasses import dataclass
+import struct
+import threading
+from dataclasses import dataclass, replace
 
 from .transaction import Transaction, VIn, VOut
-from .utils.block import get_merkle_root, get_nonce_for, calculate_new_difficulty
+from .utils.block import (
+    get_merkle_root,
+    calculate_new_difficulty,
+    TARGET_BLOCK_INTERVAL,
+    target_to_bits,
+    bits_to_target,
+    NONCE_FORMAT,
+)
 from .utils.common import pubkey_compressed_hash160
 from .keys import KeysAddress
+from .mining import ParallelMiner
+from .clock import SimClock
+from .merkle import MerkleTree, MerkleProof
+from .encoding import ByteReader, DecodeError, write_varint, versioned, read_versioned
 
 
 Random = random.Random(55)  # PRNG for creating initial coinbase p2pk address
@@ -17,8 +30,16 @@ Random = random.Random(55)  # PRNG for creating initial coinbase p2pk address
 INITIAL_DIFFICULTY = 2**237
 INITIAL_TIMESTAMP = 1694692863
 
+# version, prev_block_hash, merkle_root, timestamp, bits. The 4 bytes nonce
+# follows, making 80 bytes as in bitcoin.
+HEADER_PREFIX_FORMAT = struct.Struct("<I32s32sII")
+HEADER_SIZE = HEADER_PREFIX_FORMAT.size + NONCE_FORMAT.size
 
-@dataclass
+# Flags of a block in the binary format
+BLOCK_FLAG_FULL_TARGET = 0x01  # target does not fit in bits, 32 bytes target follow the header
+
+
+@dataclass(frozen=True)
 class BlockHeader:
     version: int  # 4 bytes in real
     prev_block_hash: str  # 32 bytes in real
@@ -48,6 +69,63 @@ class BlockHeader:
             self.nonce,
         ])
 
+    def pack_without_nonce(self) -> bytes:
+        """Fixed width binary header, without the trailing nonce"""
+        return HEADER_PREFIX_FORMAT.pack(
+            self.version,
+            bytes.fromhex(self.prev_block_hash),
+            bytes.fromhex(self.merkle_root),
+            self.timestamp,
+            self.bits,
+        )
+
+    def pack(self) -> bytes:
+        return self.pack_without_nonce() + NONCE_FORMAT.pack(self.nonce)
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        v, p, m, t, b = HEADER_PREFIX_FORMAT.unpack_from(data)
+        [n] = NONCE_FORMAT.unpack_from(data, HEADER_PREFIX_FORMAT.size)
+        return cls(
+            version=v,
+            prev_block_hash=p.hex(),
+            merkle_root=m.hex(),
+            timestamp=t,
+            difficulty_target=bits_to_target(b),
+            nonce=n,
+        )
+
+    def to_bytes(self) -> bytes:
+        """The packed header, along with the full target if it does not fit in bits"""
+        target = int(self.difficulty_target)
+        full_target = bits_to_target(self.bits) != target
+        return b"".join([
+            bytes([BLOCK_FLAG_FULL_TARGET if full_target else 0]),
+            self.pack(),
+            target.to_bytes(32, "little") if full_target else b"",
+        ])
+
+    @classmethod
+    def read_from(cls, reader: ByteReader):
+        flags = reader.read(1)[0]
+        header = cls.unpack(reader.read(HEADER_SIZE))
+        if flags & BLOCK_FLAG_FULL_TARGET:
+            target = int.from_bytes(reader.read(32), "little")
+            header = replace(header, difficulty_target=target)
+        return header
+
+    @property
+    def bits(self) -> int:
+        return target_to_bits(int(self.difficulty_target))
+
+    @functools.cached_property
+    def pow_hash(self) -> bytes:
+        """sha256 of the packed header. This is what is compared with the target"""
+        return hashlib.sha256(self.pack()).digest()
+
+    def check_pow(self) -> bool:
+        return self.pow_hash < int(self.difficulty_target).to_bytes(32, 'big')
+
     def to_json(self):
         return {
             "version": self.version,
@@ -71,25 +149,96 @@ class BlockHeader:
         )
 
 
-@dataclass
+@dataclass(frozen=True)
 class Block:
     block_header: BlockHeader
     num_transactions: int
-    transactions: List[Transaction]
+    transactions: Tuple[Transaction, ...]
     block_size: int = 0
 
     @functools.cached_property
     def hash(self) -> str:
         return hashlib.sha256(self.serialize().encode("utf-8")).hexdigest()
 
-    def serialize(self):
+    @functools.cached_property
+    def _serialized_body(self) -> str:
+        """Serialized block up to, not including, the block_size field"""
         return json.dumps([
             self.block_header.serialize(),
             self.num_transactions,
             [x.serialize() for x in self.transactions],
-            self.block_size,
+        ])[:-1]
+
+    @functools.cached_property
+    def _serialized(self) -> str:
+        # Same as json.dumps of the 4 fields
+        return f"{self._serialized_body}, {self.block_size}]"
+
+    def serialize(self) -> str:
+        return self._serialized
+
+    @functools.cached_property
+    def _packed(self) -> bytes:
+        return b"".join([
+            self.block_header.to_bytes(),
+            write_varint(self.num_transactions),
+            write_varint(len(self.transactions)),
+            *[x.to_bytes() for x in self.transactions],
+            write_varint(self.block_size),
         ])
 
+    def to_bytes(self) -> bytes:
+        return self._packed
+
+    @classmethod
+    def read_from(cls, reader: ByteReader):
+        header = BlockHeader.read_from(reader)
+        num_transactions = reader.read_varint()
+        transactions = tuple(Transaction.read_from(reader) for _ in range(reader.read_varint()))
+        return cls(
+            block_header=header,
+            num_transactions=num_transactions,
+            transactions=transactions,
+            block_size=reader.read_varint(),
+        )
+
+    def serialize_binary(self) -> bytes:
+        """Compact binary form for the wire, see encoding.py"""
+        return versioned(self.to_bytes())
+
+    @classmethod
+    def deserialize_binary(cls, data: bytes):
+        reader = read_versioned(data)
+        block = cls.read_from(reader)
+        if not reader.at_end():
+            raise DecodeError("Trailing data after block")
+        return block
+
+    @classmethod
+    def with_size(cls, block_header: BlockHeader, transactions: List[Transaction]) -> "Block":
+        """Block with block_size computed, serializing the transactions just once"""
+        unsized = cls(
+            block_size=0,
+            block_header=block_header,
+            num_transactions=len(transactions),
+            transactions=tuple(transactions),
+        )
+        block_size = len(unsized.serialize()) - 3  # noqa: Subtract 3 because block_size=0 present: [0, ...block after block_size field...]
+        block = replace(unsized, block_size=block_size)
+        # block_size comes last, everything before it is the same
+        block.__dict__["_serialized_body"] = unsized._serialized_body
+        return block
+
+    def get_merkle_proof(self, txid: str) -> Optional[MerkleProof]:
+        """
+        Proof that txid is included in this block, to be checked against the
+        header's merkle root with merkle.verify_merkle_proof
+        """
+        txids = [x.txid for x in self.transactions]
+        if txid not in txids:
+            return None
+        return MerkleTree(txids).get_proof(txids.index(txid))
+
     def to_json(self):
         return {
             "header": self.block_header.to_json(),
@@ -104,7 +253,7 @@ class Block:
         return cls(
             block_header=BlockHeader.deserialize(bh),
             num_transactions=nt,
-            transactions=[Transaction.deserialize(x) for x in t],
+            transactions=tuple(Transaction.deserialize(x) for x in t),
             block_size=bs,
         )
 
@@ -114,10 +263,11 @@ class Block:
         prev_block_hash: str,
         transactions: List[Transaction],
         version=1,
+        clock: Optional[SimClock] = None,
     ):
         merkle_root = get_merkle_root(transactions)
         difficulty_target = INITIAL_DIFFICULTY  # TODO: calculate new
-        timestamp = int(time.time())
+        timestamp = int(clock.time() if clock else time.time())
         header = BlockHeader(
             version=version,
             prev_block_hash=prev_block_hash,
@@ -126,16 +276,7 @@ class Block:
             difficulty_target=difficulty_target,
             nonce=0,  # this should be changed
         )
-
-        block = cls(
-            block_size=0,
-            block_header=header,
-            num_transactions=len(transactions),
-            transactions=transactions,
-        )
-        block_size = len(block.serialize()) - 3  # noqa: Subtract 3 because block_size=0 present: [0, ...block after block_size field...]
-        block.block_size = block_size
-        return block
+        return cls.with_size(header, transactions)
 
     @classmethod
     def mine(
@@ -144,11 +285,24 @@ class Block:
         transactions: List[Transaction],
         blocks: list,
         version=1,
-    ):
-        merkle_root = get_merkle_root(transactions)
-        difficulty_target = calculate_new_difficulty(blocks)
+        miner: Optional[ParallelMiner] = None,
+        abort: Optional[threading.Event] = None,
+        merkle_root: Optional[str] = None,
+        clock: Optional[SimClock] = None,
+        target_interval: int = TARGET_BLOCK_INTERVAL,
+    ) -> Optional["Block"]:
+        """
+        Returns None if abort gets set before a nonce is found.
+        merkle_root can be passed if the caller already has it for transactions.
+        Timestamps come from clock, which defaults to the wall clock, and the
+        target is retargeted for a block every target_interval seconds of it.
+        """
+        miner = miner or ParallelMiner()
+        clock = clock or SimClock()
+        merkle_root = merkle_root or get_merkle_root(transactions)
+        difficulty_target = calculate_new_difficulty(blocks, target_interval)
         while True:
-            timestamp = int(time.time())
+            timestamp = int(clock.time())
             header = BlockHeader(
                 version=version,
                 prev_block_hash=prev_block_hash,
@@ -157,21 +311,14 @@ class Block:
                 difficulty_target=difficulty_target,
                 nonce=0,  # this will be changed below
             )
-            header_formatted = header.serialize_without_nonce()
-            nonce = get_nonce_for(header_formatted, difficulty_target)
-            if nonce is not None:
-                header.nonce = nonce
+            result = miner.find_nonce(header.pack_without_nonce(), difficulty_target, abort)
+            if result.aborted:
+                return None
+            if result.nonce is not None:
+                header = replace(header, nonce=result.nonce)
                 break
 
-        block = cls(
-            block_size=0,
-            block_header=header,
-            num_transactions=len(transactions),
-            transactions=transactions,
-        )
-        block_size = len(block.serialize()) - 3  # noqa: Subtract 3 because block_size=0 present: [0, ...block after block_size field...]
-        block.block_size = block_size
-        return block
+        return cls.with_size(header, transactions)
 
 
 # Genesis coinbase paid to this address
@@ -195,10 +342,10 @@ def get_genesis_block() -> Block:
         merkle_root=merkle_root,
         timestamp=INITIAL_TIMESTAMP,
         difficulty_target=INITIAL_DIFFICULTY,
-        nonce=350254,  # noqa: nonce for genesis header, precalculated for above txns, time and so on
+        nonce=567555,  # noqa: nonce for genesis header, precalculated for above txns, time and so on
     )
     return Block(
         block_header=header,
         num_transactions=len(GenesisTransactions),
-        transactions=GenesisTransactions,
+        transactions=tuple(GenesisTransactions),
     )
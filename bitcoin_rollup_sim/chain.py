@@ -0,0 +1,246 @@
+"""
+Index of every block a node knows about: the ones of its active chain and the
+ones of competing branches.
+
+Each entry links to its parent and carries the height of the block and the
+total work of the chain ending at it. The active chain is the valid one with
+the most work, on a tie the first seen one is kept. Switching to another
+branch means disconnecting the active chain down to the fork point and
+connecting the blocks of the branch, see Node.activate_best_chain.
+"""
+from typing import Iterable, Iterator, List, Optional, Tuple
+from collections import deque
+from dataclasses import dataclass, field
+import itertools
+
+from .block import Block, BlockHeader
+from .encoding import ByteReader, write_hash
+
+
+def get_block_work(block: Block) -> int:
+    """Expected number of hashes it took to mine block"""
+    return 2**256 // (int(block.block_header.difficulty_target) + 1)
+
+
+@dataclass(eq=False, slots=True)
+class BlockIndexEntry:
+    hash: str
+    prev_hash: str
+    height: int
+    chain_work: int  # total work of the chain ending at this block
+    seq: int  # order in which blocks were seen, breaks ties of chain_work
+    # Only kept for blocks off the active chain, the node has the others
+    block: Optional[Block] = field(default=None, repr=False)
+    invalid: bool = False
+
+
+class BlockIndex:
+    def __init__(self):
+        self.entries: dict[str, BlockIndexEntry] = {}
+        self.best: Optional[BlockIndexEntry] = None  # most work valid entry
+        self._seq = itertools.count()
+
+    @classmethod
+    def from_chain(cls, blocks: Iterable[Block], height: int = 0) -> "BlockIndex":
+        """Index of the blocks of a chain, the first one being its root, at height"""
+        index = cls()
+        for block in blocks:
+            if not index.entries:
+                index.add_root(block, height)
+            else:
+                index.add(block)
+        for entry in index.entries.values():
+            entry.block = None
+        return index
+
+    @classmethod
+    def from_stored(cls, rows: Iterable[Tuple[str, str, int, int]]) -> "BlockIndex":
+        """
+        Like from_chain, from (hash, prev_hash, height, chain_work) of the
+        blocks of a chain, lowest first, without reading the blocks
+        """
+        index = cls()
+        for block_hash, prev_hash, height, chain_work in rows:
+            entry = BlockIndexEntry(block_hash, prev_hash, height, chain_work, next(index._seq))
+            index.entries[block_hash] = entry
+            index.best = entry
+        return index
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, block_hash: str):
+        return block_hash in self.entries
+
+    def __getitem__(self, block_hash: str) -> BlockIndexEntry:
+        return self.entries[block_hash]
+
+    def get(self, block_hash: str) -> Optional[BlockIndexEntry]:
+        return self.entries.get(block_hash)
+
+    def add_root(self, block: Block, height: int = 0) -> BlockIndexEntry:
+        """
+        Adds the block the index starts from, which has no parent to link to:
+        the genesis block or the tip of a UTXO snapshot
+        """
+        entry = BlockIndexEntry(
+            hash=block.hash,
+            prev_hash=block.block_header.prev_block_hash,
+            height=height,
+            chain_work=get_block_work(block),
+            seq=next(self._seq),
+            block=block,
+        )
+        self.entries[entry.hash] = entry
+        if self.best is None:
+            self.best = entry
+        return entry
+
+    def add(self, block: Block) -> Optional[BlockIndexEntry]:
+        """
+        Adds block on top of its parent, None if the parent is not known.
+        A block already present is not added again.
+        """
+        entry = self.entries.get(block.hash)
+        if entry is not None:
+            return entry
+        parent = self.entries.get(block.block_header.prev_block_hash)
+        if parent is None:
+            return None
+        entry = BlockIndexEntry(
+            hash=block.hash,
+            prev_hash=parent.hash,
+            height=parent.height + 1,
+            chain_work=parent.chain_work + get_block_work(block),
+            seq=next(self._seq),
+            block=block,
+            invalid=parent.invalid,
+        )
+        self.entries[entry.hash] = entry
+        if not entry.invalid and (self.best is None or entry.chain_work > self.best.chain_work):
+            self.best = entry
+        return entry
+
+    def mark_invalid(self, entry: BlockIndexEntry):
+        """Marks entry and all of its descendants invalid, so they are never chosen"""
+        entry.invalid = True
+        for other in sorted(self.entries.values(), key=lambda x: x.height):
+            if other.height > entry.height and self.entries[other.prev_hash].invalid:
+                other.invalid = True
+        valid = [x for x in self.entries.values() if not x.invalid]
+        self.best = max(valid, key=lambda x: (x.chain_work, -x.seq), default=None)
+
+    def find_fork(
+        self, a: BlockIndexEntry, b: BlockIndexEntry,
+    ) -> Tuple[BlockIndexEntry, List[BlockIndexEntry], List[BlockIndexEntry]]:
+        """
+        The last common ancestor of a and b, with the entries from it (not
+        included) up to a and up to b, lowest first.
+        """
+        branch_a: List[BlockIndexEntry] = []
+        branch_b: List[BlockIndexEntry] = []
+        while a is not b:
+            if a.height >= b.height:
+                branch_a.append(a)
+                a = self.entries[a.prev_hash]
+            else:
+                branch_b.append(b)
+                b = self.entries[b.prev_hash]
+        return a, branch_a[::-1], branch_b[::-1]
+
+
+class PartialChain:
+    """
+    The blocks of a chain from height `start` on, e.g. of a node started from
+    a UTXO snapshot. Indexes, slices and grows like the list of blocks of the
+    whole chain, the blocks before start are just not there.
+    """
+
+    def __init__(self, start: int, blocks: Iterable[Block] = ()):
+        self.start = start
+        self.blocks = list(blocks)
+
+    def __len__(self):
+        return self.start + len(self.blocks)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        height = key + len(self) if key < 0 else key
+        if not self.start <= height < len(self):
+            raise IndexError("block height out of range")
+        return self.blocks[height - self.start]
+
+    def __iter__(self) -> Iterator[Block]:
+        return iter(self.blocks)
+
+    def __contains__(self, block: Block):
+        return any(x.hash == block.hash for x in self.blocks)
+
+    def append(self, block: Block):
+        self.blocks.append(block)
+
+    def pop(self) -> Block:
+        return self.blocks.pop()
+
+
+@dataclass(frozen=True)
+class PrunedBlock:
+    """What is left of a block pruned from a PrunedChain, its txns are gone"""
+    hash: str
+    block_header: BlockHeader
+
+
+class PrunedChain:
+    """
+    The blocks of a chain from height `start` on, with only the last `keep`
+    ones in full. Older blocks are pruned down to their hash and header,
+    packed, which is what the block locator, the difficulty retarget and
+    headers sync need. Indexing them gives a PrunedBlock.
+    """
+
+    def __init__(self, keep: int, blocks: Iterable[Block] = (), start: int = 0):
+        self.keep = keep
+        self.start = start
+        self.pruned: List[bytes] = []  # packed hash and header of pruned blocks, from start
+        self.recent: deque[Block] = deque()
+        for block in blocks:
+            self.append(block)
+
+    @property
+    def full_start(self) -> int:
+        """Height of the first block kept in full"""
+        return self.start + len(self.pruned)
+
+    def __len__(self):
+        return self.full_start + len(self.recent)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        height = key + len(self) if key < 0 else key
+        if not self.start <= height < len(self):
+            raise IndexError("block height out of range")
+        if height >= self.full_start:
+            return self.recent[height - self.full_start]
+        reader = ByteReader(self.pruned[height - self.start])
+        return PrunedBlock(hash=reader.read_hash(), block_header=BlockHeader.read_from(reader))
+
+    def __iter__(self) -> Iterator[Block]:
+        for height in range(self.start, len(self)):
+            yield self[height]
+
+    def __contains__(self, block: Block):
+        return any(x.hash == block.hash for x in self)
+
+    def append(self, block: Block):
+        self.recent.append(block)
+        while len(self.recent) > self.keep:
+            old = self.recent.popleft()
+            self.pruned.append(write_hash(old.hash) + old.block_header.to_bytes())
+
+    def pop(self) -> Block:
+        """Removes the last block, which must not be pruned"""
+        if not self.recent:
+            raise IndexError("last block is pruned")
+        return self.recent.pop()
@@ -0,0 +1,27 @@
+import time
+from typing import Optional
+
+
+class SimClock:
+    """
+    Virtual clock for the simulation. From `epoch` on, it runs `speed` times
+    faster than wall clock time, so a run can cover hours of chain time in
+    minutes. Nodes of a network must share the same epoch and speed to agree
+    on time.
+
+    With the default speed of 1, it is the wall clock.
+    """
+
+    def __init__(self, speed: float = 1.0, epoch: Optional[float] = None):
+        self.speed = speed
+        self.epoch = time.time() if epoch is None else epoch
+
+    def time(self) -> float:
+        return self.epoch + (time.time() - self.epoch) * self.speed
+
+    def to_wall_seconds(self, seconds: float) -> float:
+        """Wall clock duration of `seconds` of virtual time"""
+        return seconds / self.speed
+
+    def sleep(self, seconds: float):
+        time.sleep(self.to_wall_seconds(seconds))
@@ -0,0 +1,118 @@
+"""
+Coin selection: which of a wallet's coins a payment spends.
+
+Every input costs a signature check on every node and makes the txn bigger,
+so payments spend as few coins as possible:
+
+  1. branch and bound looks for coins adding up to exactly the amount, with
+     the fewest inputs, so that the txn needs no change output
+  2. otherwise the smallest coin covering the amount on its own
+  3. otherwise the largest coins first, until the amount is covered
+
+Always taking big coins leaves a wallet with many small ones over time.
+With consolidate, a payment from a wallet holding more than
+CONSOLIDATE_MIN_COINS coins also spends some of its smallest ones, merging
+them into the change.
+"""
+from typing import List, Optional, Sequence, Tuple
+
+from .transaction import VOut
+from .utxo import TxId
+
+Coin = Tuple[TxId, VOut]
+
+BNB_MAX_TRIES = 10_000  # steps of the branch and bound search before giving up on it
+CONSOLIDATE_MIN_COINS = 10
+
+
+def select_coins(coins: Sequence[Coin], amt_sats: int, consolidate: int = 0) -> List[Coin]:
+    """
+    Coins adding up to at least amt_sats, an empty list if they are not
+    enough. consolidate is how many of the smallest other coins are spent
+    along, if there are more than CONSOLIDATE_MIN_COINS.
+    """
+    if amt_sats <= 0 or sum(vout.value for _, vout in coins) < amt_sats:
+        return []
+    selected = select_branch_and_bound(coins, amt_sats)
+    if selected is None:
+        selected = select_single(coins, amt_sats) or select_largest_first(coins, amt_sats)
+    if consolidate and len(coins) > CONSOLIDATE_MIN_COINS:
+        selected = selected + get_smallest(coins, consolidate, exclude=selected)
+    return selected
+
+
+def select_branch_and_bound(coins: Sequence[Coin], amt_sats: int) -> Optional[List[Coin]]:
+    """
+    Fewest coins adding up to exactly amt_sats, None if there are none or
+    the search gave up. An input costs more than a change output, so it
+    never takes more coins than select_largest_first does.
+
+    Coins are tried largest first, a branch is cut as soon as it overshoots,
+    can't reach amt_sats with the coins left or would take too many coins.
+    """
+    ordered = sorted(coins, key=lambda x: x[1].value, reverse=True)
+    # remaining[i]: total value of ordered[i:]
+    remaining = [0] * (len(ordered) + 1)
+    for i in range(len(ordered) - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + ordered[i][1].value
+    # No selection has fewer coins than the largest ones covering amt_sats
+    fewest = len(select_largest_first(coins, amt_sats))
+    max_coins = fewest
+
+    best: Optional[List[int]] = None
+    tries = 0
+    # Depth first with an explicit stack of (next coin, total, selected)
+    stack: List[Tuple[int, int, List[int]]] = [(0, 0, [])]
+    while stack and tries < BNB_MAX_TRIES:
+        tries += 1
+        i, total, selected = stack.pop()
+        if total == amt_sats:
+            best = selected
+            if len(best) == fewest:
+                break
+            max_coins = len(best) - 1
+            continue
+        if (
+            i == len(ordered)
+            or total + remaining[i] < amt_sats
+            or len(selected) + 1 > max_coins
+        ):
+            continue
+        value = ordered[i][1].value
+        # Leaving out ordered[i] and taking a coin of the same value next
+        # gives the same totals, so equal coins are left out together
+        j = i + 1
+        while j < len(ordered) and ordered[j][1].value == value:
+            j += 1
+        # Pushed first, so that taking ordered[i] is tried first
+        stack.append((j, total, selected))
+        if total + value <= amt_sats:
+            stack.append((i + 1, total + value, selected + [i]))
+    if best is None:
+        return None
+    return [ordered[i] for i in best]
+
+
+def select_single(coins: Sequence[Coin], amt_sats: int) -> List[Coin]:
+    """The smallest coin covering amt_sats, keeping bigger ones for bigger payments"""
+    covering = [x for x in coins if x[1].value >= amt_sats]
+    if not covering:
+        return []
+    return [min(covering, key=lambda x: x[1].value)]
+
+
+def select_largest_first(coins: Sequence[Coin], amt_sats: int) -> List[Coin]:
+    total = 0
+    selected = []
+    for coin in sorted(coins, key=lambda x: x[1].value, reverse=True):
+        total += coin[1].value
+        selected.append(coin)
+        if total >= amt_sats:
+            return selected
+    return []
+
+
+def get_smallest(coins: Sequence[Coin], count: int, exclude: Sequence[Coin] = ()) -> List[Coin]:
+    excluded = {(txid, vout.n) for txid, vout in exclude}
+    others = [x for x in coins if (x[0], x[1].n) not in excluded]
+    return sorted(others, key=lambda x: x[1].value)[:count]
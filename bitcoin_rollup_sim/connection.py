@@ -1,20 +1,53 @@
+from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import asyncio
 import random
+import select
+import selectors
 import socket
+import threading
+import time
 
-from .utils.common import recv_from_sock
+from .utils.common import (
+    FRAME_HEADER, FRAME_MESSAGE, FRAME_REPLY, MAX_FRAME_SIZE, FrameReader, pack_frame, send_frame,
+)
 
 
-# How many bytes to represent the size(stringified int) of the data
-DATA_LEN_NUM_BYTES = 5
 HOSTNAME = "0.0.0.0"
+# Seconds an outgoing connection is kept open without messages to send
+IDLE_TIMEOUT = 30
+# Seconds an incoming connection is kept open without messages to read. Longer
+# than IDLE_TIMEOUT, so the sending side is the one closing idle connections
+LISTEN_IDLE_TIMEOUT = 2 * IDLE_TIMEOUT
 
 random.seed(400)
 
 
+@dataclass
+class PeerConnection:
+    sock: socket.socket
+    last_used: float
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
 class ConnectionMixin:
+    """
+    Messages travel over long lived connections: send keeps one connection
+    per port open and reuses it, reconnecting if the other side closed it.
+    listen reads messages from all incoming connections as they arrive.
+
+    With async_workers, serve runs listen_async instead, where messages of
+    different connections are handled concurrently.
+    """
+    # Threads handling messages for listen_async, None serves with listen
+    async_workers: Optional[int] = None
+
     def __init__(self, *args, **kwargs):
         self.socket = socket.socket()
         self.nid = "<unnamed node>"
+        self.connections: dict[int, PeerConnection] = {}  # outgoing, by port
+        self.connections_lock = threading.Lock()
         self.setup()
 
     def setup(self):
@@ -31,23 +64,182 @@ class ConnectionMixin:
         pass
 
     def run(self):
-        self.listen()
+        self.serve()
+
+    def serve(self):
+        if self.async_workers:
+            asyncio.run(self.listen_async(self.async_workers))
+        else:
+            self.listen()
 
     def listen(self):
         self.socket.listen(10)   # 10 connections max
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        readers: dict[socket.socket, FrameReader] = {}
+        last_read: dict[socket.socket, float] = {}
+
+        def drop(conn: socket.socket):
+            selector.unregister(conn)
+            del readers[conn], last_read[conn]
+            conn.close()
+
         while True:
-            conn, addr = self.socket.accept()
-            # Read size of data in bytes
-            # first N bytes denote stringified number of bytes
-            data = recv_from_sock(conn)
-            resp = self.on_receive_message(data, conn)
-            if resp is not None:
-                ln = str(len(resp)).zfill(DATA_LEN_NUM_BYTES)
-                conn.send(f"{ln}{resp}".encode())
+            for key, _ in selector.select(timeout=LISTEN_IDLE_TIMEOUT / 4):
+                if key.fileobj is self.socket:
+                    conn, addr = self.socket.accept()
+                    selector.register(conn, selectors.EVENT_READ)
+                    readers[conn] = FrameReader(conn)
+                    last_read[conn] = time.monotonic()
+                    continue
+                conn = key.fileobj
+                if not self.read_messages(readers[conn]):
+                    drop(conn)
+                    continue
+                last_read[conn] = time.monotonic()
+            now = time.monotonic()
+            for conn, read_at in list(last_read.items()):
+                if now - read_at > LISTEN_IDLE_TIMEOUT:
+                    drop(conn)
+
+    def read_messages(self, reader: FrameReader) -> bool:
+        """
+        Reads what arrived on a connection and handles the messages completed
+        by it. False if the connection should be closed: the other side or a
+        message handler closed it, or it sent garbage.
+        """
+        try:
+            if not reader.feed():
+                return False
+            while True:
+                frame = reader.next_frame()
+                if frame is None:
+                    return True
+                self.handle_frame(*frame, reader.conn)
+                if reader.conn.fileno() == -1:  # closed by the handler, e.g. after replying to an app
+                    return False
+        except (OSError, ValueError):
+            return False
+
+    def handle_frame(self, frame_type: int, data: str, conn):
+        if frame_type != FRAME_MESSAGE:
+            raise ValueError(f"Unexpected frame type {frame_type}")
+        resp = self.on_receive_message(data, conn)
+        if resp is not None:
+            send_frame(conn, resp, FRAME_REPLY)
+
+    async def listen_async(self, workers: int):
+        """
+        Like listen, but every connection is read by its own task and its
+        messages are handled in a pool of threads, so a slow message or peer
+        does not hold up the others. Messages of a connection are still
+        handled one after the other, in order.
+        """
+        self.socket.listen(10)
+        self.socket.setblocking(False)
+        executor = ThreadPoolExecutor(workers, thread_name_prefix=f"{self.nid}-handler")
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            conn = StreamConnection(writer, asyncio.get_running_loop())
+            try:
+                while not conn.closed:
+                    frame = await asyncio.wait_for(read_frame_async(reader), LISTEN_IDLE_TIMEOUT)
+                    if frame is None:
+                        break
+                    await asyncio.get_running_loop().run_in_executor(
+                        executor, self.handle_frame, *frame, conn,
+                    )
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, sock=self.socket)
+        with executor:
+            async with server:
+                await server.serve_forever()
 
     def send(self, port: int, data: str, peer_id="<na>"):
-        addr = ("localhost", port)
-        s = socket.create_connection(addr)
-        ln = str(len(data)).zfill(DATA_LEN_NUM_BYTES)
-        s.send(f"{ln}{data}".encode())
+        message = pack_frame(data)
+        peer = self.get_connection(port)
+        with peer.lock:
+            try:
+                peer.sock.sendall(message)
+            except OSError:
+                # The other side went away, e.g. it restarted. Try once more
+                self.logger.info(f"Reconnecting to {peer_id}({port})")
+                peer.sock.close()
+                peer.sock = socket.create_connection(("localhost", port))
+                peer.sock.sendall(message)
+            peer.last_used = time.monotonic()
         self.logger.info(f"Sent data to {peer_id}({port})")
+
+    def get_connection(self, port: int) -> PeerConnection:
+        """The open connection to port, a new one if there is none or it was closed"""
+        self.close_idle_connections()
+        with self.connections_lock:
+            peer = self.connections.get(port)
+            if peer is not None and is_closed(peer.sock):
+                peer.sock.close()
+                peer = None
+            if peer is None:
+                peer = PeerConnection(socket.create_connection(("localhost", port)), time.monotonic())
+                self.connections[port] = peer
+            return peer
+
+    def close_idle_connections(self):
+        now = time.monotonic()
+        with self.connections_lock:
+            for port, peer in list(self.connections.items()):
+                if now - peer.last_used > IDLE_TIMEOUT and peer.lock.acquire(blocking=False):
+                    del self.connections[port]
+                    peer.sock.close()
+                    peer.lock.release()
+
+
+class StreamConnection:
+    """
+    What message handlers get as conn in listen_async: replies go through
+    the event loop, as handlers run in other threads
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.writer = writer
+        self.loop = loop
+        self.closed = False
+
+    def send(self, data: bytes) -> int:
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    sendall = send
+
+    def close(self):
+        self.closed = True
+
+
+async def read_frame_async(reader: asyncio.StreamReader) -> Optional[Tuple[int, str]]:
+    """Like FrameReader.read_frame, None if the connection was closed before a frame"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Connection closed within a frame")
+        return None
+    size, frame_type = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {size} bytes is too big")
+    payload = await reader.readexactly(size)
+    return frame_type, payload.decode("utf-8")
+
+
+def is_closed(sock: socket.socket) -> bool:
+    """
+    Whether the other side closed sock. Nothing is ever sent back on
+    connections used by send, so readable means the connection was closed.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
@@ -0,0 +1,139 @@
+"""
+Helpers for the compact binary encoding of blocks and transactions.
+
+Integers are little endian. Variable length integers use bitcoin's CompactSize
+format. Top level payloads (see versioned/read_versioned) start with a single
+byte format version.
+"""
+from typing import Optional
+import struct
+
+WIRE_FORMAT_VERSION = 1
+
+U32 = struct.Struct("<I")
+U64 = struct.Struct("<Q")
+U32_PAIR = struct.Struct("<II")
+
+# Tags for hex hashes, which are stored raw when possible
+HASH_EMPTY = 0
+HASH_RAW = 1
+HASH_STR = 2
+
+
+class DecodeError(Exception):
+    pass
+
+
+def write_varint(n: int) -> bytes:
+    if n < 0xFD:
+        return bytes([n])
+    if n <= 0xFFFF:
+        return b"\xfd" + n.to_bytes(2, "little")
+    if n <= 0xFFFFFFFF:
+        return b"\xfe" + n.to_bytes(4, "little")
+    return b"\xff" + n.to_bytes(8, "little")
+
+
+def write_bytes(data: bytes) -> bytes:
+    return write_varint(len(data)) + data
+
+
+def write_str(data: str) -> bytes:
+    return write_bytes(data.encode("utf-8"))
+
+
+def write_hash(data: str) -> bytes:
+    """32 bytes hex hash, or anything else that ends up in a hash field"""
+    if not data:
+        return bytes([HASH_EMPTY])
+    raw = to_raw_hash(data)
+    if raw is not None:
+        return bytes([HASH_RAW]) + raw
+    return bytes([HASH_STR]) + write_str(data)
+
+
+def to_raw_hash(data: str) -> Optional[bytes]:
+    """Raw 32 bytes if data is a lowercase 64 chars hex, else None"""
+    if len(data) != 64:
+        return None
+    try:
+        raw = bytes.fromhex(data)
+    except ValueError:
+        return None
+    return raw if raw.hex() == data else None
+
+
+def versioned(payload: bytes) -> bytes:
+    return bytes([WIRE_FORMAT_VERSION]) + payload
+
+
+def read_versioned(data: bytes) -> "ByteReader":
+    reader = ByteReader(data)
+    version = reader.read(1)[0]
+    if version != WIRE_FORMAT_VERSION:
+        raise DecodeError(f"Unsupported wire format version {version}")
+    return reader
+
+
+class ByteReader:
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data: bytes):
+        self.data = bytes(data)
+        self.pos = 0
+
+    def read(self, size: int) -> bytes:
+        pos = self.pos
+        end = pos + size
+        if end > len(self.data):
+            raise DecodeError("Unexpected end of data")
+        self.pos = end
+        return self.data[pos:end]
+
+    def read_byte(self) -> int:
+        try:
+            byte = self.data[self.pos]
+        except IndexError:
+            raise DecodeError("Unexpected end of data")
+        self.pos += 1
+        return byte
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        try:
+            values = fmt.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise DecodeError("Unexpected end of data")
+        self.pos += fmt.size
+        return values
+
+    def read_u32(self) -> int:
+        return self.unpack(U32)[0]
+
+    def read_u64(self) -> int:
+        return self.unpack(U64)[0]
+
+    def read_varint(self) -> int:
+        first = self.read_byte()
+        if first < 0xFD:
+            return first
+        size = {0xFD: 2, 0xFE: 4, 0xFF: 8}[first]
+        return int.from_bytes(self.read(size), "little")
+
+    def read_bytes(self) -> bytes:
+        return self.read(self.read_varint())
+
+    def read_str(self) -> str:
+        return self.read_bytes().decode("utf-8")
+
+    def read_hash(self) -> str:
+        tag = self.read_byte()
+        if tag == HASH_RAW:
+            return self.read(32).hex()
+        if tag == HASH_EMPTY:
+            return ""
+        if tag == HASH_STR:
+            return self.read_str()
+        raise DecodeError(f"Invalid hash tag {tag}")
+
+    def at_end(self) -> bool:
+        return self.pos == len(self.data)
@@ -0,0 +1,137 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+from dataclasses import dataclass
+import heapq
+import itertools
+import threading
+
+from .transaction import Transaction
+from .utxo import UtxoSet, get_spent_outpoints
+
+# Rebuild the heap once stale entries outnumber live ones by this factor
+HEAP_COMPACT_FACTOR = 2
+
+
+@dataclass
+class MempoolEntry:
+    txn: Transaction
+    fee: int  # sats, inputs minus outputs
+    size: int  # bytes of serialized txn
+    seq: int  # arrival order, also breaks fee rate ties
+
+    @property
+    def fee_rate(self) -> float:
+        return self.fee / self.size
+
+
+def get_fee(txn: Transaction, utxos: UtxoSet) -> Optional[int]:
+    """Returns None if any of the inputs is not in utxos"""
+    vouts = utxos.get_many(get_spent_outpoints([txn]))
+    if any(x is None for x in vouts):
+        return None
+    return sum(x.value for x in vouts) - sum(x.value for x in txn.vout)
+
+
+class Mempool:
+    """
+    Transactions waiting to be mined, indexed by fee rate.
+
+    The heap holds (-fee_rate, seq, txid) and removal is lazy: removed txns
+    stay in the heap until they surface and are found missing from entries.
+    """
+
+    def __init__(self):
+        self.entries: dict[str, MempoolEntry] = {}
+        # (txid, vout index) -> txid of the mempool txn spending it
+        self.spent_outpoints: dict[Tuple[str, int], str] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid: str):
+        return txid in self.entries
+
+    def __iter__(self) -> Iterator[Transaction]:
+        """Transactions in arrival order"""
+        return iter([x.txn for x in list(self.entries.values())])
+
+    def add(self, txn: Transaction, utxos: UtxoSet) -> bool:
+        """
+        Returns False if txn is already present, spends unknown outputs,
+        spends more than its inputs or conflicts with a txn in the pool.
+        """
+        fee = get_fee(txn, utxos)
+        if fee is None or fee < 0:
+            return False
+        outpoints = get_spent_outpoints([txn])
+        with self._lock:
+            if txn.txid in self.entries:
+                return False
+            if any(x in self.spent_outpoints for x in outpoints):
+                return False
+            entry = MempoolEntry(
+                txn=txn,
+                fee=fee,
+                size=len(txn.serialize()),
+                seq=next(self._seq),
+            )
+            self.entries[txn.txid] = entry
+            for outpoint in outpoints:
+                self.spent_outpoints[outpoint] = txn.txid
+            heapq.heappush(self._heap, (-entry.fee_rate, entry.seq, txn.txid))
+        return True
+
+    def select(self, max_txns: int) -> List[Transaction]:
+        """
+        Highest fee rate txns, best first, in O(k log n). The txns stay in the
+        pool until removed.
+        """
+        selected: List[Tuple[float, int, str]] = []
+        with self._lock:
+            while self._heap and len(selected) < max_txns:
+                item = heapq.heappop(self._heap)
+                entry = self.entries.get(item[2])
+                if entry is None or entry.seq != item[1]:
+                    continue  # stale, drop it for good
+                selected.append(item)
+            for item in selected:
+                heapq.heappush(self._heap, item)
+            return [self.entries[x[2]].txn for x in selected]
+
+    def remove(self, txid: str):
+        with self._lock:
+            self._remove(txid)
+            self._maybe_compact()
+
+    def remove_many(self, txids: Iterable[str]):
+        with self._lock:
+            for txid in txids:
+                self._remove(txid)
+            self._maybe_compact()
+
+    def remove_for_block(self, transactions: Iterable[Transaction]):
+        """Remove txns included in a block and txns conflicting with them"""
+        with self._lock:
+            for txn in transactions:
+                self._remove(txn.txid)
+                for vin in txn.vin:
+                    conflict = self.spent_outpoints.get((vin.transaction_id, vin.vout))
+                    if conflict is not None:
+                        self._remove(conflict)
+            self._maybe_compact()
+
+    def _remove(self, txid: str):
+        entry = self.entries.pop(txid, None)
+        if entry is None:
+            return
+        for vin in entry.txn.vin:
+            self.spent_outpoints.pop((vin.transaction_id, vin.vout), None)
+
+    def _maybe_compact(self):
+        if len(self._heap) > HEAP_COMPACT_FACTOR * len(self.entries) + 64:
+            self._heap = [
+                (-x.fee_rate, x.seq, txid) for txid, x in self.entries.items()
+            ]
+            heapq.heapify(self._heap)
@@ -0,0 +1,85 @@
+from typing import Iterable, List, Optional, Tuple, TypeAlias
+import hashlib
+
+# (sibling hash, whether the sibling is on the left) for each level, leaf first
+MerkleProof: TypeAlias = List[Tuple[str, bool]]
+
+
+def hash_pair(left: str, right: str) -> str:
+    return hashlib.sha256((left + right).encode('utf-8')).hexdigest()
+
+
+class MerkleTree:
+    """
+    Merkle tree over txids which keeps all its levels, so that appending or
+    replacing a leaf only rehashes the path to the root.
+
+    Levels with odd number of items pair the last item with itself, and the
+    leaves are hashed at least once even if there is a single one. This gives
+    the same root as utils.block.get_merkle_root always did.
+    """
+
+    def __init__(self, leaves: Iterable[str] = ()):
+        self.levels: List[List[str]] = [list(leaves)]
+        level = self.levels[0]
+        while level and (len(level) > 1 or len(self.levels) == 1):
+            level = [
+                hash_pair(level[i], level[i + 1] if i + 1 < len(level) else level[i])
+                for i in range(0, len(level), 2)
+            ]
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    @property
+    def leaves(self) -> List[str]:
+        return self.levels[0]
+
+    @property
+    def root(self) -> Optional[str]:
+        if not self.leaves:
+            return None
+        return self.levels[-1][0]
+
+    def append(self, leaf: str):
+        self.levels[0].append(leaf)
+        self._update_path(len(self.levels[0]) - 1)
+
+    def replace(self, index: int, leaf: str):
+        self.levels[0][index] = leaf
+        self._update_path(index)
+
+    def _update_path(self, index: int):
+        depth = 0
+        while depth == 0 or len(self.levels[depth]) > 1:
+            level = self.levels[depth]
+            parent = index // 2
+            left = level[2 * parent]
+            right = level[2 * parent + 1] if 2 * parent + 1 < len(level) else left
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+            upper = self.levels[depth + 1]
+            if parent == len(upper):
+                upper.append(hash_pair(left, right))
+            else:
+                upper[parent] = hash_pair(left, right)
+            index = parent
+            depth += 1
+
+    def get_proof(self, index: int) -> MerkleProof:
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling >= len(level):  # odd one out is paired with itself
+                sibling = index
+            proof.append((level[sibling], sibling < index))
+            index //= 2
+        return proof
+
+
+def verify_merkle_proof(leaf: str, proof: MerkleProof, root: str) -> bool:
+    digest = leaf
+    for sibling, is_left in proof:
+        digest = hash_pair(sibling, digest) if is_left else hash_pair(digest, sibling)
+    return digest == root
@@ -0,0 +1,170 @@
+"""
+Nonce search spread over a pool of worker processes.
+
+The nonce space is cut into chunks which are handed out to the workers. The
+first worker that finds a nonce sets a shared stop event, after which every
+other worker gives up its chunk at the next check. The same event is used to
+abort a search from outside, e.g. when a new tip arrives.
+"""
+from typing import Optional
+from dataclasses import dataclass
+import multiprocessing
+import threading
+import time
+
+from .utils.block import get_nonce_for_prefix, NONCE_SPACE
+
+CHUNK_SIZE = 2**14  # Nonces handed to a worker at once
+STOP_CHECK_INTERVAL = 2**10  # Nonces hashed between checks of the stop event
+ABORT_POLL_INTERVAL = 0.002  # Seconds between checks of the abort event while workers run
+
+# Set in each worker process by the pool initializer
+_stop_event = None
+
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def _search_chunk(args) -> tuple[Optional[int], int]:
+    """
+    Scan [start, end) for a nonce. Returns the nonce found (or None) and the
+    number of hashes computed.
+    """
+    prefix, difficulty, start, end = args
+    tried = 0
+    for batch_start in range(start, end, STOP_CHECK_INTERVAL):
+        if _stop_event.is_set():
+            return None, tried
+        batch_end = min(batch_start + STOP_CHECK_INTERVAL, end)
+        nonce = get_nonce_for_prefix(prefix, difficulty, batch_start, batch_end)
+        if nonce is not None:
+            return nonce, tried + nonce - batch_start + 1
+        tried += batch_end - batch_start
+    return None, tried
+
+
+@dataclass
+class MiningResult:
+    nonce: Optional[int]
+    hashes: int
+    elapsed: float  # seconds
+    workers: int
+    aborted: bool = False
+
+    @property
+    def hashrate(self) -> float:
+        """Hashes per second"""
+        return self.hashes / self.elapsed if self.elapsed else 0.0
+
+
+class ParallelMiner:
+    """
+    Finds nonces with `workers` processes. With a single worker it just runs
+    get_nonce_for_prefix in the calling process.
+
+    The pool is created lazily on first use, so the miner can be built in one
+    process and used in another (nodes are started with multiprocessing).
+    """
+
+    def __init__(self, workers: int = 1, nonce_space: int = NONCE_SPACE):
+        self.workers = max(1, workers)
+        self.nonce_space = nonce_space
+        self.hashes = 0
+        self.elapsed = 0.0
+        self._pool = None
+        self._stop_event = None
+
+    @property
+    def hashrate(self) -> float:
+        """Hashes per second over all searches since the last reset_stats()"""
+        return self.hashes / self.elapsed if self.elapsed else 0.0
+
+    def reset_stats(self):
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._stop_event = multiprocessing.Event()
+            self._pool = multiprocessing.Pool(
+                self.workers,
+                initializer=_init_worker,
+                initargs=(self._stop_event,),
+            )
+        return self._pool
+
+    def find_nonce(
+        self,
+        prefix: bytes,
+        difficulty: int,
+        abort: Optional[threading.Event] = None,
+    ) -> MiningResult:
+        """
+        prefix: packed header without nonce, see BlockHeader.pack_without_nonce
+        abort: when set, the search stops within a few milliseconds and the
+            result has aborted=True
+        """
+        started = time.perf_counter()
+        if self.workers == 1:
+            nonce, hashes, aborted = self._find_nonce_serial(prefix, difficulty, abort)
+        else:
+            nonce, hashes, aborted = self._find_nonce_parallel(prefix, difficulty, abort)
+        result = MiningResult(
+            nonce=nonce,
+            hashes=hashes,
+            elapsed=time.perf_counter() - started,
+            workers=self.workers,
+            aborted=aborted,
+        )
+        self.hashes += result.hashes
+        self.elapsed += result.elapsed
+        return result
+
+    def _find_nonce_serial(self, prefix: bytes, difficulty: int, abort):
+        hashes = 0
+        for start in range(0, self.nonce_space, STOP_CHECK_INTERVAL):
+            if abort is not None and abort.is_set():
+                return None, hashes, True
+            end = min(start + STOP_CHECK_INTERVAL, self.nonce_space)
+            nonce = get_nonce_for_prefix(prefix, difficulty, start, end)
+            if nonce is not None:
+                return nonce, hashes + nonce - start + 1, False
+            hashes += end - start
+        return None, hashes, False
+
+    def _find_nonce_parallel(self, prefix: bytes, difficulty: int, abort):
+        pool = self._get_pool()
+        self._stop_event.clear()
+        chunks = [
+            (prefix, difficulty, start, min(start + CHUNK_SIZE, self.nonce_space))
+            for start in range(0, self.nonce_space, CHUNK_SIZE)
+        ]
+        nonce = None
+        hashes = 0
+        aborted = False
+        # Drain every result so the pool is idle when we return. Chunks that
+        # start after the stop event is set return right away.
+        results = pool.imap_unordered(_search_chunk, chunks)
+        while True:
+            if abort is not None and abort.is_set() and not self._stop_event.is_set():
+                aborted = True
+                self._stop_event.set()
+            try:
+                found, tried = results.next(timeout=ABORT_POLL_INTERVAL)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            hashes += tried
+            if found is not None and nonce is None and not aborted:
+                nonce = found
+                self._stop_event.set()
+        return nonce, hashes, aborted
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
@@ -1,24 +1,131 @@
-from typing import List
+from typing import List, Optional
+import base64
 import json
 import random
 import time
 import logging
+import socket
 import threading
-from collections import defaultdict
 
 from .transaction import Transaction, VIn, VOut
-from .block import Block, get_genesis_block
+from .block import Block, BlockHeader, get_genesis_block
+from .coin_selection import select_coins
+from .chain import BlockIndex, PartialChain, PrunedBlock, PrunedChain
+from .encoding import (
+    ByteReader, DecodeError, read_versioned, versioned, write_bytes, write_hash, write_varint,
+)
 from .keys import KeysAddress
-from .validation import validate_new_transaction, validate_new_block
-from .utils.node import get_inputs_for, get_balance_for
-from .utils.common import get_signature
+from .validation import validate_merkle_root, validate_new_transaction, validate_new_block, BatchValidator
+from .utils.common import FRAME_REPLY, get_signature, recv_frame, send_frame
+from .utils.block import RETARGET_WINDOW, TARGET_BLOCK_INTERVAL, calculate_new_difficulty
+from .mining import ParallelMiner
+from .merkle import MerkleTree
+from .mempool import Mempool
+from .utxo import AddressIndex, BlockUndo, UtxoSet, connect_block, disconnect_block, get_spent_outpoints
+from .clock import SimClock
+from .storage import ChainStorage
+from .snapshot import SNAPSHOT_BLOCKS, UtxoSnapshot, validate_history
+from .sync import BLOCKS_PER_REQUEST, MAX_HEADERS, HeaderItem, HeaderSync, get_locator
 from .connection import ConnectionMixin
+from .relay import (
+    INV_BLOCK, INV_TXN, MAX_PEER_INVENTORY, MAX_RELAY_BATCH, MAX_REJECTED_TXNS, MAX_REQUESTED,
+    MAX_SEEN_BLOCKS, MAX_SEEN_TXNS, RELAY_REQUEST_TIMEOUT, TXN_RELAY_INTERVAL, InvBatches, ItemRequest,
+    RecentSet,
+)
 
 MIN_TXNS_PER_BLOCK = 3
 MAX_TXNS_PER_BLOCK = 10
 MIN_TIME_SINCE_LAST_BLOCK = 30  # Seconds
 # Only start candidate block mining if there are no min txns in mempool
 # and above time has elapsed
+MINING_INTERVAL = 10  # Seconds between mining attempts, unless new work arrives
+# Abort the current mining attempt once this many txns arrive after the
+# candidate block was built
+MEMPOOL_REBUILD_THRESHOLD = MAX_TXNS_PER_BLOCK // 2
+# Blocks whose parent is not known yet are kept until it arrives, up to this many
+MAX_ORPHAN_BLOCKS = 100
+SYNC_INTERVAL = 10  # Wall clock seconds between asking peers for new headers
+APP_BLOCKS_PER_REQUEST = 500  # Blocks per app:getblocks when fetching a whole chain
+# Fewest full blocks a pruned node keeps, enough to dump a UTXO snapshot
+MIN_PRUNED_BLOCKS = SNAPSHOT_BLOCKS
+
+# Encodings of blocks and txns on the wire, most preferred first. Peers tell
+# each other what they support with a hello message; until then json is used.
+ENCODING_BINARY = "bin1"
+ENCODING_JSON = "json"
+SUPPORTED_ENCODINGS = [ENCODING_BINARY, ENCODING_JSON]
+# Suffix of message types carrying binary payloads, e.g. newblock:bin
+BINARY_MSG_SUFFIX = ":bin"
+
+
+def encode_payload(item: Block | Transaction, encoding: str) -> str:
+    if encoding == ENCODING_BINARY:
+        # The message protocol is text, so binary payloads go as base64
+        return base64.b64encode(item.serialize_binary()).decode()
+    return item.serialize()
+
+
+def decode_block(data: str, encoding: str) -> Block:
+    if encoding == ENCODING_BINARY:
+        return Block.deserialize_binary(base64.b64decode(data))
+    return Block.deserialize(data)
+
+
+def decode_transaction(data: str, encoding: str) -> Transaction:
+    if encoding == ENCODING_BINARY:
+        return Transaction.deserialize_binary(base64.b64decode(data))
+    return Transaction.deserialize(data)
+
+
+def encode_headers(items: List[HeaderItem], encoding: str) -> str:
+    if encoding == ENCODING_BINARY:
+        data = write_varint(len(items)) + b"".join(write_hash(h) + x.to_bytes() for h, x in items)
+        return base64.b64encode(versioned(data)).decode()
+    return json.dumps([[h, x.serialize()] for h, x in items])
+
+
+def decode_headers(data: str, encoding: str) -> List[HeaderItem]:
+    if encoding == ENCODING_BINARY:
+        reader = read_versioned(base64.b64decode(data))
+        items = [(reader.read_hash(), BlockHeader.read_from(reader)) for _ in range(reader.read_varint())]
+        if not reader.at_end():
+            raise DecodeError("Trailing data after headers")
+        return items
+    return [(h, BlockHeader.deserialize(x)) for h, x in json.loads(data)]
+
+
+def encode_blocks(blocks: List[Block], encoding: str) -> str:
+    if encoding == ENCODING_BINARY:
+        data = write_varint(len(blocks)) + b"".join(write_bytes(x.to_bytes()) for x in blocks)
+        return base64.b64encode(versioned(data)).decode()
+    return json.dumps([x.serialize() for x in blocks])
+
+
+def decode_blocks(data: str, encoding: str) -> List[Block]:
+    if encoding == ENCODING_BINARY:
+        reader = read_versioned(base64.b64decode(data))
+        blocks = [Block.read_from(ByteReader(reader.read_bytes())) for _ in range(reader.read_varint())]
+        if not reader.at_end():
+            raise DecodeError("Trailing data after blocks")
+        return blocks
+    return [Block.deserialize(x) for x in json.loads(data)]
+
+
+def encode_transactions(txns: List[Transaction], encoding: str) -> str:
+    if encoding == ENCODING_BINARY:
+        data = write_varint(len(txns)) + b"".join(write_bytes(x.to_bytes()) for x in txns)
+        return base64.b64encode(versioned(data)).decode()
+    return json.dumps([x.serialize() for x in txns])
+
+
+def decode_transactions(data: str, encoding: str) -> List[Transaction]:
+    if encoding == ENCODING_BINARY:
+        reader = read_versioned(base64.b64decode(data))
+        txns = [Transaction.read_from(ByteReader(reader.read_bytes())) for _ in range(reader.read_varint())]
+        if not reader.at_end():
+            raise DecodeError("Trailing data after transactions")
+        return txns
+    return [Transaction.deserialize(x) for x in json.loads(data)]
 
 
 logging.basicConfig(
@@ -32,20 +139,195 @@ class Node(ConnectionMixin):
     nid: str = "<none>"
     port: int = 0
     peers: dict = dict()
-    propagated_txns: list[str] = list()
-    propagated_blocks: list[str] = list()
-    mem_pool: list[Transaction] = list()
-    utxo_set: dict[str, list[VOut]] = dict()
+    mem_pool: Mempool
+    utxo_set: UtxoSet
     blocks: list[Block] = list([get_genesis_block()])
     type = "full"
+    validation_workers: int = 1  # Processes used for script checks of blocks
+    # The UTXO snapshot the node was started from, if any, and whether the
+    # history up to its tip was found valid (None until checked)
+    snapshot: Optional[UtxoSnapshot] = None
+    history_validated: Optional[bool] = None
+    # Full blocks kept in memory by a pruned node, None keeps all of them
+    prune: Optional[int] = None
+    # Txn invs queued for a peer are sent every relay_interval seconds, or
+    # once relay_batch_size of them are queued
+    relay_interval: float = TXN_RELAY_INTERVAL
+    relay_batch_size: int = MAX_RELAY_BATCH
+    # Blocks are retargeted for one every target_block_interval seconds of
+    # self.clock. Received blocks and headers must carry the target that
+    # gives, unless check_targets is off
+    target_block_interval: int = TARGET_BLOCK_INTERVAL
+    check_targets: bool = True
 
-    def __init__(self, peers):
+    def __init__(
+        self,
+        peers,
+        clock: Optional[SimClock] = None,
+        validation_workers=None,
+        data_dir: Optional[str] = None,
+        snapshot: Optional[str] = None,
+        snapshot_commitment: Optional[str] = None,
+        prune: Optional[int] = None,
+        async_workers: Optional[int] = None,
+        relay_interval: Optional[float] = None,
+        relay_batch_size: Optional[int] = None,
+        target_block_interval: Optional[int] = None,
+    ):
         super().__init__()
+        if validation_workers is not None:
+            self.validation_workers = validation_workers
+        if async_workers is not None:
+            self.async_workers = async_workers
+        if relay_interval is not None:
+            self.relay_interval = relay_interval
+        if relay_batch_size is not None:
+            self.relay_batch_size = relay_batch_size
+        if target_block_interval is not None:
+            self.target_block_interval = target_block_interval
+        if prune is not None:
+            if prune < MIN_PRUNED_BLOCKS:
+                raise ValueError(f"A pruned node keeps at least {MIN_PRUNED_BLOCKS} blocks")
+            self.prune = prune
+        self.clock = clock or SimClock()
         self.nid = f"{self.type}-{random.randrange(100)}"
         self.logger = logging.getLogger(self.nid)
         self.logger.warning(f"Running {self.type} node on port {self.port}")
 
         self.peers = {k: v for k, v in peers.items()}
+        self.mem_pool = Mempool()
+        # utxo_set is changed in place, guard it against readers in other threads
+        self.utxo_lock = threading.RLock()
+        # With a data_dir, the chain, utxos and undo records live on disk
+        self.storage: Optional[ChainStorage] = None
+        if data_dir is not None:
+            # Blocks are on disk already, pruning bounds the ones cached in memory
+            if self.prune is not None:
+                self.storage = ChainStorage(data_dir, block_cache_size=self.prune)
+            else:
+                self.storage = ChainStorage(data_dir)
+            self.blocks = self.storage.blocks
+            self.utxo_set = self.storage.utxos
+            self.block_undo = self.storage.undo
+        else:
+            if self.prune is not None:
+                self.blocks = PrunedChain(self.prune, self.blocks)
+            self.utxo_set = UtxoSet(index=AddressIndex())
+            # Block hash -> what connecting the block changed in utxo_set
+            self.block_undo: dict[str, BlockUndo] = {}
+        self._block_index: Optional[BlockIndex] = None
+        if snapshot is not None:
+            if self.storage is not None:
+                raise ValueError("A node with a data_dir can't be started from a snapshot")
+            self.load_snapshot(UtxoSnapshot.load(snapshot, snapshot_commitment))
+        # Hash of the missing parent -> blocks waiting for it
+        self.orphan_blocks: dict[str, list[Block]] = {}
+        self.sync = HeaderSync()
+        self.validator = BatchValidator(self.validation_workers)
+        self.peer_encodings: dict[str, str] = {}
+        self.hello_sent: set[str] = set()
+        # Relay state, see relay.py
+        self.seen_txns = RecentSet(MAX_SEEN_TXNS)  # accepted or mined
+        # Txns that failed validation or conflicted with the mempool. Only
+        # until the next block, which may make them valid, e.g. by creating
+        # their inputs
+        self.rejected_txns = RecentSet(MAX_REJECTED_TXNS)
+        self.seen_blocks = RecentSet(MAX_SEEN_BLOCKS)
+        self.peer_inventory: dict[str, RecentSet] = {}
+        self.requested = RecentSet(MAX_REQUESTED)  # hash -> ItemRequest
+        self.txn_invs = InvBatches(self.relay_batch_size)
+
+    @property
+    def block_index(self) -> BlockIndex:
+        """
+        Every block seen, by hash, with the branches competing with
+        self.blocks. Built on first use, as it reads the whole chain, except
+        with a data_dir where it is loaded from the stored index.
+        """
+        if self._block_index is None:
+            if self.storage is not None:
+                # Stored along with the chain, so that restarting does not read it
+                self._block_index = BlockIndex.from_stored(self.storage.blocks.get_index())
+            elif self.snapshot is None:
+                self._block_index = BlockIndex.from_chain(self.blocks)
+            else:
+                # There are no undo records below the tip of the snapshot,
+                # so the chain is never reorganized past it
+                height = self.snapshot.height
+                self._block_index = BlockIndex.from_chain(self.blocks[height:], height)
+        return self._block_index
+
+    @property
+    def chain_start(self) -> int:
+        """Height of the first block the node has, above 0 when started from a snapshot"""
+        return self.blocks.start if isinstance(self.blocks, (PartialChain, PrunedChain)) else 0
+
+    @property
+    def full_blocks_start(self) -> int:
+        """Height of the first block the node has with its txns, the ones before it are pruned"""
+        return self.blocks.full_start if isinstance(self.blocks, PrunedChain) else self.chain_start
+
+    def load_snapshot(self, snapshot: UtxoSnapshot):
+        """Starts the chain and utxo set from snapshot, instead of from genesis"""
+        with self.utxo_lock:
+            self.snapshot = snapshot
+            if self.prune is not None:
+                self.blocks = PrunedChain(self.prune, snapshot.blocks, snapshot.start)
+            else:
+                self.blocks = PartialChain(snapshot.start, snapshot.blocks)
+            self.utxo_set = UtxoSet(snapshot.outputs)
+            self.utxo_set.index = AddressIndex.from_utxos(self.utxo_set)
+            self.block_undo = {}
+            self._block_index = None
+        self.logger.warning(
+            f"Started from snapshot at height {snapshot.height}, commitment {snapshot.commitment}"
+        )
+
+    def dump_snapshot(self, path: str) -> UtxoSnapshot:
+        with self.utxo_lock:
+            snapshot = UtxoSnapshot.create(self.blocks, self.utxo_set)
+        snapshot.save(path)
+        return snapshot
+
+    def validate_snapshot_history(self) -> Optional[bool]:
+        """
+        Replays the chain up to the tip of the snapshot, as served by peers,
+        until one of them gives a valid one. history_validated is False if
+        none did, the node keeps following the chain but should not be
+        trusted.
+        """
+        for peer_id, port in list(self.peers.items()):
+            try:
+                blocks = self.fetch_blocks(port)
+            except Exception:
+                self.logger.warning(f"Could not get blocks from {peer_id}")
+                continue
+            if validate_history(blocks, self.snapshot, self.validator):
+                self.logger.warning("History up to the snapshot is valid")
+                self.history_validated = True
+                return True
+        self.logger.error("Could not validate the history up to the snapshot")
+        self.history_validated = False
+        return False
+
+    def start_history_validation(self):
+        if self.snapshot is not None and self.history_validated is None:
+            threading.Thread(None, self.validate_snapshot_history, daemon=True).start()
+
+    def fetch_blocks(self, port: int) -> List[Block]:
+        """The whole chain of the node at port, through ranged app:getblocks messages"""
+        blocks: List[Block] = []
+        while True:
+            conn = socket.create_connection(("localhost", port))
+            try:
+                msg = f"{self.nid}:{self.port} app:getblocks {len(blocks)} {APP_BLOCKS_PER_REQUEST}"
+                send_frame(conn, msg)
+                page = [Block.deserialize(x) for x in json.loads(recv_frame(conn))]
+            finally:
+                conn.close()
+            blocks.extend(page)
+            if len(page) < APP_BLOCKS_PER_REQUEST:
+                return blocks
 
     def on_receive_message(self, message: str, conn):
         try:
@@ -64,18 +346,41 @@ class Node(ConnectionMixin):
                 self.peers[nid] = nport
 
         self.logger.info(f"Message type {msg_type} received with data {data[:20]}...")
+        encoding = ENCODING_JSON
+        if msg_type.endswith(BINARY_MSG_SUFFIX):
+            msg_type = msg_type[:-len(BINARY_MSG_SUFFIX)]
+            encoding = ENCODING_BINARY
+
         if msg_type == "newblock":
-            self.process_new_block(data)
+            self.process_new_block(data, encoding, nid)
         elif msg_type == "newtxn":
-            self.process_new_transaction(data)
+            self.process_new_transaction(data, encoding, nid)
+        elif msg_type == "txns":
+            self.process_transactions(data, encoding, nid)
+        elif msg_type == "inv":
+            self.process_inv(nport, data, nid)
+        elif msg_type == "getdata":
+            self.send_data(nport, data, nid)
+        elif msg_type == "hello":
+            self.process_hello(nport, data, nid)
         elif msg_type == "pay":
             self.process_payment(data)
         elif msg_type == "getpeers":
             self.send_peers(nport, data, nid)
+        elif msg_type == "getheaders":
+            self.send_headers(nport, data, nid)
+        elif msg_type == "headers":
+            self.process_headers(data, encoding, nid)
+        elif msg_type == "getblocks":
+            self.send_blocks(nport, data, nid)
+        elif msg_type == "blocks":
+            self.process_blocks(data, encoding, nid)
         elif msg_type == "app:getblocks":
-            self.send_blocks_to_app(conn)
+            self.send_blocks_to_app(conn, data)
         elif msg_type == "app:getbalance":
             self.send_balance_to_app(conn)
+        elif msg_type == "app:dumpsnapshot":
+            self.send_snapshot_to_app(data.strip(), conn)
         elif msg_type == "peers":
             self.process_peers(data)
 
@@ -87,22 +392,25 @@ class Node(ConnectionMixin):
                 # Every 15 seconds
                 time.sleep(15)
 
-    def send_blocks_to_app(self, conn):
-        blocks = [x.serialize() for x in self.blocks]
-        msg = json.dumps(blocks)
-        ln = len(msg)
-        data = f"{ln}{msg}"
-        conn.send(data.encode())
+    def send_blocks_to_app(self, conn, data: str = ""):
+        """
+        All blocks, or with data "<start> <count>" count blocks from height
+        start. A pruned node only has the last ones.
+        """
+        start, count = 0, len(self.blocks)
+        if data.strip():
+            start, count = [int(x) for x in data.split()]
+        start = max(start, self.full_blocks_start)
+        blocks = [x.serialize() for x in self.blocks[start:start + count]]
+        send_frame(conn, json.dumps(blocks), FRAME_REPLY)
         conn.close()
 
     def send_balance_to_app(self, conn):
-        # Prepend space in the beginning, due to a bug:
-        # The recv_from.. function first reads the size and then receives size amt of data
-        # if size and balance value are appended, it will cause error
-        msg = f" {self.get_balance()}"
-        ln = len(msg)
-        data = f"{ln}{msg}"
-        conn.send(data.encode())
+        send_frame(conn, str(self.get_balance()), FRAME_REPLY)
+        conn.close()
+
+    def send_snapshot_to_app(self, path: str, conn):
+        send_frame(conn, self.dump_snapshot(path).commitment, FRAME_REPLY)
         conn.close()
 
     def send_peers(self, port: int, data: str, peer_id: str):
@@ -110,13 +418,207 @@ class Node(ConnectionMixin):
         msg = f"{self.nid}:{self.port} peers {peersdata}"
         self.send(port, msg, peer_id)
 
-    def send_block(self, port: int, serialized_block: str, peer_id: str):
-        msg = f"{self.nid}:{self.port} newblock {serialized_block}"
+    def send_block(self, port: int, serialized_block: str, peer_id: str, encoding=ENCODING_JSON):
+        suffix = BINARY_MSG_SUFFIX if encoding == ENCODING_BINARY else ""
+        msg = f"{self.nid}:{self.port} newblock{suffix} {serialized_block}"
+        self.send(port, msg, peer_id)
+
+    def send_transactions(self, port: int, txns: List[Transaction], peer_id: str, encoding=ENCODING_JSON):
+        suffix = BINARY_MSG_SUFFIX if encoding == ENCODING_BINARY else ""
+        msg = f"{self.nid}:{self.port} txns{suffix} {encode_transactions(txns, encoding)}"
         self.send(port, msg, peer_id)
 
-    def send_transaction(self, port: int, serialized_txn: str, peer_id: str):
-        msg = f"{self.nid}:{self.port} newtxn {serialized_txn}"
+    def send_hello(self, port: int, peer_id: str):
+        msg = f"{self.nid}:{self.port} hello {','.join(SUPPORTED_ENCODINGS)}"
         self.send(port, msg, peer_id)
+        self.hello_sent.add(peer_id)
+
+    def process_hello(self, port: int, data: str, peer_id: str):
+        theirs = data.strip().split(",")
+        common = [x for x in SUPPORTED_ENCODINGS if x in theirs]
+        self.peer_encodings[peer_id] = common[0] if common else ENCODING_JSON
+        if peer_id not in self.hello_sent:
+            self.send_hello(port, peer_id)
+
+    def get_peer_encoding(self, port: int, peer_id: str) -> str:
+        encoding = self.peer_encodings.get(peer_id)
+        if encoding is None:
+            if peer_id not in self.hello_sent:
+                self.send_hello(port, peer_id)
+            return ENCODING_JSON
+        return encoding
+
+    def send_get_headers(self, port: int, peer_id: str):
+        # Headers already known to self.sync come first, so the peer only
+        # sends the ones following them
+        locator = get_locator(self.blocks, self.chain_start)
+        if self.sync.last_hash is not None:
+            locator.insert(0, self.sync.last_hash)
+        msg = f"{self.nid}:{self.port} getheaders {','.join(locator)}"
+        self.send(port, msg, peer_id)
+
+    def send_headers(self, port: int, data: str, peer_id: str):
+        with self.utxo_lock:
+            height = self.find_on_chain(data.strip().split(","))
+            if height is None:
+                return
+            blocks = self.blocks[height + 1:height + 1 + MAX_HEADERS]
+        items = [(x.hash, x.block_header) for x in blocks]
+        encoding = self.get_peer_encoding(port, peer_id)
+        suffix = BINARY_MSG_SUFFIX if encoding == ENCODING_BINARY else ""
+        msg = f"{self.nid}:{self.port} headers{suffix} {encode_headers(items, encoding)}"
+        self.send(port, msg, peer_id)
+
+    def find_on_chain(self, hashes: List[str]) -> Optional[int]:
+        """Height of the first of hashes that is a block of the active chain"""
+        for block_hash in hashes:
+            entry = self.block_index.get(block_hash)
+            if entry is not None and entry.height < len(self.blocks) and (
+                entry.height >= self.chain_start and self.blocks[entry.height].hash == block_hash
+            ):
+                return entry.height
+        return None
+
+    def get_header(
+        self, block_hash: str, headers: Optional[dict[str, BlockHeader]] = None,
+    ) -> Optional[BlockHeader]:
+        """The header of block_hash, from headers, the ones being synced or the block index"""
+        header = (headers or {}).get(block_hash) or self.sync.headers.get(block_hash)
+        if header is not None:
+            return header
+        with self.utxo_lock:
+            entry = self.block_index.get(block_hash)
+            if entry is None:
+                return None
+            if entry.block is not None:
+                return entry.block.block_header
+            if self.chain_start <= entry.height < len(self.blocks):
+                return self.blocks[entry.height].block_header
+        return None
+
+    def get_expected_target(
+        self, prev_hash: str, headers: Optional[dict[str, BlockHeader]] = None,
+    ) -> Optional[int]:
+        """
+        Target of a block following prev_hash, as calculate_new_difficulty
+        gives for the chain ending at it. headers are ones not in the block
+        index yet, e.g. of the same headers message. None if not enough
+        ancestors are known to tell, e.g. below the snapshot the node started
+        from.
+        """
+        ancestors: List[PrunedBlock] = []
+        block_hash = prev_hash
+        # The oldest one is left out of the retarget, unless it is genesis
+        while len(ancestors) < RETARGET_WINDOW + 2:
+            header = self.get_header(block_hash, headers)
+            if header is None:
+                return None
+            ancestors.append(PrunedBlock(block_hash, header))
+            entry = self.block_index.get(block_hash)
+            if entry is not None and entry.height == 0:
+                break
+            block_hash = header.prev_block_hash
+        return calculate_new_difficulty(ancestors[::-1], self.target_block_interval)
+
+    def check_target(self, header: BlockHeader, headers: Optional[dict[str, BlockHeader]] = None) -> bool:
+        """Whether header has the expected target, when it can be told (see get_expected_target)"""
+        if not self.check_targets:
+            return True
+        expected = self.get_expected_target(header.prev_block_hash, headers)
+        return expected is None or int(header.difficulty_target) == expected
+
+    def process_headers(self, data: str, encoding: str, peer_id: str):
+        try:
+            items = decode_headers(data, encoding)
+        except Exception:
+            self.logger.warning("Unparseable headers received. Ignoring.")
+            return
+        if not items:
+            return
+        pending = dict(items)
+        if not all(self.check_target(header, pending) for _, header in items):
+            self.logger.warning(f"Headers with unexpected targets received from {peer_id}. Ignoring.")
+            return
+        added = self.sync.add_headers(items, self.block_index.__contains__)
+        if added is None:
+            self.logger.warning(f"Invalid headers received from {peer_id}. Ignoring.")
+            return
+        self.logger.info(f"{added} new header(s) from {peer_id}, {len(self.sync)} to download")
+        # A full message means the peer has more, they are asked for once
+        # the download catches up, to bound the headers held in memory
+        self.sync.more_headers_peer = peer_id if len(items) == MAX_HEADERS else None
+        if self.sync.more_headers_peer is not None and len(self.sync) < 2 * MAX_HEADERS:
+            self.send_get_headers(self.peers[peer_id], peer_id)
+        self.request_blocks()
+
+    def request_blocks(self):
+        """Asks peers for the ranges of blocks to download next"""
+        for request in self.sync.next_requests(list(self.peers), time.monotonic()):
+            try:
+                self.send_get_blocks(self.peers[request.peer_id], request.hashes, request.peer_id)
+            except OSError:
+                self.logger.warning(f"Could not ask {request.peer_id} for blocks")
+
+    def send_get_blocks(self, port: int, hashes: List[str], peer_id: str):
+        msg = f"{self.nid}:{self.port} getblocks {hashes[0]} {len(hashes)}"
+        self.send(port, msg, peer_id)
+
+    def send_blocks(self, port: int, data: str, peer_id: str):
+        try:
+            first_hash, countstr = data.strip().split()
+            count = min(int(countstr), BLOCKS_PER_REQUEST)
+        except ValueError:
+            self.logger.error("Could not parse getblocks request")
+            return
+        with self.utxo_lock:
+            height = self.find_on_chain([first_hash])
+            if height is None or height < self.full_blocks_start:
+                blocks = []
+            else:
+                blocks = self.blocks[height:height + count]
+        encoding = self.get_peer_encoding(port, peer_id)
+        suffix = BINARY_MSG_SUFFIX if encoding == ENCODING_BINARY else ""
+        msg = f"{self.nid}:{self.port} blocks{suffix} {first_hash} {encode_blocks(blocks, encoding)}"
+        self.send(port, msg, peer_id)
+
+    def process_blocks(self, data: str, encoding: str, peer_id: str):
+        try:
+            first_hash, payload = data.strip().split(" ", 1)
+            blocks = decode_blocks(payload, encoding)
+        except Exception:
+            self.logger.warning("Unparseable blocks received. Ignoring.")
+            return
+        self.sync.add_blocks(first_hash, blocks)
+        self.connect_synced_blocks()
+        self.request_blocks()
+
+    def connect_synced_blocks(self):
+        """Hands the downloaded blocks that follow known ones to the chain"""
+        with self.utxo_lock:
+            tip = self.blocks[-1].hash
+            for block in self.sync.pop_ready(self.block_index.__contains__):
+                self.accept_block(block)
+            new_tip = self.blocks[-1]
+        if new_tip.hash != tip:
+            self.on_new_tip(new_tip)
+            self.logger.info(f"BLOCK HEIGHT: {len(self.blocks)}\n")
+        peer_id = self.sync.more_headers_peer
+        if peer_id is not None and peer_id in self.peers and len(self.sync) < MAX_HEADERS:
+            self.sync.more_headers_peer = None
+            self.send_get_headers(self.peers[peer_id], peer_id)
+
+    def sync_with_peers(self):
+        while True:
+            for peer_id, port in list(self.peers.items()):
+                try:
+                    self.send_get_headers(port, peer_id)
+                except OSError:
+                    self.logger.warning(f"Could not ask {peer_id} for headers")
+            self.request_blocks()
+            time.sleep(SYNC_INTERVAL)
+
+    def start_sync(self):
+        threading.Thread(None, self.sync_with_peers, daemon=True).start()
 
     def send_get_peers(self, port: int, peer_id: str):
         msg = f"{self.nid}:{self.port} getpeers"
@@ -142,111 +644,415 @@ class Node(ConnectionMixin):
             self.logger.error("Could not parse payment request")
 
     def propagate_block(self, block: Block):
-        if block.hash in self.propagated_blocks:
+        self.seen_blocks.add(block.hash)
+        self.announce(INV_BLOCK, block.hash)
+
+    def propagate_transaction(self, transaction: Transaction):
+        self.seen_txns.add(transaction.txid)
+        self.announce(INV_TXN, transaction.txid)
+
+    def announce(self, kind: str, item_hash: str):
+        """
+        Sends an inv of item_hash to the peers not known to have it, txns
+        are queued to go in batches
+        """
+        for peer_id, port in list(self.peers.items()):
+            known = self.get_peer_inventory(peer_id)
+            if item_hash in known:
+                continue
+            known.add(item_hash)
+            batch = [item_hash] if kind == INV_BLOCK else self.txn_invs.add(peer_id, item_hash)
+            if batch is None:
+                continue
+            try:
+                self.send_inv(port, kind, batch, peer_id)
+            except OSError:
+                # e.g. an app that sent a message, it does not listen for any
+                self.logger.warning(f"Could not announce {kind} to {peer_id}")
+
+    def send_inv(self, port: int, kind: str, hashes: List[str], peer_id: str):
+        self.send(port, f"{self.nid}:{self.port} inv {kind} {','.join(hashes)}", peer_id)
+
+    def flush_txn_invs(self):
+        for peer_id, hashes in self.txn_invs.pop_all().items():
+            port = self.peers.get(peer_id)
+            if port is None:
+                continue
+            try:
+                self.send_inv(port, INV_TXN, hashes, peer_id)
+            except OSError:
+                self.logger.warning(f"Could not announce txns to {peer_id}")
+
+    def relay_transactions(self):
+        while True:
+            time.sleep(self.relay_interval)
+            self.flush_txn_invs()
+            self.retry_requests()
+
+    def start_relay(self):
+        threading.Thread(None, self.relay_transactions, daemon=True).start()
+
+    def get_peer_inventory(self, peer_id: str) -> RecentSet:
+        """Hashes peer_id announced or was sent"""
+        return self.peer_inventory.setdefault(peer_id, RecentSet(MAX_PEER_INVENTORY))
+
+    def has_item(self, kind: str, item_hash: str) -> bool:
+        if kind == INV_BLOCK:
+            # Orphans and invalid blocks are in seen_blocks, synced ones only in the block index
+            return item_hash in self.seen_blocks or item_hash in self.block_index
+        return item_hash in self.seen_txns or item_hash in self.mem_pool or item_hash in self.rejected_txns
+
+    def process_inv(self, port: int, data: str, peer_id: str):
+        """Asks peer_id for the announced items the node does not have and did not just ask for"""
+        try:
+            kind, hashes = data.strip().split(" ")
+        except ValueError:
+            self.logger.error("Could not parse inv")
             return
+        if kind not in (INV_BLOCK, INV_TXN):
+            return
+        known = self.get_peer_inventory(peer_id)
+        now = time.monotonic()
+        wanted = []
+        for item_hash in hashes.split(","):
+            known.add(item_hash)
+            if self.has_item(kind, item_hash):
+                continue
+            request = self.requested.get(item_hash)
+            if request is not None:
+                # Asked to another peer already, this one is next if that one does not send it
+                if peer_id != request.peer_id and peer_id not in request.announcers:
+                    request.announcers.append(peer_id)
+                continue
+            self.requested.add(item_hash, ItemRequest(kind, peer_id, now))
+            wanted.append(item_hash)
+        if wanted:
+            self.send_get_data(port, kind, wanted, peer_id)
 
-        for peer_id, peer_port in self.peers.items():
-            self.send_block(peer_port, block.serialize(), peer_id)
+    def send_get_data(self, port: int, kind: str, hashes: List[str], peer_id: str):
+        self.send(port, f"{self.nid}:{self.port} getdata {kind} {','.join(hashes)}", peer_id)
 
-        with threading.Lock():
-            self.propagated_blocks.append(block.hash)
+    def retry_requests(self):
+        """Asks the next announcer for the items not received within RELAY_REQUEST_TIMEOUT"""
+        now = time.monotonic()
+        retries: dict[tuple[str, str], List[str]] = {}
+        for item_hash, request in self.requested.items():
+            if now - request.requested_at < RELAY_REQUEST_TIMEOUT:
+                continue
+            announcers = [x for x in request.announcers if x in self.peers]
+            if not announcers or self.has_item(request.kind, item_hash):
+                # Given up on, a new inv asks for it again
+                self.requested.discard(item_hash)
+                continue
+            request.peer_id, request.announcers = announcers[0], announcers[1:]
+            request.requested_at = now
+            retries.setdefault((request.peer_id, request.kind), []).append(item_hash)
+        for (peer_id, kind), hashes in retries.items():
+            try:
+                self.send_get_data(self.peers[peer_id], kind, hashes, peer_id)
+            except OSError:
+                self.logger.warning(f"Could not ask {peer_id} for {kind}s")
 
-    def propagate_transaction(self, transaction: Transaction):
-        if transaction.txid in self.propagated_txns:
+    def send_data(self, port: int, data: str, peer_id: str):
+        """Sends the items of a getdata the node has"""
+        try:
+            kind, hashes = data.strip().split(" ")
+        except ValueError:
+            self.logger.error("Could not parse getdata")
             return
+        encoding = self.get_peer_encoding(port, peer_id)
+        if kind == INV_BLOCK:
+            for item_hash in hashes.split(","):
+                block = self.get_block(item_hash)
+                if block is not None:
+                    self.send_block(port, encode_payload(block, encoding), peer_id, encoding)
+        elif kind == INV_TXN:
+            entries = [self.mem_pool.entries.get(x) for x in hashes.split(",")]
+            txns = [x.txn for x in entries if x is not None]
+            for i in range(0, len(txns), self.relay_batch_size):
+                self.send_transactions(port, txns[i:i + self.relay_batch_size], peer_id, encoding)
 
-        for peer_id, port in self.peers.items():
-            self.send_transaction(port, transaction.serialize(), peer_id)
-        with threading.Lock():
-            self.propagated_txns.append(transaction.txid)
+    def get_block(self, block_hash: str) -> Optional[Block]:
+        """The block with block_hash if the node has it in full, on any branch"""
+        with self.utxo_lock:
+            entry = self.block_index.get(block_hash)
+            if entry is None:
+                return None
+            if entry.block is not None:
+                return entry.block
+            height = self.find_on_chain([block_hash])
+            if height is None or height < self.full_blocks_start:
+                return None
+            return self.blocks[height]
 
-    def process_new_transaction(self, txstr: str):
+    def process_new_transaction(self, txstr: str, encoding=ENCODING_JSON, peer_id: Optional[str] = None):
         try:
-            txn = Transaction.deserialize(txstr)
+            txn = decode_transaction(txstr, encoding)
         except Exception:
             self.logger.warning("Unparseable txn received. Ignoring.")
             return
-        is_valid = validate_new_transaction(txn, self.utxo_set)
-        if not is_valid:
-            self.logger.warning("Invalid txn received. Ignoring.")
+        self.accept_transactions([txn], peer_id)
+
+    def process_transactions(self, data: str, encoding: str, peer_id: str):
+        try:
+            txns = decode_transactions(data, encoding)
+        except Exception:
+            self.logger.warning("Unparseable txns received. Ignoring.")
             return
-        # Add to txn pool if not already
-        mempool_ids = [x.txid for x in self.mem_pool]
-        with threading.Lock():
-            if txn.txid not in mempool_ids:
-                self.mem_pool.append(txn)
+        self.accept_transactions(txns, peer_id)
 
-        self.propagate_transaction(txn)
+    def accept_transactions(self, txns: List[Transaction], peer_id: Optional[str] = None):
+        """Validates the new ones of txns in one batch, adds the valid ones to the mempool and relays them"""
+        new = []
+        new_txids = set()
+        for txn in txns:
+            self.requested.discard(txn.txid)
+            if peer_id is not None:
+                self.get_peer_inventory(peer_id).add(txn.txid)
+            if self.has_item(INV_TXN, txn.txid) or txn.txid in new_txids:
+                continue
+            new.append(txn)
+            new_txids.add(txn.txid)
+        if not new:
+            return
+        # A block may be connected meanwhile, so the outputs the txns spend
+        # are looked up under utxo_lock. The script checks then go to the
+        # validation workers, if any, without holding it
+        with self.utxo_lock:
+            outpoints = get_spent_outpoints(new)
+            found = zip(outpoints, self.utxo_set.get_many(outpoints))
+            spent = UtxoSet((x, vout) for x, vout in found if vout is not None)
+        results = self.validator.validate([(x, spent) for x in new])
+        added = []
+        with self.utxo_lock:
+            for txn, is_valid in zip(new, results):
+                if not is_valid:
+                    self.logger.warning("Invalid txn received. Ignoring.")
+                    self.rejected_txns.add(txn.txid)
+                # Add to txn pool, unless it conflicts with one already there
+                # or a block spent its inputs since the checks
+                elif not self.mem_pool.add(txn, self.utxo_set):
+                    self.logger.warning("Txn conflicts with mempool. Ignoring.")
+                    self.rejected_txns.add(txn.txid)
+                else:
+                    self.seen_txns.add(txn.txid)
+                    added.append(txn)
+        if not added:
+            return
+        self.on_mempool_change()
 
-    def process_new_block(self, blockstr: str):
+        for txn in added:
+            self.propagate_transaction(txn)
+
+    def process_new_block(self, blockstr: str, encoding=ENCODING_JSON, peer_id: Optional[str] = None):
         try:
-            block = Block.deserialize(blockstr)
+            block = decode_block(blockstr, encoding)
         except Exception:
             self.logger.warning("Unparseable block received. Ignoring.")
             return
-        is_valid = validate_new_block(block)
-        if not is_valid:
-            self.logger.warning("Invalid block received. Ignoring.")
+        self.requested.discard(block.hash)
+        if peer_id is not None:
+            self.get_peer_inventory(peer_id).add(block.hash)
+        if block.hash in self.block_index or self.is_orphan(block):
             return
-        # Add to blocks if not already
-        # TODO: make this better
-        hashes = [x.hash for x in self.blocks]
-        if block.hash in hashes:
+        self.seen_blocks.add(block.hash)
+        if not block.block_header.check_pow():
+            self.logger.warning("Block with invalid proof of work received. Ignoring.")
             return
+        with self.utxo_lock:
+            tip = self.blocks[-1].hash
+            accepted = self.accept_block(block)
+            new_tip = self.blocks[-1]
+        if accepted:
+            self.sync.forget_known(self.block_index.__contains__)
+        elif peer_id in self.peers and self.is_orphan(block):
+            # Missed some blocks, the peer's headers tell which
+            self.send_get_headers(self.peers[peer_id], peer_id)
 
-        with threading.Lock():
-            self.blocks.append(block)
+        if new_tip.hash != tip:
+            self.on_new_tip(new_tip)
+            self.logger.info(f"BLOCK HEIGHT: {len(self.blocks)}\n")
 
-        self.update_utxo(block)
+        # Blocks of competing branches are relayed too, so that every node
+        # gets to know all branches and they all settle on the same one
+        for block in accepted:
+            self.propagate_block(block)
 
-        self.logger.info(f"BLOCK HEIGHT: {len(self.blocks)}\n")
-        # TODO: check for block forks
+    def is_orphan(self, block: Block) -> bool:
+        siblings = self.orphan_blocks.get(block.block_header.prev_block_hash, [])
+        return any(x.hash == block.hash for x in siblings)
 
-        # propagate valid transaction
-        if block.hash not in self.propagated_blocks:
-            self.propagate_block(block)
+    def accept_block(self, block: Block) -> List[Block]:
+        """
+        Adds block to the block index, along with the orphans waiting for it,
+        and switches to the most work chain. Returns the blocks added to the
+        index that are still valid.
+        """
+        with self.utxo_lock:
+            if not self.check_new_block(block):
+                return []
+            if self.block_index.add(block) is None:
+                self.add_orphan(block)
+                return []
+            added = [block]
+            i = 0
+            while i < len(added):
+                for orphan in self.orphan_blocks.pop(added[i].hash, []):
+                    # Its target could not be told before its parent arrived
+                    if not self.check_new_block(orphan):
+                        continue
+                    self.block_index.add(orphan)
+                    added.append(orphan)
+                i += 1
+            self.activate_best_chain()
+            return [x for x in added if not self.block_index[x.hash].invalid]
 
-    def update_utxo(self, block: Block):
-        consumed_utxos = defaultdict(list)
-        for tx in block.transactions:
-            vins = tx.vin
-            for vin in vins:
-                consumed_utxos[vin.transaction_id].append(vin.vout)
-
-        new_utxo: dict[str, List[VOut]] = {}
-        for txid, vouts in self.utxo_set.items():
-            consumed = consumed_utxos.get(txid)
-            if not consumed:
-                new_utxo[txid] = self.utxo_set[txid]
-            else:
-                consumed_inds = set(consumed)
-                new_vouts = []
-                for vout in vouts:
-                    if vout.n not in consumed_inds:
-                        new_vouts.append(vout)
-                if new_vouts:
-                    new_utxo[txid] = new_vouts
-        # new_utxo now has all the consumed vouts removed
-        # Now add the new utxos from the block
-        for tx in block.transactions:
-            new_utxo[tx.txid] = tx.vout
+    def check_new_block(self, block: Block) -> bool:
+        """
+        The checks of block that do not need its inputs, done before its work
+        is credited in the block index: its merkle root and its target
+        """
+        if not validate_merkle_root(block):
+            self.logger.warning("Block with invalid merkle root received. Ignoring.")
+            # Its header may be the one of a valid block, which is still to be asked for
+            self.seen_blocks.discard(block.hash)
+            return False
+        if not self.check_target(block.block_header):
+            self.logger.warning("Block with unexpected target received. Ignoring.")
+            return False
+        return True
 
-        with threading.Lock():
-            self.utxo_set = new_utxo
+    def add_orphan(self, block: Block):
+        if sum(len(x) for x in self.orphan_blocks.values()) >= MAX_ORPHAN_BLOCKS:
+            self.logger.warning("Too many orphan blocks. Dropping the oldest.")
+            del self.orphan_blocks[next(iter(self.orphan_blocks))]
+        self.orphan_blocks.setdefault(block.block_header.prev_block_hash, []).append(block)
+
+    def activate_best_chain(self):
+        """
+        Makes the most work valid branch the active chain: blocks of the
+        active chain past the fork point are disconnected and those of the
+        branch connected. A branch block failing validation is marked invalid
+        along with its descendants, and the next best branch is tried.
+        """
+        with self.utxo_lock:
+            while True:
+                tip = self.block_index[self.blocks[-1].hash]
+                best = self.block_index.best
+                if best is tip:
+                    return
+                _, disconnect, connect = self.block_index.find_fork(tip, best)
+                if disconnect and disconnect[0].height < self.full_blocks_start:
+                    # Pruned blocks can't be disconnected, so the branch is never switched to
+                    self.logger.warning("Branch forks below the pruned blocks. Ignoring.")
+                    self.block_index.mark_invalid(connect[0])
+                    continue
+                disconnected = [self.disconnect_tip() for _ in disconnect]
+                failed = None
+                for entry in connect:
+                    # Txns in the mempool were validated when they arrived
+                    is_valid = validate_new_block(
+                        entry.block, self.utxo_set, self.validator,
+                        known_valid=self.mem_pool.entries.keys(), height=entry.height,
+                    )
+                    if not is_valid:
+                        failed = entry
+                        break
+                    self.add_block(entry.block)
+                if disconnected:
+                    self.logger.warning(
+                        f"Reorganized {len(disconnected)} block(s) at height {len(self.blocks) - 1}"
+                    )
+                    self.restore_to_mempool(disconnected)
+                if failed is None:
+                    return
+                self.logger.warning("Invalid block received. Ignoring.")
+                self.block_index.mark_invalid(failed)
+
+    def disconnect_tip(self) -> Block:
+        """Removes the last block of the chain, keeping it in the block index"""
+        with self.utxo_lock:
+            block = self.blocks.pop()
+            self.revert_utxo(block)
+            self.block_index[block.hash].block = block
+        return block
+
+    def restore_to_mempool(self, blocks: List[Block]):
+        """Puts txns of disconnected blocks back in the mempool, unless they are in the chain again"""
+        for block in blocks:
+            for txn in block.transactions[1:]:
+                if txn.txid not in self.mem_pool and validate_new_transaction(txn, self.utxo_set):
+                    self.mem_pool.add(txn, self.utxo_set)
+
+    def add_block(self, block: Block):
+        """Append block to the chain and apply it to the utxo set"""
+        with self.utxo_lock:
+            entry = self.block_index.add(block)
+            if entry is not None:
+                entry.block = None  # self.blocks has it
+            self.blocks.append(block)
+            self.update_utxo(block)
+            for txn in block.transactions:
+                self.seen_txns.add(txn.txid)
+            self.rejected_txns.clear()
+            if isinstance(self.blocks, PrunedChain) and self.blocks.pruned:
+                # A pruned block is never disconnected, its undo record is not needed
+                self.block_undo.pop(self.blocks[self.blocks.full_start - 1].hash, None)
+        self.mem_pool.remove_for_block(block.transactions)
+
+    def update_utxo(self, block: Block) -> BlockUndo:
+        with self.utxo_lock:
+            undo = connect_block(self.utxo_set, block)
+            self.block_undo[block.hash] = undo
+            self.commit_storage()
+        return undo
+
+    def revert_utxo(self, block: Block):
+        """Undo update_utxo for block, which must be the last block applied"""
+        with self.utxo_lock:
+            undo = self.block_undo.pop(block.hash)
+            disconnect_block(self.utxo_set, block, undo)
+            self.commit_storage()
+
+    def commit_storage(self):
+        if self.storage is not None:
+            self.storage.commit()
 
     def get_balance(self, *args, **kwargs):
         return 0
 
+    def on_new_tip(self, block: Block):
+        pass
+
+    def on_mempool_change(self):
+        pass
+
+    def run(self):
+        self.start_history_validation()
+        self.start_sync()
+        self.start_relay()
+        super().run()
+
 
 class WalletNode(Node):
     """
     For simplicity wallet node handles just a single address
     """
     type = "wallet"
+    # Small coins spent along with each payment once the wallet has many, see coin_selection
+    consolidate_inputs: int = 0
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, consolidate_inputs=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.keysaddress = KeysAddress.new()
+        if consolidate_inputs is not None:
+            self.consolidate_inputs = consolidate_inputs
+        # Keep the same address across restarts
+        keysaddress = self.storage.load_keys() if self.storage is not None else None
+        if keysaddress is None:
+            keysaddress = KeysAddress.new()
+            if self.storage is not None:
+                self.storage.save_keys(keysaddress)
+        self.keysaddress = keysaddress
         self.logger.warning(f"pkeyhash {self.keysaddress.pub_key_hash}")
 
     @property
@@ -259,11 +1065,16 @@ class WalletNode(Node):
         return get_signature(vout.serialize(), self.keysaddress.priv_key)
 
     def get_balance(self):
-        return get_balance_for(self.keysaddress.pub_key_hash, self.utxo_set)
+        with self.utxo_lock:
+            return self.utxo_set.index.get_balance(self.keysaddress.pub_key_hash)
 
     def pay_to(self, pkeyhash: str, amt_sats: int):
         self.logger.info(f"Received payment request {amt_sats} Sats to {pkeyhash}")
-        inps = get_inputs_for(self.keysaddress.pub_key_hash, amt_sats, self.utxo_set)
+        with self.utxo_lock:
+            coins = self.utxo_set.index.get_coins(self.keysaddress.pub_key_hash)
+        # Coins spent by payments still in the mempool would make a conflicting txn
+        coins = [x for x in coins if (x[0], x[1].n) not in self.mem_pool.spent_outpoints]
+        inps = select_coins(coins, amt_sats, self.consolidate_inputs)
         if not inps:
             self.logger.error(f"Insufficient Funds({amt_sats} sats)!")
             return False
@@ -293,7 +1104,9 @@ class WalletNode(Node):
         txn = Transaction.new(vins, vouts)
 
         # Add to txn pool
-        self.mem_pool.append(txn)
+        if not self.mem_pool.add(txn, self.utxo_set):
+            self.logger.error("Payment conflicts with a txn in mempool")
+            return False
 
         # And then propagate
         self.propagate_transaction(txn)
@@ -302,11 +1115,51 @@ class WalletNode(Node):
 
 class MinerNode(WalletNode):
     type = "miner"
+    mining_workers: int = 1  # Processes used for nonce search
+
+    def __init__(self, *args, mining_workers=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if mining_workers is not None:
+            self.mining_workers = mining_workers
+        self.miner = ParallelMiner(self.mining_workers)
+        # Set when the candidate block is stale: stops the current mining
+        # attempt and wakes up the mining loop
+        self.new_work = threading.Event()
+        self.template_tip: str = ""
+        self.template_mempool_size = 0
+        self.template_tree = MerkleTree()
+
+    def on_new_tip(self, block: Block):
+        if self.template_tip and block.hash != self.template_tip:
+            self.logger.info("New tip received, aborting current mining attempt")
+        self.new_work.set()
+
+    def on_mempool_change(self):
+        if len(self.mem_pool) - self.template_mempool_size >= MEMPOOL_REBUILD_THRESHOLD:
+            self.new_work.set()
+
+    def get_template_merkle_root(self, txns: List[Transaction]) -> str:
+        """
+        Merkle root of the candidate block. The tree from the previous attempt
+        is reused if it still has the same txns after the coinbase, in which
+        case only the coinbase and newly added txns are rehashed.
+        """
+        txids = [x.txid for x in txns]
+        tree = self.template_tree
+        num_prev = len(tree)
+        if not num_prev or num_prev > len(txids) or tree.leaves[1:] != txids[1:num_prev]:
+            self.template_tree = MerkleTree(txids)
+            return self.template_tree.root
+        tree.replace(0, txids[0])
+        for txid in txids[num_prev:]:
+            tree.append(txid)
+        return tree.root
 
     def mine(self):
+        self.new_work.clear()
         last_block = self.blocks[-1]
         last_block_header = last_block.block_header
-        time_since_last_block = int(time.time()) - last_block_header.timestamp
+        time_since_last_block = int(self.clock.time()) - last_block_header.timestamp
 
         # Return if not enough items in mempool and min time before mining
         # has not elapsed
@@ -317,45 +1170,60 @@ class MinerNode(WalletNode):
             return
 
         self.logger.warning(f"TXNS IN MEMPOOL {len(self.mem_pool)}")
-        # TODO: sort by fees
-        txns = self.mem_pool[:MAX_TXNS_PER_BLOCK]
+        txns = self.mem_pool.select(MAX_TXNS_PER_BLOCK)
         # TODO: add fee utxos to all txns
 
         # Create a coinbase txn
         self.logger.info(f"Creating coinbase for {self.keysaddress.pub_key_hash}")
         coinbase = Transaction.create_coinbase(
             self.keysaddress.pub_key_hash,
-            f"Minted by {self.nid} at {time.time()}",
+            f"Minted by {self.nid} at {self.clock.time()}",
             len(self.blocks),
         )
         # Create candidate block
         self.logger.info(f"Started mining block. Difficulty:{last_block.block_header.difficulty_target}")
+        self.template_tip = last_block.hash
+        self.template_mempool_size = len(self.mem_pool)
+        self.miner.reset_stats()
+        block_txns = [coinbase, *txns]
         candidate_block = Block.mine(
             last_block.hash,
-            [coinbase, *txns],
+            block_txns,
             self.blocks,
+            miner=self.miner,
+            abort=self.new_work,
+            merkle_root=self.get_template_merkle_root(block_txns),
+            clock=self.clock,
+            target_interval=self.target_block_interval,
+        )
+        self.template_tip = ""
+        self.logger.warning(
+            f"Hashrate: {self.miner.hashrate:.0f} H/s with {self.miner.workers} worker(s)"
         )
-        for tx in txns:
-            self.logger.warn(f"vout: {tx.vout[0].script_pub_key}")
-        self.update_utxo(candidate_block)
+        with self.utxo_lock:
+            # A competing block may also have been accepted just as we found ours
+            if candidate_block is None or self.blocks[-1].hash != last_block.hash:
+                self.logger.warning("Candidate block is stale. Rebuilding.")
+                return
+            for tx in txns:
+                self.logger.warn(f"vout: {tx.vout[0].script_pub_key}")
+            self.add_block(candidate_block)
 
         self.logger.warning("Minted block. Now propagating.\n")
 
-        self.blocks.append(candidate_block)
         self.propagate_block(candidate_block)
 
-        with threading.Lock():
-            # Update mem_pool remove included txns
-            self.mem_pool = self.mem_pool[MAX_TXNS_PER_BLOCK:]
-
     def run(self):
+        self.start_history_validation()
+        self.start_sync()
+        self.start_relay()
         # Run peer discovery and listener in separate threads
         peer_discovery_thread = threading.Thread(None, self.peer_discovery)
         peer_discovery_thread.start()
 
-        listener_thread = threading.Thread(None, self.listen)
+        listener_thread = threading.Thread(None, self.serve)
         listener_thread.start()
 
         while True:
             self.mine()
-            time.sleep(10)
+            self.new_work.wait(self.clock.to_wall_seconds(MINING_INTERVAL))
@@ -0,0 +1,120 @@
+"""
+Announce-then-fetch relay of blocks and txns.
+
+Instead of pushing a new block or txn to every peer, a node announces its
+hash, and peers that don't have it ask for it:
+
+    inv <kind> <hashes>      comma separated hashes of blocks or txns
+    getdata <kind> <hashes>  the ones of an inv the node does not have
+
+kind is INV_BLOCK or INV_TXN. Blocks asked for are sent as newblock
+messages, txns as txns messages of up to a batch size of them each.
+
+Blocks are announced right away. Txns arrive far more often, so their
+announcements to each peer are queued in InvBatches and go out together,
+every flush interval or as soon as a batch size of them is queued.
+
+A node remembers which hashes each peer knows about (announced to it or
+by it) so it never announces them to that peer again. An item is asked
+from one peer at a time: the other peers announcing it meanwhile are
+recorded in its ItemRequest and asked in turn if it does not arrive
+within RELAY_REQUEST_TIMEOUT. All the sets of hashes are RecentSets,
+bounded to the most recent ones.
+"""
+from typing import Dict, Hashable, List, Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import threading
+
+INV_BLOCK = "block"
+INV_TXN = "txn"
+
+MAX_SEEN_TXNS = 50_000  # txids a node remembers having seen
+MAX_REJECTED_TXNS = 10_000  # txids of invalid txns remembered, until the next block
+MAX_SEEN_BLOCKS = 5_000  # hashes of blocks a node remembers that are not in its block index
+MAX_PEER_INVENTORY = 10_000  # hashes remembered as known by each peer
+MAX_REQUESTED = 10_000  # items asked for and not received yet
+# Seconds after which an item asked for and not received is asked from another peer
+RELAY_REQUEST_TIMEOUT = 10
+TXN_RELAY_INTERVAL = 0.2  # Wall clock seconds between sending the queued txn invs of a peer
+MAX_RELAY_BATCH = 1000  # txids per inv, txns per txns message
+
+
+class RecentSet:
+    """
+    The last maxlen items added, each with an optional value. Adding an
+    item again makes it the most recent one.
+    """
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def __contains__(self, item: Hashable):
+        with self._lock:
+            return item in self._items
+
+    def add(self, item: Hashable, value=None):
+        with self._lock:
+            self._items[item] = value
+            self._items.move_to_end(item)
+            if len(self._items) > self.maxlen:
+                self._items.popitem(last=False)
+
+    def items(self) -> List[Tuple[Hashable, object]]:
+        """A snapshot of the items and their values, oldest first"""
+        with self._lock:
+            return list(self._items.items())
+
+    def get(self, item: Hashable, default=None) -> Optional[object]:
+        with self._lock:
+            return self._items.get(item, default)
+
+    def discard(self, item: Hashable):
+        with self._lock:
+            self._items.pop(item, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+@dataclass
+class ItemRequest:
+    """An item asked for and not received yet"""
+    kind: str
+    peer_id: str  # the peer it was asked from
+    requested_at: float  # time.monotonic() of the getdata
+    # Other peers that announced it, in the order they did
+    announcers: List[str] = field(default_factory=list)
+
+
+class InvBatches:
+    """Hashes waiting to be announced, by peer"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._pending: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(x) for x in self._pending.values())
+
+    def add(self, peer_id: str, item_hash: str) -> Optional[List[str]]:
+        """Queues item_hash for peer_id, returns the batch of peer_id once it is full"""
+        with self._lock:
+            batch = self._pending.setdefault(peer_id, [])
+            batch.append(item_hash)
+            if len(batch) >= self.max_size:
+                return self._pending.pop(peer_id)
+        return None
+
+    def pop_all(self) -> Dict[str, List[str]]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
@@ -1,4 +1,3 @@
-import hashlib
 from fastecdsa import ecdsa, curve
 
 from .utils.common import pubkey_compressed_hash160, pubkey_compressed_to_point
@@ -50,8 +49,7 @@ class Actions:
         rhex, shex = signature.split(":")
         r, s = int(rhex, 16), int(shex, 16)
 
-        msg = vout_txn.serialize()
-        msgdigest = hashlib.sha256(msg.encode("utf-8")).digest()
+        msgdigest = vout_txn.signing_digest
         return ecdsa.verify((r, s), msgdigest, Q, curve.secp256k1), stack
 
     @staticmethod
@@ -0,0 +1,151 @@
+"""
+UTXO snapshots: the UTXO set of a node at its tip, so that a new node can
+follow the chain from there instead of replaying it from genesis.
+
+A snapshot holds the height of the tip, the last blocks up to it (enough to
+retarget the difficulty of the next block), the unspent outputs and a
+commitment hash over the tip hash and the outputs. The commitment is checked
+when a snapshot is loaded, and can be compared with one from a trusted source.
+
+A node started from a snapshot trusts it until it has replayed the history up
+to the tip and got the same commitment, see validate_history.
+"""
+from typing import Iterable, List, Optional, Tuple
+from dataclasses import dataclass
+import hashlib
+
+from .block import Block, get_genesis_block
+from .encoding import ByteReader, DecodeError, read_versioned, versioned, write_bytes, write_varint
+from .utils.block import RETARGET_WINDOW
+from .utxo import OutPoint, UtxoSet, connect_block, pack_outpoint, pack_outputs, read_outputs
+from .transaction import VOut
+from .validation import BatchValidator, validate_new_block
+
+# Blocks kept up to the tip, the retarget looks at this many
+SNAPSHOT_BLOCKS = RETARGET_WINDOW + 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def get_utxo_commitment(tip_hash: str, outputs: Iterable[Tuple[OutPoint, VOut]]) -> str:
+    """Hash of the outputs in outpoint order, so it does not depend on how they are stored"""
+    sha = hashlib.sha256(tip_hash.encode("utf-8"))
+    packed = sorted((pack_outpoint(*outpoint), vout.to_bytes()) for outpoint, vout in outputs)
+    for key, vout in packed:
+        sha.update(key)
+        sha.update(vout)
+    return sha.hexdigest()
+
+
+@dataclass
+class UtxoSnapshot:
+    height: int  # of the tip
+    blocks: List[Block]  # last blocks of the chain, the tip last
+    outputs: List[Tuple[OutPoint, VOut]]
+    commitment: str
+
+    @property
+    def tip_hash(self) -> str:
+        return self.blocks[-1].hash
+
+    @property
+    def start(self) -> int:
+        """Height of the first block kept"""
+        return self.height - len(self.blocks) + 1
+
+    @classmethod
+    def create(cls, blocks, utxos: UtxoSet) -> "UtxoSnapshot":
+        """Snapshot of a chain (a list of blocks from genesis) and its UTXO set"""
+        recent = blocks[max(0, len(blocks) - SNAPSHOT_BLOCKS):]
+        outputs = list(utxos.items())
+        return cls(
+            height=len(blocks) - 1,
+            blocks=recent,
+            outputs=outputs,
+            commitment=get_utxo_commitment(recent[-1].hash, outputs),
+        )
+
+    def check(self):
+        """Raises SnapshotError unless the blocks link up and the commitment matches"""
+        if not self.blocks or self.start < 0:
+            raise SnapshotError("Snapshot has no blocks up to its tip")
+        for prev, block in zip(self.blocks, self.blocks[1:]):
+            if block.block_header.prev_block_hash != prev.hash:
+                raise SnapshotError("Snapshot blocks do not form a chain")
+        if get_utxo_commitment(self.tip_hash, self.outputs) != self.commitment:
+            raise SnapshotError("Snapshot does not match its commitment")
+
+    def serialize_binary(self) -> bytes:
+        return versioned(b"".join([
+            write_varint(self.height),
+            write_varint(len(self.blocks)),
+            *[write_bytes(x.to_bytes()) for x in self.blocks],
+            pack_outputs(self.outputs),
+            bytes.fromhex(self.commitment),
+        ]))
+
+    @classmethod
+    def deserialize_binary(cls, data: bytes) -> "UtxoSnapshot":
+        reader = read_versioned(data)
+        height = reader.read_varint()
+        blocks = [Block.read_from(ByteReader(reader.read_bytes())) for _ in range(reader.read_varint())]
+        snapshot = cls(
+            height=height,
+            blocks=blocks,
+            outputs=read_outputs(reader),
+            commitment=reader.read(32).hex(),
+        )
+        if not reader.at_end():
+            raise DecodeError("Trailing data after snapshot")
+        return snapshot
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.serialize_binary())
+
+    @classmethod
+    def load(cls, path: str, commitment: Optional[str] = None) -> "UtxoSnapshot":
+        """
+        Reads and checks a snapshot. With commitment, e.g. published by a
+        trusted node, the snapshot must have that one.
+        """
+        with open(path, "rb") as f:
+            snapshot = cls.deserialize_binary(f.read())
+        snapshot.check()
+        if commitment is not None and snapshot.commitment != commitment:
+            raise SnapshotError(f"Snapshot commitment {snapshot.commitment} is not {commitment}")
+        return snapshot
+
+
+def validate_history(
+    blocks: Iterable[Block],
+    snapshot: UtxoSnapshot,
+    validator: Optional[BatchValidator] = None,
+) -> bool:
+    """
+    Replays blocks, the chain from genesis, up to the height of snapshot: every
+    block must link to the previous one, have a valid proof of work and valid
+    txns. Then its tip and UTXO set must be the ones of snapshot.
+    """
+    utxos = UtxoSet()
+    prev = None
+    for height, block in enumerate(blocks):
+        if prev is None:
+            if block.hash != get_genesis_block().hash:
+                return False
+        elif (
+            block.block_header.prev_block_hash != prev.hash
+            or not block.block_header.check_pow()
+            or not validate_new_block(block, utxos, validator, height=height)
+        ):
+            return False
+        if height:  # the genesis outputs are not spendable
+            connect_block(utxos, block)
+        if height == snapshot.height:
+            return block.hash == snapshot.tip_hash and get_utxo_commitment(
+                block.hash, utxos.items()
+            ) == snapshot.commitment
+        prev = block
+    return False
@@ -0,0 +1,360 @@
+"""
+On disk storage of a node's chain and UTXO set, under its data_dir:
+
+    blocks.dat          append only block file. Each block is stored as its
+                        binary serialization, preceded by its 4 bytes length
+    chainstate.sqlite   the block index (height -> position in blocks.dat,
+                        with the parent and chain work of each block), undo
+                        records of connected blocks and the UTXO set
+    wallet.key          private key of a wallet node
+
+All of chainstate.sqlite is committed at once after a block is connected, so
+a restarted node carries on from the last committed block without replaying
+the chain, or even reading it to rebuild its block index. Bytes of
+blocks.dat past the last indexed block (from a crash mid write) are cut off
+on open. Blocks of branches competing with the chain are only kept in
+memory, in the node's block index.
+
+The sqlite connection and the block file are opened on first use, so that a
+node can be created in one process and run in another.
+"""
+from typing import Iterable, Iterator, List, Optional, Tuple
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import os
+import sqlite3
+import threading
+
+from .block import Block, get_genesis_block
+from .chain import get_block_work
+from .encoding import U32
+from .keys import KeysAddress
+from .transaction import VOut
+from .utxo import AddressIndex, BlockUndo, OutPoint, TxId, UtxoSet
+
+BLOCK_FILE = "blocks.dat"
+CHAINSTATE_DB = "chainstate.sqlite"
+WALLET_KEY_FILE = "wallet.key"
+
+BLOCK_CACHE_SIZE = 64  # Decoded blocks kept in memory, the tip is read a lot
+# Outpoints per query of get_many, below sqlite's limit of bound parameters
+OUTPOINTS_PER_QUERY = 400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    height INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    offset INTEGER NOT NULL,  -- of the serialized block in blocks.dat
+    size INTEGER NOT NULL,
+    prev_hash TEXT,
+    chain_work TEXT  -- hex, it does not fit a sqlite integer
+);
+CREATE TABLE IF NOT EXISTS undo (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS utxos (
+    txid TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    script TEXT NOT NULL,
+    pkh TEXT,
+    PRIMARY KEY (txid, n)
+);
+CREATE INDEX IF NOT EXISTS utxos_pkh ON utxos (pkh);
+"""
+
+
+class ChainStorage:
+    def __init__(self, data_dir: str, block_cache_size: int = BLOCK_CACHE_SIZE):
+        self.data_dir = data_dir
+        self.block_cache_size = block_cache_size
+        os.makedirs(data_dir, exist_ok=True)
+        self._db: Optional[sqlite3.Connection] = None
+        self._block_file = None
+        self._lock = threading.Lock()
+        self.blocks = StoredBlocks(self)
+        self.utxos = SqliteUtxoSet(self)
+        self.undo = SqliteUndoMap(self)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        self.open()
+        return self._db
+
+    @property
+    def block_file(self):
+        self.open()
+        return self._block_file
+
+    def open(self):
+        """Opens the db and the block file, unless already open"""
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    self._open()
+
+    def _open(self):
+        db = sqlite3.connect(self.path(CHAINSTATE_DB), check_same_thread=False)
+        db.executescript(SCHEMA)
+        columns = {x[1] for x in db.execute("PRAGMA table_info(blocks)")}
+        if "chain_work" not in columns:
+            # Created before the block index was stored, filled in below
+            db.execute("ALTER TABLE blocks ADD COLUMN prev_hash TEXT")
+            db.execute("ALTER TABLE blocks ADD COLUMN chain_work TEXT")
+        row = db.execute("SELECT offset + size FROM blocks ORDER BY height DESC LIMIT 1").fetchone()
+        end = row[0] if row else 0
+        block_file = open(self.path(BLOCK_FILE), "ab+")
+        if os.fstat(block_file.fileno()).st_size > end:
+            block_file.truncate(end)
+        self._block_file = block_file
+        self.blocks.count = db.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+        self._db = db
+        if not self.blocks.count:
+            self.blocks.append(get_genesis_block())
+            self.commit()
+        elif db.execute("SELECT 1 FROM blocks WHERE chain_work IS NULL LIMIT 1").fetchone():
+            self.blocks.fill_index()
+            self.commit()
+
+    def commit(self):
+        self.block_file.flush()
+        os.fsync(self.block_file.fileno())
+        self.db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._block_file.close()
+            self._db = None
+            self._block_file = None
+
+    def load_keys(self) -> Optional[KeysAddress]:
+        try:
+            with open(self.path(WALLET_KEY_FILE)) as f:
+                return KeysAddress.from_priv_key(int(f.read().strip(), 16))
+        except FileNotFoundError:
+            return None
+
+    def save_keys(self, keysaddress: KeysAddress):
+        with open(self.path(WALLET_KEY_FILE), "w") as f:
+            f.write(f"{keysaddress.priv_key:x}")
+
+
+class StoredBlocks:
+    """
+    The chain, read from the block file. Indexes and slices like the list of
+    blocks it replaces; only the last few blocks are kept decoded in memory.
+    """
+
+    def __init__(self, storage: ChainStorage):
+        self.storage = storage
+        self.count = 0  # set when the storage is opened
+        self._cache: OrderedDict[int, Block] = OrderedDict()
+
+    def __len__(self):
+        self.storage.open()
+        return self.count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        height = key + len(self) if key < 0 else key
+        if not 0 <= height < len(self):
+            raise IndexError("block height out of range")
+        block = self._cache.get(height)
+        if block is None:
+            row = self.storage.db.execute(
+                "SELECT offset, size FROM blocks WHERE height = ?", (height,)
+            ).fetchone()
+            block = self._read(*row)
+            self._remember(height, block)
+        return block
+
+    def __iter__(self) -> Iterator[Block]:
+        rows = self.storage.db.execute("SELECT offset, size FROM blocks ORDER BY height").fetchall()
+        for offset, size in rows:
+            yield self._read(offset, size)
+
+    def __contains__(self, block: Block):
+        return self.get_height(block.hash) is not None
+
+    def get_height(self, block_hash: str) -> Optional[int]:
+        row = self.storage.db.execute("SELECT height FROM blocks WHERE hash = ?", (block_hash,)).fetchone()
+        return row[0] if row else None
+
+    def get_index(self) -> List[Tuple[str, str, int, int]]:
+        """(hash, prev_hash, height, chain_work) of every block, lowest first"""
+        rows = self.storage.db.execute(
+            "SELECT hash, prev_hash, height, chain_work FROM blocks ORDER BY height"
+        )
+        return [(x, prev_hash, height, int(work, 16)) for x, prev_hash, height, work in rows]
+
+    def fill_index(self):
+        """Sets prev_hash and chain_work of blocks stored without them, reading the whole chain"""
+        chain_work = 0
+        for height, block in enumerate(self):
+            chain_work += get_block_work(block)
+            self.storage.db.execute(
+                "UPDATE blocks SET prev_hash = ?, chain_work = ? WHERE height = ?",
+                (block.block_header.prev_block_hash, f"{chain_work:x}", height),
+            )
+
+    def append(self, block: Block):
+        height = len(self)
+        chain_work = get_block_work(block)
+        if height:
+            row = self.storage.db.execute("SELECT chain_work FROM blocks WHERE height = ?", (height - 1,))
+            chain_work += int(row.fetchone()[0], 16)
+        data = block.serialize_binary()
+        block_file = self.storage.block_file
+        block_file.seek(0, os.SEEK_END)
+        offset = block_file.tell() + U32.size
+        block_file.write(U32.pack(len(data)) + data)
+        self.storage.db.execute(
+            "INSERT INTO blocks (height, hash, offset, size, prev_hash, chain_work)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (height, block.hash, offset, len(data), block.block_header.prev_block_hash, f"{chain_work:x}"),
+        )
+        self.count += 1
+        self._remember(height, block)
+
+    def pop(self) -> Block:
+        """
+        Removes the last block, e.g. when it is disconnected on a reorg. Its
+        bytes are left in the block file, a later append goes after them.
+        """
+        block = self[-1]
+        height = len(self) - 1
+        self.storage.db.execute("DELETE FROM blocks WHERE height = ?", (height,))
+        self.count -= 1
+        self._cache.pop(height, None)
+        return block
+
+    def _read(self, offset: int, size: int) -> Block:
+        block_file = self.storage.block_file
+        block_file.flush()
+        return Block.deserialize_binary(os.pread(block_file.fileno(), size, offset))
+
+    def _remember(self, height: int, block: Block):
+        self._cache[height] = block
+        self._cache.move_to_end(height)
+        while len(self._cache) > self.storage.block_cache_size:
+            self._cache.popitem(last=False)
+
+
+class SqliteUtxoSet(UtxoSet):
+    """UtxoSet kept in the chainstate db, so it does not need to fit in memory"""
+
+    def __init__(self, storage: ChainStorage):
+        self.storage = storage
+        self.index = SqliteAddressIndex(storage)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self.storage.db
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM utxos").fetchone()[0]
+
+    def __contains__(self, outpoint: OutPoint):
+        return self.get(*outpoint) is not None
+
+    def __iter__(self) -> Iterator[OutPoint]:
+        return iter(self.db.execute("SELECT txid, n FROM utxos").fetchall())
+
+    def items(self) -> Iterable[Tuple[OutPoint, VOut]]:
+        rows = self.db.execute("SELECT txid, n, value, script FROM utxos")
+        return [((txid, n), VOut(n=n, value=value, script_pub_key=script)) for txid, n, value, script in rows]
+
+    def get(self, txid: TxId, n: int) -> Optional[VOut]:
+        row = self.db.execute(
+            "SELECT value, script FROM utxos WHERE txid = ? AND n = ?", (txid, n)
+        ).fetchone()
+        return VOut(n=n, value=row[0], script_pub_key=row[1]) if row else None
+
+    def get_many(self, outpoints: Iterable[OutPoint]) -> List[Optional[VOut]]:
+        outpoints = list(outpoints)
+        found = {}
+        for i in range(0, len(outpoints), OUTPOINTS_PER_QUERY):
+            chunk = outpoints[i:i + OUTPOINTS_PER_QUERY]
+            values = ", ".join(["(?, ?)"] * len(chunk))
+            rows = self.db.execute(
+                f"SELECT txid, n, value, script FROM utxos WHERE (txid, n) IN (VALUES {values})",
+                [x for outpoint in chunk for x in outpoint],
+            )
+            for txid, n, value, script in rows:
+                found[(txid, n)] = VOut(n=n, value=value, script_pub_key=script)
+        return [found.get(x) for x in outpoints]
+
+    def get_coins(self, pkh: str) -> List[Tuple[TxId, VOut]]:
+        return self.index.get_coins(pkh)
+
+    def add(self, txid: TxId, vout: VOut):
+        self.db.execute(
+            "INSERT OR REPLACE INTO utxos (txid, n, value, script, pkh) VALUES (?, ?, ?, ?, ?)",
+            (txid, vout.n, vout.value, vout.script_pub_key, vout.pub_key_hash),
+        )
+
+    def spend(self, txid: TxId, n: int) -> Optional[VOut]:
+        vout = self.get(txid, n)
+        if vout is not None:
+            self.db.execute("DELETE FROM utxos WHERE txid = ? AND n = ?", (txid, n))
+        return vout
+
+
+class SqliteAddressIndex(AddressIndex):
+    """The utxos table is indexed by pkh, so this only needs to query it"""
+
+    def __init__(self, storage: ChainStorage):
+        self.storage = storage
+
+    def _add(self, key: bytes, vout: VOut):
+        pass
+
+    def _remove(self, key: bytes, vout: VOut):
+        pass
+
+    def get_balance(self, pkh: str) -> int:
+        row = self.storage.db.execute("SELECT SUM(value) FROM utxos WHERE pkh = ?", (pkh,)).fetchone()
+        return row[0] or 0
+
+    def get_coins(self, pkh: str) -> List[Tuple[TxId, VOut]]:
+        rows = self.storage.db.execute(
+            "SELECT txid, n, value, script FROM utxos WHERE pkh = ? ORDER BY rowid", (pkh,)
+        )
+        return [(txid, VOut(n=n, value=value, script_pub_key=script)) for txid, n, value, script in rows]
+
+
+class SqliteUndoMap(MutableMapping):
+    """Block hash -> BlockUndo, like the dict nodes keep in memory"""
+
+    def __init__(self, storage: ChainStorage):
+        self.storage = storage
+
+    def __getitem__(self, block_hash: str) -> BlockUndo:
+        row = self.storage.db.execute("SELECT data FROM undo WHERE hash = ?", (block_hash,)).fetchone()
+        if row is None:
+            raise KeyError(block_hash)
+        return BlockUndo.deserialize_binary(row[0])
+
+    def __setitem__(self, block_hash: str, undo: BlockUndo):
+        self.storage.db.execute(
+            "INSERT OR REPLACE INTO undo (hash, data) VALUES (?, ?)",
+            (block_hash, undo.serialize_binary()),
+        )
+
+    def __delitem__(self, block_hash: str):
+        cursor = self.storage.db.execute("DELETE FROM undo WHERE hash = ?", (block_hash,))
+        if not cursor.rowcount:
+            raise KeyError(block_hash)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([x for x, in self.storage.db.execute("SELECT hash FROM undo")])
+
+    def __len__(self):
+        return self.storage.db.execute("SELECT COUNT(*) FROM undo").fetchone()[0]
@@ -0,0 +1,218 @@
+"""
+Headers-first chain sync, so that a node that started late or missed some
+newblock messages catches up with its peers.
+
+A node asks its peers for the headers following the blocks it has, checks
+that they link up and carry valid proof of work, then downloads the blocks in
+ranges from several peers at once. Downloaded blocks are handed to the node
+in chain order, so they never wait in the orphan pool.
+
+Messages (the hash of a block is not part of its header, so headers are sent
+along with the hash of their block):
+
+    getheaders <locator>            comma separated block hashes, newest first
+    headers <payload>               up to MAX_HEADERS (hash, header) following
+                                    the first locator hash on the peer's chain
+    getblocks <first hash> <count>  blocks of the peer's chain from first hash
+    blocks <first hash> <payload>   reply to getblocks, no blocks if the peer
+                                    does not have first hash on its chain
+
+As for blocks and txns, payloads are json or, with :bin, base64 of the binary
+encoding.
+"""
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from collections import deque
+from dataclasses import dataclass, field
+import threading
+
+from .block import Block, BlockHeader
+
+MAX_HEADERS = 500  # per headers message
+BLOCKS_PER_REQUEST = 16
+MAX_REQUESTS_PER_PEER = 2  # ranges in flight from a single peer
+REQUEST_TIMEOUT = 10  # wall clock seconds, after which a range is asked from another peer
+MAX_LOCATOR_HASHES = 32
+
+HeaderItem = Tuple[str, BlockHeader]  # (block hash, header)
+
+
+def get_locator(blocks, first: int = 0) -> List[str]:
+    """
+    Hashes of blocks from the tip back to the block at height first: the last
+    ten, then every 2nd, 4th, 8th... so that the fork point with a peer's chain
+    is found in few hashes however long the chains are.
+    """
+    hashes = []
+    step = 1
+    height = len(blocks) - 1
+    while height > first and len(hashes) < MAX_LOCATOR_HASHES - 1:
+        hashes.append(blocks[height].hash)
+        if len(hashes) >= 10:
+            step *= 2
+        height -= step
+    hashes.append(blocks[first].hash)
+    return hashes
+
+
+@dataclass
+class BlockRequest:
+    hashes: List[str]
+    peer_id: str = ""
+    sent_at: float = 0
+    tried: set = field(default_factory=set)  # peers asked for it so far
+
+
+class HeaderSync:
+    """
+    What a node knows of its peers' chains beyond its own block index: headers
+    whose blocks are not there yet, the ranges of them being downloaded, and
+    the blocks downloaded but not handed to the node yet.
+    """
+
+    def __init__(self):
+        # By block hash, in the order they link up: parents before children
+        self.headers: Dict[str, BlockHeader] = {}
+        self.queue: deque[BlockRequest] = deque()  # ranges to download
+        self.in_flight: Dict[str, BlockRequest] = {}  # by first hash
+        self.downloaded: Dict[str, Block] = {}
+        # Peer whose last headers message was full, so it has more of them
+        self.more_headers_peer: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.headers)
+
+    @property
+    def last_hash(self) -> Optional[str]:
+        return next(reversed(self.headers), None)
+
+    def add_headers(self, items: Sequence[HeaderItem], is_known: Callable[[str], bool]) -> Optional[int]:
+        """
+        Adds the headers of items not known yet, either here or by is_known
+        (e.g. in the block index), and queues the download of their blocks.
+
+        Returns how many were new, None if items do not link up to a known
+        block or a header has invalid proof of work, in which case none is added.
+        """
+        with self._lock:
+            prev = None
+            new = []
+            for block_hash, header in items:
+                parent = header.prev_block_hash
+                if prev is not None and parent != prev:
+                    return None
+                if prev is None and not (is_known(parent) or parent in self.headers):
+                    return None
+                if not header.check_pow():
+                    return None
+                if not is_known(block_hash) and block_hash not in self.headers:
+                    new.append((block_hash, header))
+                prev = block_hash
+            for block_hash, header in new:
+                self.headers[block_hash] = header
+            hashes = [x for x, _ in new]
+            for i in range(0, len(hashes), BLOCKS_PER_REQUEST):
+                self.queue.append(BlockRequest(hashes[i:i + BLOCKS_PER_REQUEST]))
+            return len(new)
+
+    def next_requests(self, peer_ids: Sequence[str], now: float) -> List[BlockRequest]:
+        """
+        Assigns queued ranges to peers with room for more, after putting back
+        in the queue the ranges that timed out. A range goes to a peer that
+        was not asked for it yet, if there is any. Ranges that no peer had are
+        dropped along with the headers following them, the next getheaders
+        will tell whether they are still wanted.
+        """
+        with self._lock:
+            timed_out = [x for x in self.in_flight.values() if now - x.sent_at > REQUEST_TIMEOUT]
+            for request in timed_out:
+                del self.in_flight[request.hashes[0]]
+            # Ahead of the rest, lowest first, as the blocks after them wait for them
+            self.queue.extendleft(reversed(timed_out))
+            load = {x: 0 for x in peer_ids}
+            for request in self.in_flight.values():
+                if request.peer_id in load:
+                    load[request.peer_id] += 1
+            assigned = []
+            for request in list(self.queue):
+                if request not in self.queue:
+                    continue  # dropped along with an earlier range
+                if request.tried and all(x in request.tried for x in peer_ids):
+                    self.queue.remove(request)
+                    self._drop(request.hashes)
+                    continue
+                free = [x for x in peer_ids if load[x] < MAX_REQUESTS_PER_PEER]
+                if not free:
+                    break
+                untried = [x for x in free if x not in request.tried]
+                peer_id = min(untried or free, key=lambda x: load[x])
+                self.queue.remove(request)
+                request.peer_id = peer_id
+                request.sent_at = now
+                request.tried.add(peer_id)
+                load[peer_id] += 1
+                self.in_flight[request.hashes[0]] = request
+                assigned.append(request)
+            return assigned
+
+    def add_blocks(self, first_hash: str, blocks: Sequence[Block]):
+        """
+        Takes the blocks received for the range starting at first_hash. Blocks
+        must match the headers announced for them, the ones of the range
+        missing are queued again.
+        """
+        with self._lock:
+            received = {}
+            for block in blocks:
+                header = self.headers.get(block.hash)
+                if header is not None and header == block.block_header:
+                    received[block.hash] = block
+            request = self.in_flight.pop(first_hash, None)
+            self.downloaded.update(received)
+            if request is not None:
+                missing = [x for x in request.hashes if x not in received and x in self.headers]
+                if missing:
+                    self.queue.appendleft(BlockRequest(missing, tried=request.tried))
+
+    def pop_ready(self, is_known: Callable[[str], bool]) -> List[Block]:
+        """
+        Downloaded blocks whose parent is known, along with the ones following
+        them, in chain order. They are no longer tracked here.
+        """
+        with self._lock:
+            ready = []
+            ready_hashes = set()
+            for block_hash in self.headers:
+                block = self.downloaded.get(block_hash)
+                if block is None:
+                    continue
+                prev = block.block_header.prev_block_hash
+                if prev in ready_hashes or is_known(prev):
+                    ready.append(block)
+                    ready_hashes.add(block_hash)
+            for block_hash in ready_hashes:
+                self._forget(block_hash)
+            return ready
+
+    def forget_known(self, is_known: Callable[[str], bool]):
+        """Drops headers of blocks that got known otherwise, e.g. by a newblock message"""
+        with self._lock:
+            for block_hash in [x for x in self.headers if is_known(x)]:
+                self._forget(block_hash)
+
+    def _drop(self, hashes: Sequence[str]):
+        dropped = set(hashes)
+        for block_hash, header in list(self.headers.items()):
+            if block_hash in dropped or header.prev_block_hash in dropped:
+                dropped.add(block_hash)
+                self._forget(block_hash)
+        for request in list(self.queue):
+            if request.hashes[0] in dropped:
+                self.queue.remove(request)
+
+    def _forget(self, block_hash: str):
+        del self.headers[block_hash]
+        self.downloaded.pop(block_hash, None)
+
+    def is_idle(self) -> bool:
+        return not self.queue and not self.in_flight
@@ -1,20 +1,241 @@
-from typing import List
+from typing import List, Optional, Tuple
 import json
 import hashlib
-from dataclasses import dataclass
+from dataclasses import FrozenInstanceError
 
 from .consts import ScriptOps
+from .encoding import (
+    ByteReader,
+    DecodeError,
+    U32,
+    U64,
+    U32_PAIR,
+    HASH_EMPTY,
+    HASH_RAW,
+    HASH_STR,
+    to_raw_hash,
+    write_varint,
+    write_str,
+    write_hash,
+    versioned,
+    read_versioned,
+)
 
 REWARD_HALF_BLOCKS = 5
 
+# Script encodings in the binary format. Scripts of the known shapes are
+# stored as raw numbers/hashes and rendered back to the exact same strings.
+SCRIPT_RAW = 0
+SCRIPT_P2PKH = 1  # script_pub_key: 20 bytes pubkey hash
+SCRIPT_SIG_P2PKH = 2  # script_sig: 32 bytes r, 32 bytes s, 33 bytes compressed pubkey
+NO_VOUT = 0xFFFFFFFF  # coinbase inputs have vout -1
 
-@dataclass
-class VIn:
-    transaction_id: str  # original 32 bytes tx hash
-    vout: int  # 4 bytes in real
-    script_sig: str
-    sequence: int  # 4 bytes in real, Used for locktime or disabled(0xFFFFFFFF)
-    coinbase: str = ""
+
+def get_block_reward(height: int) -> int:
+    """Satoshis the coinbase of the block at height may create, on top of the fees"""
+    return (50 * 10**8) // (2 ** (height // REWARD_HALF_BLOCKS))
+
+
+def p2pkh_script(pkeyhash: str) -> str:
+    return " ".join(
+        [
+            ScriptOps.OP_DUP,
+            ScriptOps.OP_HASH160,
+            pkeyhash,
+            ScriptOps.OP_EQUALVERIFY,
+            ScriptOps.OP_CHECKSIG,
+        ]
+    )
+
+
+def encode_script_pub_key(script: str) -> bytes:
+    parts = script.split(" ")
+    if len(parts) == 5 and len(parts[2]) == 40:
+        try:
+            pkeyhash = bytes.fromhex(parts[2])
+        except ValueError:
+            pkeyhash = None
+        if pkeyhash is not None and p2pkh_script(pkeyhash.hex()) == script:
+            return bytes([SCRIPT_P2PKH]) + pkeyhash
+    return bytes([SCRIPT_RAW]) + write_str(script)
+
+
+def decode_script_pub_key(reader: ByteReader) -> str:
+    tag = reader.read_byte()
+    if tag == SCRIPT_P2PKH:
+        return p2pkh_script(reader.read(20).hex())
+    if tag == SCRIPT_RAW:
+        return reader.read_str()
+    raise DecodeError(f"Invalid script_pub_key tag {tag}")
+
+
+def read_script_pub_key(reader: ByteReader) -> bytes:
+    """The encoded script_pub_key, as is"""
+    start = reader.pos
+    tag = reader.read_byte()
+    if tag == SCRIPT_P2PKH:
+        reader.read(20)
+    elif tag == SCRIPT_RAW:
+        reader.read_bytes()
+    else:
+        raise DecodeError(f"Invalid script_pub_key tag {tag}")
+    return reader.data[start:reader.pos]
+
+
+def _render_script_sig(r: int, s: int, pubkey: int) -> str:
+    # Same formatting as utils.common.get_signature and KeysAddress.pub_key_hex
+    return f"{r:X}:{s:X} {pubkey:x}"
+
+
+def encode_script_sig(script: str) -> bytes:
+    try:
+        sig, pubkeyhex = script.split(" ")
+        rhex, shex = sig.split(":")
+        r, s, pubkey = int(rhex, 16), int(shex, 16), int(pubkeyhex, 16)
+        if _render_script_sig(r, s, pubkey) == script:
+            return (
+                bytes([SCRIPT_SIG_P2PKH])
+                + r.to_bytes(32, "little")
+                + s.to_bytes(32, "little")
+                + pubkey.to_bytes(33, "little")
+            )
+    except (ValueError, OverflowError):
+        pass
+    return bytes([SCRIPT_RAW]) + write_str(script)
+
+
+def decode_script_sig(reader: ByteReader) -> str:
+    tag = reader.read_byte()
+    if tag == SCRIPT_SIG_P2PKH:
+        raw = reader.read(97)
+        r = int.from_bytes(raw[:32], "little")
+        s = int.from_bytes(raw[32:64], "little")
+        pubkey = int.from_bytes(raw[64:], "little")
+        return _render_script_sig(r, s, pubkey)
+    if tag == SCRIPT_RAW:
+        return reader.read_str()
+    raise DecodeError(f"Invalid script_sig tag {tag}")
+
+
+def read_script_sig(reader: ByteReader) -> bytes:
+    """The encoded script_sig, as is"""
+    start = reader.pos
+    tag = reader.read_byte()
+    if tag == SCRIPT_SIG_P2PKH:
+        reader.read(97)
+    elif tag == SCRIPT_RAW:
+        reader.read_bytes()
+    else:
+        raise DecodeError(f"Invalid script_sig tag {tag}")
+    return reader.data[start:reader.pos]
+
+
+def compact_hash(data: str) -> bytes | str:
+    """Raw 32 bytes for a hex hash, anything else stays as it is"""
+    raw = to_raw_hash(data)
+    return data if raw is None else raw
+
+
+def expand_hash(data: bytes | str) -> str:
+    return data.hex() if isinstance(data, bytes) else data
+
+
+def pack_hash(data: bytes | str) -> bytes:
+    """write_hash of a compact_hash"""
+    if isinstance(data, bytes):
+        return bytes([HASH_RAW]) + data
+    return write_hash(data)
+
+
+def read_compact_hash(reader: ByteReader) -> bytes | str:
+    tag = reader.read_byte()
+    if tag == HASH_RAW:
+        return reader.read(32)
+    if tag == HASH_EMPTY:
+        return ""
+    if tag == HASH_STR:
+        return reader.read_str()
+    raise DecodeError(f"Invalid hash tag {tag}")
+
+
+# Txns and their parts are immutable value objects with __slots__. They keep
+# hashes as raw bytes and scripts in their binary encoding (a template tag
+# plus its payload, see encode_script_pub_key/encode_script_sig), which makes
+# large UTXO sets and mempools several times smaller. The string forms are
+# rendered only when asked for.
+
+
+class _Compact:
+    __slots__ = ()
+    _fields: Tuple[str, ...] = ()  # the slots making up the value
+
+    @classmethod
+    def _make(cls, *values):
+        obj = cls.__new__(cls)
+        for name, value in zip(cls._fields, values):
+            object.__setattr__(obj, name, value)
+        return obj
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, x) for x in self._fields)
+
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __reduce__(self):
+        return (self.__class__._make, self._values())
+
+
+class VIn(_Compact):
+    __slots__ = ("_transaction_id", "vout", "_script_sig", "sequence", "coinbase", "_serialized")
+    _fields = ("_transaction_id", "vout", "_script_sig", "sequence", "coinbase")
+
+    def __init__(
+        self,
+        transaction_id: str,  # original 32 bytes tx hash
+        vout: int,  # 4 bytes in real
+        script_sig: str,
+        sequence: int,  # 4 bytes in real, Used for locktime or disabled(0xFFFFFFFF)
+        coinbase: str = "",
+    ):
+        set_ = object.__setattr__
+        set_(self, "_transaction_id", compact_hash(transaction_id))
+        set_(self, "vout", vout)
+        set_(self, "_script_sig", encode_script_sig(script_sig))
+        set_(self, "sequence", sequence)
+        set_(self, "coinbase", coinbase)
+        set_(self, "_serialized", None)
+
+    @classmethod
+    def _make(cls, *values):
+        obj = super()._make(*values)
+        object.__setattr__(obj, "_serialized", None)
+        return obj
+
+    @property
+    def transaction_id(self) -> str:
+        return expand_hash(self._transaction_id)
+
+    @property
+    def script_sig(self) -> str:
+        return decode_script_sig(ByteReader(self._script_sig))
+
+    def __repr__(self):
+        return (
+            f"VIn(transaction_id={self.transaction_id!r}, vout={self.vout!r}, "
+            f"script_sig={self.script_sig!r}, sequence={self.sequence!r}, coinbase={self.coinbase!r})"
+        )
 
     @classmethod
     def get_coinbase_input(cls, data: str, sequence: int):
@@ -28,14 +249,16 @@ class VIn:
         )
 
     def serialize(self) -> str:
-        listed = [
-            self.transaction_id,
-            self.vout,
-            self.script_sig,
-            self.sequence,
-            self.coinbase,
-        ]
-        return json.dumps(listed)
+        if self._serialized is None:
+            listed = [
+                self.transaction_id,
+                self.vout,
+                self.script_sig,
+                self.sequence,
+                self.coinbase,
+            ]
+            object.__setattr__(self, "_serialized", json.dumps(listed))
+        return self._serialized
 
     def to_json(self):
         return {
@@ -57,38 +280,99 @@ class VIn:
             coinbase=listed[4],
         )
 
+    def to_bytes(self) -> bytes:
+        return b"".join([
+            pack_hash(self._transaction_id),
+            U32.pack(NO_VOUT if self.vout == -1 else self.vout),
+            self._script_sig,
+            U32.pack(self.sequence),
+            write_str(self.coinbase),
+        ])
+
+    @classmethod
+    def read_from(cls, reader: ByteReader):
+        transaction_id = read_compact_hash(reader)
+        vout = reader.read_u32()
+        return cls._make(
+            transaction_id,
+            -1 if vout == NO_VOUT else vout,
+            read_script_sig(reader),
+            reader.read_u32(),
+            reader.read_str(),
+        )
+
+
+class VOut(_Compact):
+    # Computed on first use, the digest is needed for every signature check
+    # of a spender. The pubkey hash is not cached: it is cheap to get from
+    # the script bytes, and a copy for every output in the UTXO set isn't
+    __slots__ = ("n", "value", "_script_pub_key", "_serialized", "_digest")
+    _fields = ("n", "value", "_script_pub_key")
+
+    def __init__(
+        self,
+        n: int,
+        value: int,  # Satoshis, 8 bytes original, little endian
+        script_pub_key: str,
+    ):
+        set_ = object.__setattr__
+        set_(self, "n", n)
+        set_(self, "value", value)
+        set_(self, "_script_pub_key", encode_script_pub_key(script_pub_key))
+        set_(self, "_serialized", None)
+        set_(self, "_digest", None)
+
+    @classmethod
+    def _make(cls, *values):
+        obj = super()._make(*values)
+        object.__setattr__(obj, "_serialized", None)
+        object.__setattr__(obj, "_digest", None)
+        return obj
+
+    @property
+    def script_pub_key(self) -> str:
+        return decode_script_pub_key(ByteReader(self._script_pub_key))
 
-@dataclass
-class VOut:
-    n: int
-    value: int  # Satoshis, 8 bytes original, little endian
-    script_pub_key: str
+    def __repr__(self):
+        return f"VOut(n={self.n!r}, value={self.value!r}, script_pub_key={self.script_pub_key!r})"
 
     @classmethod
     def get_for_p2pkh(cls, pkeyhash: str, value: int, ind: int):
-        locking_script = " ".join(
-            [
-                ScriptOps.OP_DUP,
-                ScriptOps.OP_HASH160,
-                pkeyhash,
-                ScriptOps.OP_EQUALVERIFY,
-                ScriptOps.OP_CHECKSIG,
-            ]
-        )
         return cls(
             n=ind,
             value=value,
-            script_pub_key=locking_script,
+            script_pub_key=p2pkh_script(pkeyhash),
         )
 
-    def serialize(self):
-        return json.dumps(
-            [
-                self.n,
-                self.value,
-                self.script_pub_key,
-            ]
-        )
+    def serialize(self) -> str:
+        if self._serialized is None:
+            serialized = json.dumps(
+                [
+                    self.n,
+                    self.value,
+                    self.script_pub_key,
+                ]
+            )
+            object.__setattr__(self, "_serialized", serialized)
+        return self._serialized
+
+    @property
+    def script_bytes(self) -> bytes:
+        """The binary encoding of script_pub_key, see encode_script_pub_key"""
+        return self._script_pub_key
+
+    @property
+    def pub_key_hash(self) -> Optional[str]:
+        """The pubkey hash a p2pkh script pays to, None for other scripts"""
+        script = self._script_pub_key
+        return script[1:].hex() if script[0] == SCRIPT_P2PKH else None
+
+    @property
+    def signing_digest(self) -> bytes:
+        """sha256 of the serialized vout, which is what spenders sign"""
+        if self._digest is None:
+            object.__setattr__(self, "_digest", hashlib.sha256(self.serialize().encode("utf-8")).digest())
+        return self._digest
 
     def to_json(self):
         return {
@@ -106,19 +390,66 @@ class VOut:
             script_pub_key=listed[2],
         )
 
+    def to_bytes(self) -> bytes:
+        return b"".join([
+            write_varint(self.n),
+            U64.pack(self.value),
+            self._script_pub_key,
+        ])
+
+    @classmethod
+    def read_from(cls, reader: ByteReader):
+        return cls._make(
+            reader.read_varint(),
+            reader.read_u64(),
+            read_script_pub_key(reader),
+        )
+
 
-@dataclass
-class Transaction:
-    version: int
-    locktime: int
-    vin: List[VIn]
-    vout: List[VOut]
-    txid: str = ""
+class Transaction(_Compact):
+    # The serialized forms are cached, they are needed over and over while
+    # the txn is relayed, validated and mined
+    __slots__ = ("version", "locktime", "vin", "vout", "_txid", "_serialized", "_packed")
+    _fields = ("version", "locktime", "vin", "vout", "_txid")
+
+    def __init__(
+        self,
+        version: int,
+        locktime: int,
+        vin: Tuple[VIn, ...],
+        vout: Tuple[VOut, ...],
+        txid: str = "",
+    ):
+        set_ = object.__setattr__
+        set_(self, "version", version)
+        set_(self, "locktime", locktime)
+        set_(self, "vin", vin)
+        set_(self, "vout", vout)
+        set_(self, "_txid", compact_hash(txid))
+        set_(self, "_serialized", None)
+        set_(self, "_packed", None)
+
+    @classmethod
+    def _make(cls, *values):
+        obj = super()._make(*values)
+        object.__setattr__(obj, "_serialized", None)
+        object.__setattr__(obj, "_packed", None)
+        return obj
+
+    @property
+    def txid(self) -> str:
+        return expand_hash(self._txid)
+
+    def __repr__(self):
+        return (
+            f"Transaction(version={self.version!r}, locktime={self.locktime!r}, "
+            f"vin={self.vin!r}, vout={self.vout!r}, txid={self.txid!r})"
+        )
 
     @classmethod
     def create_coinbase(cls, dest_pubkeyhash: str, coinbase_message: str, blockheight: int):
-        # Block reward halves every 20 blocks
-        coinbase_value = (50 * 10**8) / (2 **(blockheight // REWARD_HALF_BLOCKS))  # in satoshis
+        # Block reward halves every REWARD_HALF_BLOCKS blocks
+        coinbase_value = get_block_reward(blockheight)  # in satoshis
         return cls.new(
             vin=[VIn.get_coinbase_input(coinbase_message, 1)],
             vout=[VOut.get_for_p2pkh(dest_pubkeyhash, coinbase_value, ind=0)],
@@ -126,29 +457,42 @@ class Transaction:
 
     @classmethod
     def new(cls, vin: List[VIn], vout: List[VOut], version=1, locktime=0):
-        # Create hash
-        instance = cls(
+        # Create hash, over the serialization with empty txid
+        unhashed = cls(
             version=version,
             locktime=locktime,
-            vin=vin,
-            vout=vout,
+            vin=tuple(vin),
+            vout=tuple(vout),
         )
-        selfstr = instance.serialize()
+        selfstr = unhashed.serialize()
         selfid = hashlib.sha256(selfstr.encode("utf8")).hexdigest()
-        instance.txid = selfid
-        return instance
-
-    def serialize(self):
-        return json.dumps(
-            [
-                self.txid,
-                self.version,
-                self.locktime,
-                [x.serialize() for x in self.vin],
-                [x.serialize() for x in self.vout],
-            ]
+        return cls(
+            version=version,
+            locktime=locktime,
+            vin=unhashed.vin,
+            vout=unhashed.vout,
+            txid=selfid,
         )
 
+    def serialize(self) -> str:
+        if self._serialized is None:
+            serialized = json.dumps(
+                [
+                    self.txid,
+                    self.version,
+                    self.locktime,
+                    [x.serialize() for x in self.vin],
+                    [x.serialize() for x in self.vout],
+                ]
+            )
+            object.__setattr__(self, "_serialized", serialized)
+        return self._serialized
+
+    @property
+    def size(self) -> int:
+        """Size in bytes of the serialized txn"""
+        return len(self.serialize())
+
     def to_json(self):
         return {
             "txid": self.txid,
@@ -165,6 +509,40 @@ class Transaction:
             txid=txid,
             version=int(ver),
             locktime=int(lck),
-            vin=[VIn.deserialize(x) for x in vins],
-            vout=[VOut.deserialize(x) for x in vouts],
+            vin=tuple(VIn.deserialize(x) for x in vins),
+            vout=tuple(VOut.deserialize(x) for x in vouts),
         )
+
+    def to_bytes(self) -> bytes:
+        if self._packed is None:
+            packed = b"".join([
+                pack_hash(self._txid),
+                U32.pack(self.version),
+                U32.pack(self.locktime),
+                write_varint(len(self.vin)),
+                *[x.to_bytes() for x in self.vin],
+                write_varint(len(self.vout)),
+                *[x.to_bytes() for x in self.vout],
+            ])
+            object.__setattr__(self, "_packed", packed)
+        return self._packed
+
+    @classmethod
+    def read_from(cls, reader: ByteReader):
+        txid = read_compact_hash(reader)
+        version, locktime = reader.unpack(U32_PAIR)
+        vin = tuple(VIn.read_from(reader) for _ in range(reader.read_varint()))
+        vout = tuple(VOut.read_from(reader) for _ in range(reader.read_varint()))
+        return cls._make(version, locktime, vin, vout, txid)
+
+    def serialize_binary(self) -> bytes:
+        """Compact binary form for the wire, see encoding.py"""
+        return versioned(self.to_bytes())
+
+    @classmethod
+    def deserialize_binary(cls, data: bytes):
+        reader = read_versioned(data)
+        txn = cls.read_from(reader)
+        if not reader.at_end():
+            raise DecodeError("Trailing data after transaction")
+        return txn
@@ -1,42 +1,37 @@
 from typing import List, Optional
 import hashlib
+import struct
 
 from bitcoin_rollup_sim.transaction import Transaction
-from bitcoin_rollup_sim.utils.common import chunk_list
+from bitcoin_rollup_sim.merkle import MerkleTree, hash_pair
 
 
 def get_merkle_root(txs: List[Transaction]):
     assert len(txs) != 0
-    txids = [x.txid for x in txs]
-    if len(txids) % 2 == 1:
-        txids.append(txids[-1])
-
-    # The first call should have more than 1 items or else it will just return
-    return create_merkle_root(txids)
+    return MerkleTree([x.txid for x in txs]).root
 
 
 def create_merkle_root(items: List[str]) -> str:
-    if len(items) == 1:  # means this is the root
-        return items[0]
-    if len(items) % 2 == 1:  # make even
-        items.append(items[-1])
+    while len(items) > 1:
+        items = [
+            hash_pair(items[i], items[i + 1] if i + 1 < len(items) else items[i])
+            for i in range(0, len(items), 2)
+        ]
+    return items[0]
+
 
-    pairs = chunk_list(items, 2)
-    pair_hashes = [
-        hashlib.sha256((x+y).encode('utf-8')).hexdigest()
-        for x, y in pairs
-    ]
-    return create_merkle_root(pair_hashes)
+NONCE_SPACE = 10**6
+NONCE_FORMAT = struct.Struct("<I")
 
 
-def get_nonce_for(inp: str, difficulty: int) -> Optional[int]:
+def get_nonce_for(inp: str, difficulty: int, end: int = NONCE_SPACE) -> Optional[int]:
     """
     inp: formatted str. use inp.format(nonce)
     NOTE: unlike in real(bitcion), here the difficulty keeps decreasing.
     We need to find nonce which makes the hash greater than the
     difficulty(unlike smaller in bitcion).
     """
-    for x in range(0, 10**6):
+    for x in range(0, end):
         to_hash = inp.format(x)
         sha = hashlib.sha256(to_hash.encode('utf8')).hexdigest()
         shaval = int(sha, 16)
@@ -45,6 +40,84 @@ def get_nonce_for(inp: str, difficulty: int) -> Optional[int]:
     return None
 
 
-def calculate_new_difficulty(blocks: list):
-    # TODO: make actual calculation
-    return int(blocks[-1].block_header.difficulty_target/1.000002)
+def get_nonce_for_prefix(
+    prefix: bytes,
+    difficulty: int,
+    start: int = 0,
+    end: int = NONCE_SPACE,
+) -> Optional[int]:
+    """
+    prefix: packed header without the nonce(BlockHeader.pack_without_nonce).
+    The prefix is hashed once and the hash state copied for every nonce, and
+    digests are compared with the target as big endian bytes, so there is no
+    hex/int conversion per attempt.
+    """
+    base = hashlib.sha256(prefix)
+    target = difficulty.to_bytes(32, 'big')
+    pack_nonce = NONCE_FORMAT.pack
+    for x in range(start, end):
+        sha = base.copy()
+        sha.update(pack_nonce(x))
+        if sha.digest() < target:
+            return x
+    return None
+
+
+def target_to_bits(target: int) -> int:
+    """
+    Compact 4 bytes representation of target as in bitcoin's nBits: 1 byte
+    exponent followed by 3 bytes mantissa. Precision beyond the mantissa is
+    truncated.
+    """
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    if mantissa & 0x800000:  # high bit is the sign bit in bitcoin, avoid it
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+
+def bits_to_target(bits: int) -> int:
+    size = bits >> 24
+    mantissa = bits & 0x7FFFFF
+    if size <= 3:
+        return mantissa >> (8 * (3 - size))
+    return mantissa << (8 * (size - 3))
+
+
+TARGET_BLOCK_INTERVAL = 30  # Seconds, of the simulation clock
+RETARGET_WINDOW = 10  # Number of latest block intervals the retarget looks at
+MAX_TARGET = 2**248  # Easiest allowed target
+
+
+def calculate_new_difficulty(
+    blocks: list,
+    target_interval: int = TARGET_BLOCK_INTERVAL,
+    window: int = RETARGET_WINDOW,
+):
+    """
+    Target for the block following blocks. Uses the average target of the
+    last `window` blocks, scaled by how long they actually took against
+    target_interval per block. The measured timespan is clamped to half/double
+    of the expected one, so that a few odd timestamps cannot swing it much.
+
+    The genesis block is left out, its timestamp has nothing to do with when
+    the simulation started.
+    """
+    last_target = int(blocks[-1].block_header.difficulty_target)
+    recent = blocks[max(1, len(blocks) - (window + 1)):]
+    num_intervals = len(recent) - 1
+    if num_intervals < 1:
+        return last_target
+
+    avg_target = sum(int(x.block_header.difficulty_target) for x in recent[1:]) // num_intervals
+    expected = target_interval * num_intervals
+    actual = recent[-1].block_header.timestamp - recent[0].block_header.timestamp
+    actual = min(max(actual, expected // 2), expected * 2)
+
+    target = min(max(avg_target * actual // max(expected, 1), 1), MAX_TARGET)
+    # Keep only what fits in the header's compact bits
+    return bits_to_target(target_to_bits(target))
@@ -1,5 +1,6 @@
-from typing import List
+from typing import List, Optional, Tuple
 import hashlib
+import struct
 from fastecdsa import ecdsa, curve, point
 
 
@@ -52,20 +53,68 @@ def pubkey_compressed_to_point(pubkey_compressed: int):
     return point.Point(X, Y, curve.secp256k1)
 
 
-def recv_from_sock(conn):
+# Messages travel in frames: a header with the size of the payload and the
+# type of frame, then the payload (utf-8 text)
+FRAME_HEADER = struct.Struct(">IB")
+FRAME_MESSAGE = 0  # a message to a node, "<nid>:<port> <type> <data>"
+FRAME_REPLY = 1  # a node's reply to an app:* message
+MAX_FRAME_SIZE = 256 * 1024 * 1024  # bigger frames are taken as garbage
+RECV_SIZE = 64 * 1024  # bytes asked for per recv
+
+
+def pack_frame(data: str, frame_type: int = FRAME_MESSAGE) -> bytes:
+    payload = data.encode("utf-8")
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+
+def send_frame(conn, data: str, frame_type: int = FRAME_MESSAGE):
+    conn.sendall(pack_frame(data, frame_type))
+
+
+class FrameReader:
+    """
+    Reads frames from a socket, RECV_SIZE bytes at a time: a recv may bring
+    several small frames, or a part of a big one.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = bytearray()
+
+    def feed(self) -> bool:
+        """Receives what is there to read, False if the connection was closed"""
+        data = self.conn.recv(RECV_SIZE)
+        self.buffer += data
+        return bool(data)
+
+    def next_frame(self) -> Optional[Tuple[int, str]]:
+        """The first complete frame in the buffer, as (frame type, payload), None if there is none yet"""
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+        size, frame_type = FRAME_HEADER.unpack_from(self.buffer)
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {size} bytes is too big")
+        end = FRAME_HEADER.size + size
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[FRAME_HEADER.size:end])
+        del self.buffer[:end]
+        return frame_type, payload.decode("utf-8")
+
+    def read_frame(self) -> Tuple[int, str]:
+        """Blocks until a whole frame is read"""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not self.feed():
+                raise ConnectionError("Connection closed")
+
+
+def recv_frame(conn) -> str:
     """
-    NOTE: this functions waits indefinitely if the data sent is all numbers
-    So if you need to send data, make sure the data starts with non number
+    Payload of the next frame on conn, e.g. the reply of a node to an app
+    message. Anything received after it is dropped.
     """
-    ln = ""
-    data = ""
-    while True:
-        d = conn.recv(1).decode()
-        if d in "1234567890":
-            ln += d
-        else:
-            data += d
-            break
-    size = int(ln)
-    data += conn.recv(size).decode()
+    _, data = FrameReader(conn).read_frame()
     return data
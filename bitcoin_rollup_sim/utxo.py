@@ -0,0 +1,259 @@
+"""
+The UTXO set, and its in place updates when connecting and disconnecting
+blocks.
+
+Connecting a block records what it changed in a BlockUndo, so that the block
+can later be disconnected (e.g. on a reorg) without replaying the chain. Both
+cost time proportional to the block's txns, not to the size of the UTXO set.
+"""
+from typing import Iterable, Iterator, List, Optional, Tuple, TypeAlias
+from dataclasses import dataclass, field
+
+from .block import Block
+from .encoding import (
+    U32, ByteReader, DecodeError, read_versioned, versioned, write_hash, write_varint,
+)
+from .transaction import NO_VOUT, Transaction, VOut, encode_script_pub_key, p2pkh_script
+
+TxId: TypeAlias = str
+OutPoint: TypeAlias = Tuple[TxId, int]  # (txid, index of the output)
+
+
+@dataclass
+class BlockUndo:
+    # For each txn of the block, in order: the outputs its inputs spent
+    spent: List[List[Tuple[OutPoint, VOut]]] = field(default_factory=list)
+    # Outputs that were overwritten by a block txn with the same txid
+    replaced: List[Tuple[OutPoint, VOut]] = field(default_factory=list)
+
+    def serialize_binary(self) -> bytes:
+        parts = [write_varint(len(self.spent))]
+        for spent in self.spent:
+            parts.append(pack_outputs(spent))
+        parts.append(pack_outputs(self.replaced))
+        return versioned(b"".join(parts))
+
+    @classmethod
+    def deserialize_binary(cls, data: bytes) -> "BlockUndo":
+        reader = read_versioned(data)
+        spent = [read_outputs(reader) for _ in range(reader.read_varint())]
+        undo = cls(spent=spent, replaced=read_outputs(reader))
+        if not reader.at_end():
+            raise DecodeError("Trailing data after undo record")
+        return undo
+
+
+def pack_outputs(outputs: List[Tuple[OutPoint, VOut]]) -> bytes:
+    # The output index is already part of the vout
+    return write_varint(len(outputs)) + b"".join(
+        write_hash(txid) + vout.to_bytes() for (txid, _), vout in outputs
+    )
+
+
+def read_outputs(reader: ByteReader) -> List[Tuple[OutPoint, VOut]]:
+    outputs = []
+    for _ in range(reader.read_varint()):
+        txid = reader.read_hash()
+        vout = VOut.read_from(reader)
+        outputs.append(((txid, vout.n), vout))
+    return outputs
+
+
+class AddressIndex:
+    """
+    Pubkey hash -> the unspent outputs paying to it, along with its balance,
+    so that wallet queries cost O(coins owned) rather than O(UTXO set).
+    Outputs that are not p2pkh are not indexed.
+    """
+
+    def __init__(self):
+        self.coins: dict[str, dict[bytes, VOut]] = {}  # by packed outpoint
+        self.balances: dict[str, int] = {}
+
+    @classmethod
+    def from_utxos(cls, utxos: "UtxoSet") -> "AddressIndex":
+        index = cls()
+        for (txid, _), vout in utxos.items():
+            index.add(txid, vout)
+        return index
+
+    def add(self, txid: TxId, vout: VOut):
+        self._add(pack_outpoint(txid, vout.n), vout)
+
+    def remove(self, txid: TxId, vout: VOut):
+        self._remove(pack_outpoint(txid, vout.n), vout)
+
+    def _add(self, key: bytes, vout: VOut):
+        pkh = vout.pub_key_hash
+        if pkh is None:
+            return
+        coins = self.coins.setdefault(pkh, {})
+        if key in coins:
+            return
+        coins[key] = vout
+        self.balances[pkh] = self.balances.get(pkh, 0) + vout.value
+
+    def _remove(self, key: bytes, vout: VOut):
+        pkh = vout.pub_key_hash
+        coins = self.coins.get(pkh)
+        if coins is None or coins.pop(key, None) is None:
+            return
+        if coins:
+            self.balances[pkh] -= vout.value
+        else:
+            del self.coins[pkh]
+            del self.balances[pkh]
+
+    def get_balance(self, pkh: str) -> int:
+        return self.balances.get(pkh, 0)
+
+    def get_coins(self, pkh: str) -> List[Tuple[TxId, VOut]]:
+        """Outputs pkh can spend, oldest first"""
+        return [(unpack_outpoint(x)[0], vout) for x, vout in self.coins.get(pkh, {}).items()]
+
+    def get_inputs_for(self, pkh: str, amt_sats: int) -> List[Tuple[TxId, VOut]]:
+        """
+        Like utils.node.get_inputs_for: the oldest coins of pkh adding up to at
+        least amt_sats, or an empty list if its balance is not enough.
+        """
+        if self.get_balance(pkh) < amt_sats:
+            return []
+        total = 0
+        items = []
+        for txid, vout in self.get_coins(pkh):
+            total += vout.value
+            items.append((txid, vout))
+            if total >= amt_sats:
+                break
+        return items
+
+
+class UtxoSet:
+    """
+    Unspent outputs keyed by outpoint. Lookups, spends and adds are O(1).
+
+    Outpoints are kept packed (the txid as 32 raw bytes, see pack_outpoint),
+    a fraction of the size of a (txid, n) tuple.
+
+    With an AddressIndex, the index is kept in sync with every change.
+    """
+
+    def __init__(
+        self,
+        outputs: Iterable[Tuple[OutPoint, VOut]] = (),
+        index: Optional[AddressIndex] = None,
+    ):
+        self.outputs: dict[bytes, VOut] = {pack_outpoint(*x): vout for x, vout in outputs}
+        self.index = index
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def __contains__(self, outpoint: OutPoint):
+        return pack_outpoint(*outpoint) in self.outputs
+
+    def __iter__(self) -> Iterator[OutPoint]:
+        return (unpack_outpoint(x) for x in self.outputs)
+
+    def __eq__(self, other):
+        if not isinstance(other, UtxoSet):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def items(self) -> Iterable[Tuple[OutPoint, VOut]]:
+        return [(unpack_outpoint(x), vout) for x, vout in self.outputs.items()]
+
+    def get(self, txid: TxId, n: int) -> Optional[VOut]:
+        return self.outputs.get(pack_outpoint(txid, n))
+
+    def get_many(self, outpoints: Iterable[OutPoint]) -> List[Optional[VOut]]:
+        """The outputs at outpoints, in order, None for the ones not in the set"""
+        get = self.outputs.get
+        return [get(pack_outpoint(*x)) for x in outpoints]
+
+    def get_coins(self, pkh: str) -> List[Tuple[TxId, VOut]]:
+        """Like AddressIndex.get_coins, by scanning the whole set"""
+        script = encode_script_pub_key(p2pkh_script(pkh))
+        return [
+            (unpack_outpoint(x)[0], vout) for x, vout in self.outputs.items() if vout.script_bytes == script
+        ]
+
+    def add(self, txid: TxId, vout: VOut):
+        key = pack_outpoint(txid, vout.n)
+        if self.index is not None:
+            replaced = self.outputs.get(key)
+            if replaced is not None:
+                self.index._remove(key, replaced)
+            self.index._add(key, vout)
+        self.outputs[key] = vout
+
+    def add_txn(self, txn: Transaction):
+        for vout in txn.vout:
+            self.add(txn.txid, vout)
+
+    def spend(self, txid: TxId, n: int) -> Optional[VOut]:
+        """Removes the output and returns it, None if it is not in the set"""
+        key = pack_outpoint(txid, n)
+        vout = self.outputs.pop(key, None)
+        if vout is not None and self.index is not None:
+            self.index._remove(key, vout)
+        return vout
+
+    def copy(self) -> "UtxoSet":
+        """An in memory copy, with its own index if this one has one"""
+        new = UtxoSet()
+        new.outputs = dict(self.outputs) if type(self) is UtxoSet else {
+            pack_outpoint(*x): vout for x, vout in self.items()
+        }
+        if self.index is not None:
+            new.index = AddressIndex.from_utxos(new)
+        return new
+
+
+def pack_outpoint(txid: TxId, n: int) -> bytes:
+    """The outpoint as a UtxoSet key: write_hash of the txid (32 raw bytes for a hex one) and 4 bytes of n"""
+    return write_hash(txid) + U32.pack(NO_VOUT if n == -1 else n)
+
+
+def unpack_outpoint(data: bytes) -> OutPoint:
+    reader = ByteReader(data)
+    txid = reader.read_hash()
+    n = reader.read_u32()
+    return txid, -1 if n == NO_VOUT else n
+
+
+def get_spent_outpoints(txns: Iterable[Transaction]) -> List[OutPoint]:
+    return [(vin.transaction_id, vin.vout) for txn in txns for vin in txn.vin]
+
+
+def connect_block(utxos: UtxoSet, block: Block) -> BlockUndo:
+    """
+    Applies the block to utxos in place: txn by txn, its inputs are spent and
+    its outputs added. Inputs spending outputs missing from utxos (e.g. the
+    coinbase) are skipped.
+    """
+    undo = BlockUndo()
+    for txn in block.transactions:
+        spent = []
+        for vin in txn.vin:
+            vout = utxos.spend(vin.transaction_id, vin.vout)
+            if vout is not None:
+                spent.append(((vin.transaction_id, vin.vout), vout))
+        undo.spent.append(spent)
+        for vout in txn.vout:
+            replaced = utxos.get(txn.txid, vout.n)
+            if replaced is not None:
+                undo.replaced.append(((txn.txid, vout.n), replaced))
+            utxos.add(txn.txid, vout)
+    return undo
+
+
+def disconnect_block(utxos: UtxoSet, block: Block, undo: BlockUndo):
+    """Reverts connect_block, block must be the last one connected to utxos"""
+    for txn, spent in zip(reversed(block.transactions), reversed(undo.spent)):
+        for vout in txn.vout:
+            utxos.spend(txn.txid, vout.n)
+        for (txid, _), vout in reversed(spent):
+            utxos.add(txid, vout)
+    for (txid, _), vout in undo.replaced:
+        utxos.add(txid, vout)
@@ -1,38 +1,83 @@
-from typing import List, TypeAlias
+from typing import Iterable, List, Optional, Sequence, Tuple, TypeAlias
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 from .block import Block
-from .transaction import Transaction, VIn, VOut
+from .utils.block import get_merkle_root
+from .transaction import Transaction, VIn, VOut, get_block_reward
 from .script import run_stack
+from .utxo import UtxoSet, get_spent_outpoints
 
 TxId: TypeAlias = str
+# (index of the txn in the batch, input, output it spends)
+ScriptCheck: TypeAlias = Tuple[int, VIn, VOut]
 
+# Script checks are split so that every worker gets about this many chunks:
+# enough to balance the load and to stop early on a failure
+CHUNKS_PER_WORKER = 4
 
-def validate_new_transaction(txn: Transaction, utxos: dict[TxId, List[VOut]]):
+
+def validate_new_transaction(txn: Transaction, utxos: UtxoSet):
     # check if input txns are in utxo set
-    utx_vouts = [utxos.get(x.transaction_id) for x in txn.vin]
-    if not all(utx_vouts):
+    utx_vouts = utxos.get_many(get_spent_outpoints([txn]))
+    if any(x is None for x in utx_vouts):
         return False
 
-    for vin, utx_vouts in zip(txn.vin, utx_vouts):
+    for vin, utx_vout in zip(txn.vin, utx_vouts):
         # Run the script
-        if not utx_vouts:
-            return False
-        if not validate_scripts(vin, utx_vouts):
+        if not validate_scripts(vin, utx_vout):
             return False
     return True
 
 
-def validate_new_block(block: Block):
-    return True
+def validate_merkle_root(block: Block) -> bool:
+    """Whether the merkle root of the block's header is the one of its txns"""
+    txns = block.transactions
+    return len(txns) > 0 and get_merkle_root(txns) == block.block_header.merkle_root
 
 
-def validate_scripts(vin: VIn, vouts: List[VOut]):
-    # TODO: use witness
-    filtered_vouts = [x for x in vouts if x.n == vin.vout]
-    if not filtered_vouts:
+def validate_new_block(
+    block: Block,
+    utxos: Optional[UtxoSet] = None,
+    validator: Optional["BatchValidator"] = None,
+    known_valid: Iterable[TxId] = (),
+    height: Optional[int] = None,
+):
+    """
+    Checks the merkle root of the block, the scripts of every non coinbase
+    txn of the block against utxos and that no output is spent twice. Txns
+    in known_valid (e.g. already accepted to the mempool) are not checked
+    again. With the height of the block, its coinbase must not create more
+    than the block reward and the fees of its txns.
+
+    Without utxos, there is nothing to check the txns against.
+    """
+    if not validate_merkle_root(block):
+        return False
+    if utxos is None:
+        return True
+    coinbase, *txns = block.transactions
+
+    outpoints = get_spent_outpoints(txns)
+    if len(set(outpoints)) != len(outpoints):
         return False
-    vout = filtered_vouts[0]
+    # Look up every input of the block at once
+    spent = utxos.get_many(outpoints)
+    if any(x is None for x in spent):
+        return False
+    if height is not None:
+        fees = sum(x.value for x in spent) - sum(x.value for txn in txns for x in txn.vout)
+        if sum(x.value for x in coinbase.vout) > get_block_reward(height) + fees:
+            return False
+    spent_utxos = UtxoSet(zip(outpoints, spent))
+
+    known_valid = set(known_valid)
+    to_check = [(x, spent_utxos) for x in txns if x.txid not in known_valid]
+    validator = validator or BatchValidator()
+    return all(validator.validate(to_check, fail_fast=True))
+
 
+def validate_scripts(vin: VIn, vout: VOut) -> bool:
+    # TODO: use witness
     locking_script = vout.script_pub_key.split()
     unlocking_script = vin.script_sig.split()
 
@@ -42,3 +87,107 @@ def validate_scripts(vin: VIn, vouts: List[VOut]):
     if len(result) != 1:
         return False
     return result[0] == 1
+
+
+def _run_script_checks(checks: List[ScriptCheck], fail_fast: bool) -> List[Tuple[int, bool]]:
+    """Runs in the worker processes. With fail_fast, stops at the first failure."""
+    results = []
+    for index, vin, vout in checks:
+        ok = validate_scripts(vin, vout)
+        results.append((index, ok))
+        if fail_fast and not ok:
+            break
+    return results
+
+
+class BatchValidator:
+    """
+    Validates many (txn, utxos) pairs at once, with the script checks (and so
+    the signature verification) of all their inputs spread over `workers`
+    processes. With a single worker, everything runs in the calling process.
+
+    Like ParallelMiner, the pool is created lazily on first use.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = max(1, workers)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def validate(
+        self,
+        items: Sequence[Tuple[Transaction, UtxoSet]],
+        fail_fast: bool = False,
+    ) -> List[bool]:
+        """
+        Returns whether each txn is valid against its utxos, in order.
+
+        With fail_fast (e.g. for the txns of a block, which is invalid as soon
+        as one of them is), pending checks are cancelled after the first
+        failure and txns whose checks did not all run are reported invalid.
+        """
+        results = [True] * len(items)
+        checks: List[ScriptCheck] = []
+        for index, (txn, utxos) in enumerate(items):
+            txn_checks = get_script_checks(index, txn, utxos)
+            if txn_checks is None:
+                results[index] = False
+                if fail_fast:
+                    return [False] * len(items)
+                continue
+            checks.extend(txn_checks)
+
+        if self.workers == 1 or len(checks) <= 1:
+            checked = _run_script_checks(checks, fail_fast)
+        else:
+            checked = self._run_parallel(checks, fail_fast)
+
+        pending = [0] * len(items)
+        for index, _, _ in checks:
+            pending[index] += 1
+        for index, ok in checked:
+            pending[index] -= 1
+            if not ok:
+                results[index] = False
+        return [ok and not left for ok, left in zip(results, pending)]
+
+    def _run_parallel(self, checks: List[ScriptCheck], fail_fast: bool) -> List[Tuple[int, bool]]:
+        executor = self._get_executor()
+        size = -(-len(checks) // (self.workers * CHUNKS_PER_WORKER))
+        chunks = [checks[i:i + size] for i in range(0, len(checks), size)]
+        futures = {executor.submit(_run_script_checks, x, fail_fast) for x in chunks}
+
+        checked: List[Tuple[int, bool]] = []
+        failed = False
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_checked = future.result()
+                checked.extend(chunk_checked)
+                failed = failed or not all(ok for _, ok in chunk_checked)
+            if fail_fast and failed:
+                # Chunks already running in a worker finish, the others never start
+                for future in futures:
+                    future.cancel()
+                break
+        return checked
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+def get_script_checks(index: int, txn: Transaction, utxos: UtxoSet) -> Optional[List[ScriptCheck]]:
+    """
+    The script checks of every input of txn, or None if any of them spends an
+    output missing from utxos.
+    """
+    vouts = utxos.get_many(get_spent_outpoints([txn]))
+    if any(x is None for x in vouts):
+        return None
+    return [(index, vin, vout) for vin, vout in zip(txn.vin, vouts)]
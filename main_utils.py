@@ -1,10 +1,42 @@
 from multiprocessing import Process, Manager
 import json
+import os
 import socket
 
-from bitcoin_rollup_sim.utils.common import recv_from_sock
+from bitcoin_rollup_sim.utils.common import recv_frame, send_frame
+from bitcoin_rollup_sim.utils.block import TARGET_BLOCK_INTERVAL
 from bitcoin_rollup_sim.node import WalletNode, MinerNode, Node
 from bitcoin_rollup_sim.block import Block
+from bitcoin_rollup_sim.clock import SimClock
+from bitcoin_rollup_sim.relay import MAX_RELAY_BATCH, TXN_RELAY_INTERVAL
+
+# Simulation settings
+# How many times faster than wall clock the simulation's clock runs
+SIM_CLOCK_SPEED = float(os.environ.get("SIM_CLOCK_SPEED", 1))
+# Seconds of simulation time between blocks, difficulty adapts to this
+SIM_TARGET_BLOCK_INTERVAL = int(os.environ.get("SIM_TARGET_BLOCK_INTERVAL", TARGET_BLOCK_INTERVAL))
+# Processes each node uses to check the scripts of received blocks
+SIM_VALIDATION_WORKERS = int(os.environ.get("SIM_VALIDATION_WORKERS", 1))
+# If set, nodes serve peers with an asyncio listener handling messages in this
+# many threads, instead of one message at a time
+SIM_ASYNC_WORKERS = int(os.environ["SIM_ASYNC_WORKERS"]) if os.environ.get("SIM_ASYNC_WORKERS") else None
+# Wall clock seconds between a node's batched txn announcements to each peer,
+# and the most txns announced or sent in one message
+SIM_RELAY_INTERVAL = float(os.environ.get("SIM_RELAY_INTERVAL", TXN_RELAY_INTERVAL))
+SIM_RELAY_BATCH_SIZE = int(os.environ.get("SIM_RELAY_BATCH_SIZE", MAX_RELAY_BATCH))
+# If set, each node keeps its chain and utxos under a subdirectory of this, and
+# picks up from there when the simulation is restarted
+SIM_DATA_DIR = os.environ.get("SIM_DATA_DIR")
+# If set, nodes without a data_dir start from this UTXO snapshot (see
+# dump_snapshot) instead of from genesis, and validate the history in the
+# background
+SIM_SNAPSHOT = os.environ.get("SIM_SNAPSHOT")
+# If set, nodes keep only this many of the last blocks in full, older ones are
+# pruned down to their headers (or only kept on disk with SIM_DATA_DIR)
+SIM_PRUNE = int(os.environ["SIM_PRUNE"]) if os.environ.get("SIM_PRUNE") else None
+# Smallest coins each wallet payment also spends once a wallet has many, to
+# keep wallets from fragmenting (see bitcoin_rollup_sim.coin_selection)
+SIM_CONSOLIDATE_INPUTS = int(os.environ.get("SIM_CONSOLIDATE_INPUTS", 0))
 
 
 def setup_network():
@@ -16,12 +48,27 @@ def setup_network():
         Node,
     ]
     nodes = []
+    clock = SimClock(SIM_CLOCK_SPEED)
     with Manager() as manager:
         peers = manager.dict()
 
         processes = []
-        for nodecls in node_types:
-            node = nodecls(peers=peers)
+        for i, nodecls in enumerate(node_types):
+            kwargs = {
+                "validation_workers": SIM_VALIDATION_WORKERS,
+                "prune": SIM_PRUNE,
+                "async_workers": SIM_ASYNC_WORKERS,
+                "relay_interval": SIM_RELAY_INTERVAL,
+                "relay_batch_size": SIM_RELAY_BATCH_SIZE,
+                "target_block_interval": SIM_TARGET_BLOCK_INTERVAL,
+            }
+            if SIM_DATA_DIR:
+                kwargs["data_dir"] = os.path.join(SIM_DATA_DIR, f"node-{i}")
+            elif SIM_SNAPSHOT:
+                kwargs["snapshot"] = SIM_SNAPSHOT
+            if issubclass(nodecls, WalletNode):
+                kwargs["consolidate_inputs"] = SIM_CONSOLIDATE_INPUTS
+            node = nodecls(peers=peers, clock=clock, **kwargs)
             nodes.append(node)
             peers[node.nid] = node.port
             p = Process(target=node.run)
@@ -37,12 +84,19 @@ def setup_network():
 def get_balance_for(node):
     conn = socket.create_connection(("localhost", node.port))
     msg = "app:8080 app:getbalance"
-    ln = len(msg)
-    conn.send(f"{ln}{msg}".encode())
-    strdata = recv_from_sock(conn)
+    send_frame(conn, msg)
+    strdata = recv_frame(conn)
     return int(strdata)
 
 
+def dump_snapshot(node, path: str) -> str:
+    """Has node write a UTXO snapshot to path, returns its commitment"""
+    conn = socket.create_connection(("localhost", node.port))
+    msg = f"app:8080 app:dumpsnapshot {path}"
+    send_frame(conn, msg)
+    return recv_frame(conn)
+
+
 def pay_from_to(app, fromid, toid, amt):
     frmnode = None
     tonode = None
@@ -56,17 +110,15 @@ def pay_from_to(app, fromid, toid, amt):
     topubkey = tonode.pubkeyhash
     conn = socket.create_connection(("localhost", frmnode.port))
     msg = f"app:8080 pay {topubkey} {amt}"
-    ln = len(msg)
-    conn.send(f"{ln}{msg}".encode())
+    send_frame(conn, msg)
 
 
 def ask_info(app):
     node = app.nodes[0]
     conn = socket.create_connection(("localhost", node.port))
     msg = "app:8080 app:getblocks"
-    ln = len(msg)
-    conn.send(f"{ln}{msg}".encode())
-    strdata = recv_from_sock(conn)
+    send_frame(conn, msg)
+    strdata = recv_frame(conn)
     blocks = [Block.deserialize(x) for x in json.loads(strdata)]
     return {
         "blocks": [x.to_json() for x in blocks],
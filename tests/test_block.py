@@ -1,4 +1,7 @@
-from bitcoin_rollup_sim.block import get_genesis_block, Block
+from dataclasses import replace
+
+from bitcoin_rollup_sim.block import get_genesis_block, Block, BlockHeader, HEADER_SIZE
+from bitcoin_rollup_sim.utils.block import target_to_bits, bits_to_target, get_nonce_for_prefix
 
 genesis_block_serialized = """
 ["[1, \\"e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855\\", \\"6703f24b5ddb09124c8e3766d464c7cdab50650b0018878b8db3fb6d31cfbfb6\\", 1694692863, 110427941548649020598956093796432407239217743554726184882600387580788736, 350254]", 1, ["[\\"ea559d8b0b3dbb03594614ea6d8fa8b968d75dddca7b7b09371c7fccb82eb273\\", 1, 0, [\\"[\\\\\\"\\\\\\", -1, \\\\\\"\\\\\\", 1, \\\\\\"Learning bitcoin\\\\\\"]\\"], [\\"[50, \\\\\\"OP_DUP OP_HASH160 42146bb6914e3e723742e6f79d56116186f86aab OP_EQUALVERIFY OP_CHECKSIG\\\\\\"]\\"]]"], 0]
@@ -14,3 +17,29 @@ def test_genesis_deserialize():
     deserialized_block = Block.deserialize(genesis_block_serialized)
     block = get_genesis_block()
     assert block == deserialized_block
+
+
+def test_header_pack_unpack():
+    header = get_genesis_block().block_header
+    packed = header.pack()
+    assert len(packed) == HEADER_SIZE == 80
+    assert BlockHeader.unpack(packed) == header
+
+
+def test_genesis_header_pow():
+    assert get_genesis_block().block_header.check_pow()
+
+
+def test_target_bits_roundtrip():
+    for target in [2**237, 2**200 + 12345, 0x7FFFFF, 0x800000]:
+        bits = target_to_bits(target)
+        assert bits_to_target(bits) <= target
+        assert target_to_bits(bits_to_target(bits)) == bits
+    assert bits_to_target(target_to_bits(2**237)) == 2**237
+
+
+def test_nonce_for_prefix_meets_target():
+    header = replace(get_genesis_block().block_header, difficulty_target=2**248)
+    nonce = get_nonce_for_prefix(header.pack_without_nonce(), header.difficulty_target)
+    assert nonce is not None
+    assert replace(header, nonce=nonce).check_pow()
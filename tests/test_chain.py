@@ -0,0 +1,94 @@
+from dataclasses import replace
+
+import pytest
+
+from bitcoin_rollup_sim.block import Block, get_genesis_block
+from bitcoin_rollup_sim.chain import BlockIndex, PrunedBlock, PrunedChain, get_block_work
+from bitcoin_rollup_sim.transaction import Transaction
+from bitcoin_rollup_sim.utils.block import get_nonce_for_prefix
+
+PKH = "42146bb6914e3e723742e6f79d56116186f86aab"
+EASY_TARGET = 2**250
+# Coinbases of test blocks claim the reward at this height, no more than the
+# one of any block of the test chains
+COINBASE_HEIGHT = 64
+
+
+def mine_block(prev: Block, name: str, txns=(), target: int = EASY_TARGET) -> Block:
+    """A block on top of prev with a valid proof of work, name tells blocks apart"""
+    coinbase = Transaction.create_coinbase(PKH, name, COINBASE_HEIGHT)
+    block = Block.new(prev.hash, [coinbase, *txns])
+    header = replace(block.block_header, difficulty_target=target)
+    nonce = get_nonce_for_prefix(header.pack_without_nonce(), target)
+    return Block.with_size(replace(header, nonce=nonce), list(block.transactions))
+
+
+def test_heights_and_work():
+    genesis = get_genesis_block()
+    a1 = mine_block(genesis, "a1")
+    a2 = mine_block(a1, "a2")
+    index = BlockIndex.from_chain([genesis, a1, a2])
+    assert len(index) == 3 and a2.hash in index
+    assert index[a2.hash].height == 2
+    assert index[a2.hash].chain_work == sum(get_block_work(x) for x in [genesis, a1, a2])
+    assert index.best is index[a2.hash]
+    assert index[a1.hash].block is None
+
+
+def test_unknown_parent_not_added():
+    index = BlockIndex.from_chain([get_genesis_block()])
+    orphan = mine_block(mine_block(get_genesis_block(), "a1"), "a2")
+    assert index.add(orphan) is None
+    assert orphan.hash not in index
+
+
+def test_most_work_wins_first_seen_on_tie():
+    genesis = get_genesis_block()
+    index = BlockIndex.from_chain([genesis])
+    a1 = index.add(mine_block(genesis, "a1"))
+    b1 = index.add(mine_block(genesis, "b1"))
+    assert index.best is a1
+    # Less blocks, but more work
+    c1 = index.add(mine_block(genesis, "c1", target=EASY_TARGET // 2))
+    assert index.best is c1
+    b2 = index.add(mine_block(b1.block, "b2"))
+    b3 = index.add(mine_block(b2.block, "b3"))
+    assert index.best is b3
+
+    fork, disconnect, connect = index.find_fork(c1, b3)
+    assert fork is index[genesis.hash]
+    assert disconnect == [c1] and connect == [b1, b2, b3]
+    assert index.find_fork(b3, b1) == (b1, [b2, b3], [])
+    assert a1.chain_work == b1.chain_work
+
+
+def test_invalid_branch_never_chosen():
+    genesis = get_genesis_block()
+    index = BlockIndex.from_chain([genesis])
+    a1 = index.add(mine_block(genesis, "a1"))
+    b1 = index.add(mine_block(genesis, "b1"))
+    b2 = index.add(mine_block(b1.block, "b2"))
+    assert index.best is b2
+    index.mark_invalid(b1)
+    assert b2.invalid and index.best is a1
+    # Descendants arriving later are invalid too
+    b3 = index.add(mine_block(b2.block, "b3"))
+    assert b3.invalid and index.best is a1
+
+
+def test_pruned_chain():
+    blocks = [get_genesis_block()]
+    for i in range(10):
+        blocks.append(mine_block(blocks[-1], f"a{i}"))
+    chain = PrunedChain(4, blocks)
+    assert len(chain) == 11 and chain.full_start == 7
+    assert chain[3] == PrunedBlock(blocks[3].hash, blocks[3].block_header)
+    assert chain[7:] == blocks[7:]
+    assert [x.hash for x in chain] == [x.hash for x in blocks]
+
+    for _ in range(4):
+        chain.pop()
+    with pytest.raises(IndexError):
+        chain.pop()
+    chain.append(blocks[7])
+    assert chain[-1] == blocks[7] and len(chain) == 8
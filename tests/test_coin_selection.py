@@ -0,0 +1,75 @@
+from bitcoin_rollup_sim.block import get_genesis_block
+from bitcoin_rollup_sim.coin_selection import (
+    CONSOLIDATE_MIN_COINS, select_branch_and_bound, select_coins, select_largest_first,
+)
+from bitcoin_rollup_sim.node import WalletNode
+from bitcoin_rollup_sim.transaction import Transaction, VOut
+from bitcoin_rollup_sim.utxo import AddressIndex, UtxoSet
+
+PKH = "42146bb6914e3e723742e6f79d56116186f86aab"
+OTHER_PKH = "1111111111111111111111111111111111111111"
+
+
+def make_coins(*values):
+    return [(f"{i:064x}", VOut.get_for_p2pkh(PKH, value, ind=0)) for i, value in enumerate(values)]
+
+
+def values(coins):
+    return sorted(vout.value for _, vout in coins)
+
+
+def test_exact_match_with_fewest_inputs():
+    coins = make_coins(1, 2, 3, 4, 5, 50)
+    assert values(select_branch_and_bound(coins, 53)) == [3, 50]
+    assert values(select_branch_and_bound(coins, 50)) == [50]
+    # Never more inputs than the largest coins would take, one here
+    assert select_branch_and_bound(coins, 9) is None
+    assert values(select_coins(coins, 9)) == [50]
+
+    coins = make_coins(30, 25, 20, 12, 8)
+    assert values(select_coins(coins, 45)) == [20, 25]
+    assert values(select_coins(coins, 62)) == [12, 20, 30]
+    # No exact match, so spend as few coins as possible
+    assert values(select_coins(coins, 46)) == [25, 30]
+
+
+def test_fallbacks():
+    coins = make_coins(10, 20, 40, 70)
+    # The smallest coin covering the amount
+    assert values(select_coins(coins, 35)) == [40]
+    # Else the largest ones
+    assert values(select_coins(coins, 125)) == [20, 40, 70]
+    assert values(select_largest_first(coins, 75)) == [40, 70]
+    assert select_coins(coins, 141) == []
+    assert select_coins(coins, 0) == []
+
+
+def test_consolidation():
+    coins = make_coins(1000, *range(1, CONSOLIDATE_MIN_COINS + 1))
+    assert values(select_coins(coins, 1000)) == [1000]
+    assert values(select_coins(coins, 1000, consolidate=3)) == [1, 2, 3, 1000]
+    # Only wallets with many coins consolidate
+    assert values(select_coins(coins[:5], 1000, consolidate=3)) == [1000]
+
+
+def make_wallet(*values) -> WalletNode:
+    wallet = WalletNode(peers={})
+    wallet.socket.close()
+    wallet.blocks = [get_genesis_block()]
+    vouts = [VOut.get_for_p2pkh(wallet.pubkeyhash, x, ind=i) for i, x in enumerate(values)]
+    coinbase = Transaction.create_coinbase(wallet.pubkeyhash, "coins", 1)
+    txn = Transaction.new(list(coinbase.vin), vouts)
+    wallet.utxo_set = UtxoSet(((txn.txid, x.n), x) for x in vouts)
+    wallet.utxo_set.index = AddressIndex.from_utxos(wallet.utxo_set)
+    return wallet
+
+
+def test_wallet_pays_with_fewest_inputs():
+    wallet = make_wallet(*[100] * 8, 300, 500)
+    assert wallet.pay_to(OTHER_PKH, 800)
+    [txn] = wallet.mem_pool
+    assert len(txn.vin) == 2 and len(txn.vout) == 1
+    # Coins spent by the first payment are not picked again
+    assert wallet.pay_to(OTHER_PKH, 300)
+    assert len(wallet.mem_pool) == 2
+    assert not wallet.pay_to(OTHER_PKH, 900)
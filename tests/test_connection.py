@@ -0,0 +1,133 @@
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+from bitcoin_rollup_sim.connection import ConnectionMixin
+from bitcoin_rollup_sim.utils.common import FRAME_REPLY, FrameReader, pack_frame, recv_frame, send_frame
+
+
+class Peer(ConnectionMixin):
+    def __init__(self, async_workers=None):
+        super().__init__()
+        self.async_workers = async_workers
+        self.logger = logging.getLogger("peer")
+        self.received = []
+        self.socket.listen(10)  # before the listener thread gets to it, so connecting works right away
+        threading.Thread(None, self.serve, daemon=True).start()
+
+    def on_receive_message(self, message: str, conn):
+        if message.endswith("slow"):
+            time.sleep(0.5)
+        self.received.append(message)
+        if message == "ping":
+            return "pong"
+        if message == "app":
+            send_frame(conn, "pong", FRAME_REPLY)
+            conn.close()
+
+    def wait_for(self, count: int):
+        deadline = time.monotonic() + 5
+        while len(self.received) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(self.received) == count
+
+
+def test_messages_share_a_connection():
+    sender, receiver = Peer(), Peer()
+    messages = [f"a:1 msg {i} " + "x" * i * 100 for i in range(50)]
+    for message in messages:
+        sender.send(receiver.port, message)
+    receiver.wait_for(50)
+    assert receiver.received == messages
+    assert list(sender.connections) == [receiver.port]
+
+
+def test_reconnects_when_closed(monkeypatch):
+    monkeypatch.setattr("bitcoin_rollup_sim.connection.LISTEN_IDLE_TIMEOUT", 0.2)
+    sender, receiver = Peer(), Peer()
+    sender.send(receiver.port, "a:1 first")
+    receiver.wait_for(1)
+    first = sender.connections[receiver.port].sock
+    time.sleep(0.5)  # the receiver closes the idle connection
+    sender.send(receiver.port, "a:1 second")
+    receiver.wait_for(2)
+    assert sender.connections[receiver.port].sock is not first
+
+
+def test_idle_connections_closed():
+    sender, receiver = Peer(), Peer()
+    sender.send(receiver.port, "a:1 msg")
+    sender.connections[receiver.port].last_used -= 1000
+    sender.close_idle_connections()
+    assert sender.connections == {}
+
+
+def test_reply_on_same_connection():
+    receiver = Peer()
+    conn = socket.create_connection(("localhost", receiver.port))
+    for _ in range(2):
+        send_frame(conn, "ping")
+        assert recv_frame(conn) == "pong"
+    conn.close()
+
+
+def test_async_messages_handled_concurrently():
+    receiver = Peer(async_workers=2)
+    slow, fast = Peer(), Peer()
+    slow.send(receiver.port, "a:1 slow")
+    time.sleep(0.1)
+    for i in range(3):
+        fast.send(receiver.port, f"b:2 fast {i}")
+    receiver.wait_for(4)
+    # In order for a connection, without waiting for the slow one
+    assert receiver.received == ["b:2 fast 0", "b:2 fast 1", "b:2 fast 2", "a:1 slow"]
+
+
+def test_async_replies():
+    receiver = Peer(async_workers=2)
+    conn = socket.create_connection(("localhost", receiver.port))
+    send_frame(conn, "ping")
+    assert recv_frame(conn) == "pong"
+    send_frame(conn, "app")
+    assert recv_frame(conn) == "pong"
+    # The handler closed it
+    assert conn.recv(1) == b""
+
+
+class ChunkedConn:
+    """Hands out data a few bytes per recv"""
+
+    def __init__(self, data: bytes, chunk: int):
+        self.data = data
+        self.chunk = chunk
+
+    def recv(self, size: int) -> bytes:
+        part, self.data = self.data[:min(size, self.chunk)], self.data[min(size, self.chunk):]
+        return part
+
+
+def test_frames():
+    big = "x" * 300_000  # more than the old 5 digits size prefix allowed
+    messages = ["1234", big, "", "héllo"]
+    data = b"".join(pack_frame(x) for x in messages)
+    for chunk in [1000, 65537, len(data)]:
+        reader = FrameReader(ChunkedConn(data, chunk))
+        assert [reader.read_frame()[1] for _ in messages] == messages
+    small = b"".join(pack_frame(x) for x in messages if x is not big)
+    reader = FrameReader(ChunkedConn(small, 1))
+    assert [reader.read_frame()[1] for _ in range(3)] == ["1234", "", "héllo"]
+    reader = FrameReader(ChunkedConn(pack_frame(big)[:1000], 100))
+    with pytest.raises(ConnectionError):
+        reader.read_frame()
+
+
+def test_large_messages_between_peers():
+    sender, receiver = Peer(), Peer(async_workers=2)
+    big = "a:1 big " + "x" * 1_000_000
+    sender.send(receiver.port, big)
+    sender.send(receiver.port, "a:1 small")
+    receiver.wait_for(2)
+    assert receiver.received == [big, "a:1 small"]
@@ -0,0 +1,47 @@
+from dataclasses import replace
+
+from bitcoin_rollup_sim.block import get_genesis_block, INITIAL_DIFFICULTY
+from bitcoin_rollup_sim.clock import SimClock
+from bitcoin_rollup_sim.utils.block import calculate_new_difficulty, MAX_TARGET
+
+START = 1_700_000_000
+
+
+def make_chain(intervals, target=INITIAL_DIFFICULTY):
+    genesis = get_genesis_block()
+    blocks = [genesis]
+    timestamp = START
+    for interval in intervals:
+        timestamp += interval
+        header = replace(genesis.block_header, timestamp=timestamp, difficulty_target=target)
+        blocks.append(replace(genesis, block_header=header))
+    return blocks
+
+
+def test_no_retarget_without_enough_blocks():
+    assert calculate_new_difficulty(make_chain([])) == INITIAL_DIFFICULTY
+    assert calculate_new_difficulty(make_chain([1000])) == INITIAL_DIFFICULTY
+
+
+def test_on_target_keeps_difficulty():
+    blocks = make_chain([30] * 12)
+    assert calculate_new_difficulty(blocks, target_interval=30) == INITIAL_DIFFICULTY
+
+
+def test_fast_blocks_make_it_harder():
+    blocks = make_chain([20] * 12)
+    target = calculate_new_difficulty(blocks, target_interval=30)
+    assert target < INITIAL_DIFFICULTY
+    assert abs(target - INITIAL_DIFFICULTY * 2 // 3) < INITIAL_DIFFICULTY // 1000
+
+
+def test_adjustment_is_clamped():
+    assert calculate_new_difficulty(make_chain([1] * 12), target_interval=30) == INITIAL_DIFFICULTY // 2
+    assert calculate_new_difficulty(make_chain([1000] * 12), target_interval=30) == INITIAL_DIFFICULTY * 2
+    assert calculate_new_difficulty(make_chain([1000] * 12, MAX_TARGET), target_interval=30) == MAX_TARGET
+
+
+def test_sim_clock_speed():
+    clock = SimClock(speed=60, epoch=0)
+    assert clock.time() > 60 * START
+    assert clock.to_wall_seconds(120) == 2
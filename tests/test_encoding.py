@@ -0,0 +1,91 @@
+from dataclasses import FrozenInstanceError, replace
+import pickle
+
+import pytest
+
+from bitcoin_rollup_sim.block import get_genesis_block, Block, GenesisKeyAddress
+from bitcoin_rollup_sim.encoding import ByteReader, DecodeError, write_varint, write_hash
+from bitcoin_rollup_sim.transaction import Transaction, VIn, VOut
+from bitcoin_rollup_sim.utils.common import get_signature
+
+
+def make_spend() -> Transaction:
+    genesis_txn = get_genesis_block().transactions[0]
+    vout = genesis_txn.vout[0]
+    vin = VIn(
+        transaction_id=genesis_txn.txid,
+        vout=0,
+        script_sig=" ".join([
+            get_signature(vout.serialize(), GenesisKeyAddress.priv_key),
+            GenesisKeyAddress.pub_key_hex,
+        ]),
+        sequence=1,
+    )
+    return Transaction.new([vin], [VOut.get_for_p2pkh(GenesisKeyAddress.pub_key_hash, 40, ind=0)])
+
+
+def test_varint_roundtrip():
+    for n in [0, 1, 0xFC, 0xFD, 0xFFFF, 0x10000, 0xFFFFFFFF, 2**40]:
+        assert ByteReader(write_varint(n)).read_varint() == n
+
+
+def test_hash_roundtrip():
+    for h in ["", "ab" * 32, "AB" * 32, "not a hash"]:
+        assert ByteReader(write_hash(h)).read_hash() == h
+    assert len(write_hash("ab" * 32)) == 33
+
+
+def test_transaction_roundtrip():
+    txn = make_spend()
+    data = txn.serialize_binary()
+    decoded = Transaction.deserialize_binary(data)
+    assert decoded == txn
+    assert decoded.serialize() == txn.serialize()
+    assert len(data) < len(txn.serialize()) / 2
+
+
+def test_unusual_scripts_roundtrip():
+    vin = VIn(transaction_id="xyz", vout=3, script_sig="0ABC:00FF 2ab", sequence=7, coinbase="c")
+    vout = VOut(n=300, value=12, script_pub_key="OP_RETURN hello")
+    txn = Transaction.new([vin], [vout])
+    assert Transaction.deserialize_binary(txn.serialize_binary()) == txn
+
+
+def test_compact_transaction():
+    txn = make_spend()
+    vin, vout = txn.vin[0], txn.vout[0]
+    assert isinstance(vin._transaction_id, bytes)
+    assert vin.transaction_id == get_genesis_block().transactions[0].txid
+    assert vout.pub_key_hash == GenesisKeyAddress.pub_key_hash
+    assert not hasattr(vout, "__dict__")
+    assert VIn(vin.transaction_id, vin.vout, vin.script_sig, vin.sequence) == vin
+    assert Transaction.deserialize(txn.serialize()) == txn
+    assert pickle.loads(pickle.dumps(txn)) == txn
+    assert hash(pickle.loads(pickle.dumps(vout))) == hash(vout)
+    with pytest.raises(FrozenInstanceError):
+        vout.value = 1
+
+
+def test_block_roundtrip():
+    block = Block.new(get_genesis_block().hash, [
+        Transaction.create_coinbase(GenesisKeyAddress.pub_key_hash, "coinbase", 1),
+        make_spend(),
+    ])
+    decoded = Block.deserialize_binary(block.serialize_binary())
+    assert decoded == block
+    assert decoded.hash == block.hash
+
+    genesis = get_genesis_block()
+    assert Block.deserialize_binary(genesis.serialize_binary()).hash == genesis.hash
+
+    # Target not expressible in compact bits
+    odd_target = replace(block, block_header=replace(block.block_header, difficulty_target=2**237 + 1))
+    assert Block.deserialize_binary(odd_target.serialize_binary()) == odd_target
+
+
+def test_decode_errors():
+    data = get_genesis_block().serialize_binary()
+    with pytest.raises(DecodeError):
+        Block.deserialize_binary(data[:-5])
+    with pytest.raises(DecodeError):
+        Block.deserialize_binary(bytes([99]) + data[1:])
@@ -0,0 +1,86 @@
+from bitcoin_rollup_sim.mempool import Mempool, get_fee
+from bitcoin_rollup_sim.transaction import Transaction, VIn, VOut
+from bitcoin_rollup_sim.utxo import UtxoSet
+
+PKH = "42146bb6914e3e723742e6f79d56116186f86aab"
+
+
+def make_utxos(num: int, value: int = 10_000):
+    utxos = UtxoSet()
+    for i in range(num):
+        txn = Transaction.new(
+            vin=[VIn.get_coinbase_input(f"funding {i}", 1)],
+            vout=[VOut.get_for_p2pkh(PKH, value, ind=0)],
+        )
+        utxos.add_txn(txn)
+    return utxos
+
+
+def txids_of(utxos: UtxoSet):
+    return [txid for txid, _ in utxos]
+
+
+def spend(txid: str, out_value: int, vout: int = 0):
+    vin = VIn(transaction_id=txid, vout=vout, script_sig="", sequence=1)
+    return Transaction.new([vin], [VOut.get_for_p2pkh(PKH, out_value, ind=0)])
+
+
+def test_get_fee():
+    utxos = make_utxos(1)
+    [txid] = txids_of(utxos)
+    assert get_fee(spend(txid, 9_000), utxos) == 1_000
+    assert get_fee(spend(txid, 9_000, vout=1), utxos) is None
+    assert get_fee(spend("00" * 32, 9_000), utxos) is None
+
+
+def test_select_by_fee_rate():
+    utxos = make_utxos(5)
+    pool = Mempool()
+    fees = [100, 500, 300, 50, 400]
+    for txid, fee in zip(txids_of(utxos), fees):
+        assert pool.add(spend(txid, 10_000 - fee), utxos)
+
+    selected = pool.select(3)
+    assert [get_fee(x, utxos) for x in selected] == [500, 400, 300]
+    # Selecting does not remove
+    assert len(pool) == 5
+    assert [get_fee(x, utxos) for x in pool.select(10)] == [500, 400, 300, 100, 50]
+
+
+def test_rejects_duplicates_conflicts_and_overspends():
+    utxos = make_utxos(1)
+    [txid] = txids_of(utxos)
+    pool = Mempool()
+    txn = spend(txid, 9_000)
+    assert pool.add(txn, utxos)
+    assert not pool.add(txn, utxos)
+    assert not pool.add(spend(txid, 8_000), utxos)  # double spend
+    assert not pool.add(spend(txid, 20_000), utxos)
+
+
+def test_remove_for_block_removes_included_and_conflicting():
+    utxos = make_utxos(3)
+    txids = txids_of(utxos)
+    pool = Mempool()
+    in_pool = [spend(x, 9_000) for x in txids]
+    for txn in in_pool:
+        pool.add(txn, utxos)
+
+    # Block includes in_pool[0] and a different spend of txids[1]
+    pool.remove_for_block([in_pool[0], spend(txids[1], 5_000)])
+    assert list(pool) == [in_pool[2]]
+    assert pool.select(10) == [in_pool[2]]
+    # The outpoint of the removed conflict can be spent again
+    assert pool.add(spend(txids[0], 8_000), utxos)
+
+
+def test_heap_compacts_after_removals():
+    utxos = make_utxos(300)
+    pool = Mempool()
+    txns = [spend(x, 9_000) for x in txids_of(utxos)]
+    for txn in txns:
+        pool.add(txn, utxos)
+    pool.remove_many(x.txid for x in txns[:250])
+    assert len(pool) == 50
+    assert len(pool._heap) < 300
+    assert set(x.txid for x in pool.select(100)) == set(x.txid for x in txns[250:])
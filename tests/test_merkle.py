@@ -0,0 +1,49 @@
+from bitcoin_rollup_sim.merkle import MerkleTree, verify_merkle_proof
+from bitcoin_rollup_sim.utils.block import create_merkle_root
+from bitcoin_rollup_sim.block import get_genesis_block
+
+TXIDS = [f"{i:064x}" for i in range(1, 14)]
+
+
+def expected_root(txids):
+    # Same padding as the original get_merkle_root
+    items = list(txids)
+    if len(items) % 2 == 1:
+        items.append(items[-1])
+    return create_merkle_root(items)
+
+
+def test_root_matches_full_rebuild():
+    for n in range(1, len(TXIDS) + 1):
+        assert MerkleTree(TXIDS[:n]).root == expected_root(TXIDS[:n])
+
+
+def test_incremental_append_and_replace():
+    tree = MerkleTree()
+    for n, txid in enumerate(TXIDS, start=1):
+        tree.append(txid)
+        assert tree.root == expected_root(TXIDS[:n])
+
+    replaced = list(TXIDS)
+    replaced[0] = "ff" * 32
+    replaced[7] = "ee" * 32
+    tree.replace(0, replaced[0])
+    tree.replace(7, replaced[7])
+    assert tree.root == expected_root(replaced)
+    assert tree.levels == MerkleTree(replaced).levels
+
+
+def test_inclusion_proofs():
+    for n in [1, 2, 5, 13]:
+        tree = MerkleTree(TXIDS[:n])
+        for i, txid in enumerate(TXIDS[:n]):
+            assert verify_merkle_proof(txid, tree.get_proof(i), tree.root)
+        assert not verify_merkle_proof("00" * 32, tree.get_proof(0), tree.root)
+
+
+def test_block_merkle_proof():
+    block = get_genesis_block()
+    txid = block.transactions[0].txid
+    proof = block.get_merkle_proof(txid)
+    assert verify_merkle_proof(txid, proof, block.block_header.merkle_root)
+    assert block.get_merkle_proof("00" * 32) is None
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+
+from bitcoin_rollup_sim.block import get_genesis_block, Block
+from bitcoin_rollup_sim.mining import ParallelMiner
+from bitcoin_rollup_sim.utils.block import get_nonce_for_prefix, NONCE_FORMAT
+
+DIFFICULTY = 2**244
+
+
+def is_valid_nonce(prefix: bytes, nonce: int, difficulty: int) -> bool:
+    sha = hashlib.sha256(prefix + NONCE_FORMAT.pack(nonce)).hexdigest()
+    return int(sha, 16) < difficulty
+
+
+def test_parallel_miner_finds_valid_nonce():
+    prefix = get_genesis_block().block_header.pack_without_nonce()
+    miner = ParallelMiner(workers=2)
+    try:
+        result = miner.find_nonce(prefix, DIFFICULTY)
+    finally:
+        miner.close()
+    assert result.nonce is not None
+    assert is_valid_nonce(prefix, result.nonce, DIFFICULTY)
+    assert result.workers == 2
+    assert result.hashes > 0
+    assert miner.hashrate > 0
+
+
+def test_single_worker_matches_serial_search():
+    prefix = get_genesis_block().block_header.pack_without_nonce()
+    miner = ParallelMiner(workers=1)
+    result = miner.find_nonce(prefix, DIFFICULTY)
+    assert result.nonce == get_nonce_for_prefix(prefix, DIFFICULTY)
+    assert result.hashes == result.nonce + 1
+
+
+def test_parallel_miner_exhausts_nonce_space():
+    prefix = get_genesis_block().block_header.pack_without_nonce()
+    miner = ParallelMiner(workers=2, nonce_space=5000)
+    try:
+        result = miner.find_nonce(prefix, 1)  # practically impossible
+    finally:
+        miner.close()
+    assert result.nonce is None
+    assert result.hashes == 5000
+
+
+def test_parallel_miner_abort():
+    prefix = get_genesis_block().block_header.pack_without_nonce()
+    miner = ParallelMiner(workers=2, nonce_space=10**8)
+    abort = threading.Event()
+    timer = threading.Timer(0.05, abort.set)
+    try:
+        timer.start()
+        result = miner.find_nonce(prefix, 1, abort)
+    finally:
+        timer.cancel()
+        miner.close()
+    assert result.aborted
+    assert result.nonce is None
+    assert result.elapsed < 1
+
+
+def test_block_mine_returns_none_when_aborted():
+    genesis = get_genesis_block()
+    abort = threading.Event()
+    abort.set()
+    block = Block.mine(genesis.hash, genesis.transactions, [genesis], abort=abort)
+    assert block is None
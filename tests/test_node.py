@@ -0,0 +1,211 @@
+from bitcoin_rollup_sim.block import Block, get_genesis_block
+from bitcoin_rollup_sim.chain import PrunedBlock, PrunedChain
+from bitcoin_rollup_sim.node import Node, ENCODING_BINARY, ENCODING_JSON, MIN_PRUNED_BLOCKS, encode_headers
+from bitcoin_rollup_sim.relay import INV_BLOCK
+from bitcoin_rollup_sim.transaction import Transaction, VIn
+from bitcoin_rollup_sim.utils.block import calculate_new_difficulty
+from bitcoin_rollup_sim.utxo import AddressIndex, UtxoSet, connect_block
+
+from .test_chain import mine_block
+
+
+def make_node(prune=None) -> Node:
+    node = Node(peers={}, prune=prune)
+    node.socket.close()
+    # Node state defaults are class level, don't share them between tests
+    node.blocks = PrunedChain(prune, [get_genesis_block()]) if prune else [get_genesis_block()]
+    node.utxo_set = UtxoSet(index=AddressIndex())
+    # Test blocks are mined at an easy target rather than the retargeted one
+    node.check_targets = False
+    node.sent = []
+    node.send = lambda port, data, peer_id="<na>": node.sent.append((peer_id, data))
+    return node
+
+
+def test_hello_negotiates_binary():
+    node = make_node()
+    node.on_receive_message("other-1:2001 hello bin1,json", None)
+    assert node.peer_encodings["other-1"] == ENCODING_BINARY
+    # Replies with its own hello
+    [(peer_id, msg)] = node.sent
+    assert peer_id == "other-1" and " hello " in msg
+
+
+def test_json_until_hello_received():
+    node = make_node()
+    node.peers = {"other-1": 2001}
+    node.on_receive_message(f"other-1:2001 getdata block {get_genesis_block().hash}", None)
+    msg_types = [msg.split(" ")[1] for _, msg in node.sent]
+    assert msg_types == ["hello", "newblock"]
+
+    node.on_receive_message("other-1:2001 hello json", None)
+    assert node.peer_encodings["other-1"] == ENCODING_JSON
+
+
+def test_binary_block_received():
+    sender = make_node()
+    sender.peers = {"receiver": 2002}
+    sender.peer_encodings["receiver"] = ENCODING_BINARY
+    block = mine_block(get_genesis_block(), "a1")
+    sender.blocks.append(block)
+    sender.propagate_block(block)
+    [(_, inv)] = sender.sent
+
+    receiver = make_node()
+    receiver.nid = "receiver"
+    receiver.on_receive_message(inv, None)
+    [(_, getdata)] = receiver.sent
+    sender.on_receive_message(getdata, None)
+    msg = sender.sent[-1][1]
+    assert msg.split(" ")[1] == "newblock:bin"
+    receiver.on_receive_message(msg, None)
+    assert [x.hash for x in receiver.blocks] == [get_genesis_block().hash, block.hash]
+
+
+def test_update_and_revert_utxo():
+    node = make_node()
+    coinbase = Transaction.create_coinbase("42146bb6914e3e723742e6f79d56116186f86aab", "test", 1)
+    block = Block.new(get_genesis_block().hash, [coinbase])
+    node.update_utxo(block)
+    assert list(node.utxo_set.items()) == [((coinbase.txid, 0), coinbase.vout[0])]
+    assert block.hash in node.block_undo
+
+    node.revert_utxo(block)
+    assert len(node.utxo_set) == 0
+    assert block.hash not in node.block_undo
+
+
+def receive(node: Node, block: Block):
+    node.process_new_block(block.serialize())
+
+
+def utxos_of(blocks):
+    utxos = UtxoSet()
+    for block in blocks:
+        connect_block(utxos, block)
+    return utxos
+
+
+def test_reorg_to_most_work_branch():
+    node = make_node()
+    genesis = get_genesis_block()
+    a1 = mine_block(genesis, "a1")
+    a2 = mine_block(a1, "a2")
+    b1 = mine_block(genesis, "b1")
+    b2 = mine_block(b1, "b2")
+    b3 = mine_block(b2, "b3")
+    for block in [a1, a2, b1, b2]:
+        receive(node, block)
+    # Same work, the first seen branch stays
+    assert [x.hash for x in node.blocks] == [genesis.hash, a1.hash, a2.hash]
+
+    receive(node, b3)
+    assert [x.hash for x in node.blocks] == [genesis.hash, b1.hash, b2.hash, b3.hash]
+    assert node.utxo_set == utxos_of([b1, b2, b3])
+    assert set(node.block_undo) == {b1.hash, b2.hash, b3.hash}
+    # Duplicates are ignored
+    sent = len(node.sent)
+    receive(node, a2)
+    assert len(node.sent) == sent
+
+
+def test_orphans_connected_when_parent_arrives():
+    node = make_node()
+    a1 = mine_block(get_genesis_block(), "a1")
+    a2 = mine_block(a1, "a2")
+    receive(node, a2)
+    assert len(node.blocks) == 1 and node.orphan_blocks
+    receive(node, a1)
+    assert [x.hash for x in node.blocks[1:]] == [a1.hash, a2.hash]
+    assert not node.orphan_blocks
+
+
+def test_invalid_branch_is_rolled_back():
+    node = make_node()
+    genesis = get_genesis_block()
+    a1 = mine_block(genesis, "a1")
+    b1 = mine_block(genesis, "b1")
+    # Spends an output that does not exist
+    bad = Transaction.new([VIn("ab" * 32, 7, "", 1)], list(a1.transactions[0].vout))
+    b2 = mine_block(b1, "b2", [bad])
+    for block in [a1, b1, b2]:
+        receive(node, block)
+    assert [x.hash for x in node.blocks] == [genesis.hash, a1.hash]
+    assert node.utxo_set == utxos_of([a1])
+    assert node.block_index[b2.hash].invalid
+
+
+def test_block_with_other_txns_not_credited():
+    node = make_node()
+    a1 = mine_block(get_genesis_block(), "a1")
+    # a1's header, so its hash and work, with txns it does not commit to
+    other = Transaction.create_coinbase(a1.transactions[0].vout[0].pub_key_hash, "other", 1)
+    receive(node, Block.with_size(a1.block_header, [other]))
+    assert a1.hash not in node.block_index and len(node.blocks) == 1
+    # Does not keep the real one out
+    node.peers = {"a": 2001}
+    node.on_receive_message(f"a:2001 inv {INV_BLOCK} {a1.hash}", None)
+    assert node.sent == [("a", f"{node.nid}:{node.port} getdata {INV_BLOCK} {a1.hash}")]
+    receive(node, a1)
+    assert node.blocks[-1].hash == a1.hash
+
+
+def test_unexpected_target_rejected():
+    node = make_node()
+    node.check_targets = True
+    # Follows genesis, so must have its target
+    a1 = mine_block(get_genesis_block(), "a1")
+    receive(node, a1)
+    node.process_headers(encode_headers([(a1.hash, a1.block_header)], ENCODING_JSON), ENCODING_JSON, "a")
+    assert len(node.blocks) == 1 and a1.hash not in node.block_index and len(node.sync) == 0
+
+    # From an easier root, blocks retargeted as a miner does it are accepted
+    chain = [mine_block(get_genesis_block(), "root")]
+    node.blocks = list(chain)
+    node._block_index = None
+    for i in range(4):
+        chain.append(mine_block(chain[-1], f"b{i}", target=calculate_new_difficulty(chain)))
+        receive(node, chain[-1])
+    assert [x.hash for x in node.blocks] == [x.hash for x in chain]
+    assert chain[-1].block_header.difficulty_target != chain[0].block_header.difficulty_target
+    # and so are their headers, checked against the ones before them in the message
+    other = make_node()
+    other.check_targets = True
+    other.blocks = chain[:1]
+    other.peers = {"a": 2001}
+    items = [(x.hash, x.block_header) for x in chain[1:]]
+    other.process_headers(encode_headers(items, ENCODING_JSON), ENCODING_JSON, "a")
+    assert len(other.sync) == 4
+    # Not one claiming more work than that
+    harder = mine_block(chain[-1], "harder", target=calculate_new_difficulty(chain) // 2)
+    receive(node, harder)
+    assert node.blocks[-1].hash == chain[-1].hash and harder.hash not in node.block_index
+
+
+def test_pruned_node():
+    node = make_node(prune=MIN_PRUNED_BLOCKS)
+    genesis = get_genesis_block()
+    chain = [genesis]
+    for i in range(30):
+        chain.append(mine_block(chain[-1], f"a{i}"))
+        receive(node, chain[-1])
+    assert [x.hash for x in node.blocks] == [x.hash for x in chain]
+    assert node.full_blocks_start == 31 - MIN_PRUNED_BLOCKS
+    assert isinstance(node.blocks[5], PrunedBlock) and node.blocks[-1] == chain[-1]
+    assert node.utxo_set == utxos_of(chain[1:])
+    # Undo records are only kept for the blocks that can still be disconnected
+    assert set(node.block_undo) == {x.hash for x in chain[-MIN_PRUNED_BLOCKS:]}
+
+    # A branch forking below the pruned blocks is never switched to
+    branch = [chain[5]]
+    for i in range(30):
+        branch.append(mine_block(branch[-1], f"b{i}"))
+        receive(node, branch[-1])
+    assert node.blocks[-1].hash == chain[-1].hash
+    assert node.block_index[branch[-1].hash].invalid
+    # A fork above them is
+    branch = [chain[-3]]
+    for i in range(3):
+        branch.append(mine_block(branch[-1], f"c{i}"))
+        receive(node, branch[-1])
+    assert node.blocks[-1].hash == branch[-1].hash
@@ -0,0 +1,191 @@
+from bitcoin_rollup_sim.block import get_genesis_block
+from bitcoin_rollup_sim.node import ENCODING_JSON, encode_transactions
+from bitcoin_rollup_sim.relay import INV_BLOCK, INV_TXN, RELAY_REQUEST_TIMEOUT, InvBatches, RecentSet
+
+from .test_chain import mine_block
+from .test_coin_selection import OTHER_PKH, make_wallet
+from .test_node import make_node
+from .test_sync import Network
+
+
+def test_recent_set():
+    items = RecentSet(3)
+    for x in "abc":
+        items.add(x)
+    items.add("a")  # the most recent one again
+    items.add("d")
+    assert len(items) == 3
+    assert "b" not in items and all(x in items for x in "acd")
+    items.add("e", 5)
+    assert items.get("e") == 5 and "c" not in items
+
+
+def test_inv_batches():
+    batches = InvBatches(3)
+    assert batches.add("a", "h1") is None
+    assert batches.add("b", "h2") is None
+    assert batches.add("a", "h3") is None
+    assert batches.add("a", "h4") == ["h1", "h3", "h4"]
+    assert len(batches) == 1
+    assert batches.pop_all() == {"b": ["h2"]}
+    assert batches.pop_all() == {}
+
+
+def connect_all(network: Network):
+    for node in network.nodes.values():
+        node.peers = {x.nid: port for port, x in network.nodes.items() if x is not node}
+        node.peer_encodings = {nid: ENCODING_JSON for nid in node.peers}
+
+
+def test_block_fetched_once_per_node():
+    network = Network()
+    genesis = [get_genesis_block()]
+    miner, *others = [network.add(f"n{i}", 2000 + i, genesis) for i in range(4)]
+    connect_all(network)
+    block = mine_block(genesis[0], "b1")
+    miner.process_new_block(block.serialize())
+    network.run()
+
+    assert all(x.blocks[-1].hash == block.hash for x in network.nodes.values())
+    fetched = [port for port, data in network.delivered if data.split(" ")[1] == "newblock"]
+    assert sorted(fetched) == [x.port for x in others]
+    # Every node announces it at most once to each peer, never back to the one it got it from
+    invs = [(port, data.split(" ")[0]) for port, data in network.delivered if data.split(" ")[1] == "inv"]
+    assert len(invs) == len(set(invs)) <= 3 + 2 * 3
+
+
+def test_announced_item_asked_once():
+    node = make_node()
+    node.peers = {"a": 2001, "b": 2002, "c": 2003}
+    item_hash = mine_block(get_genesis_block(), "b1").hash
+    for peer in ["a:2001", "b:2002", "c:2003"]:
+        node.on_receive_message(f"{peer} inv {INV_BLOCK} {item_hash}", None)
+    assert node.sent == [("a", f"{node.nid}:{node.port} getdata {INV_BLOCK} {item_hash}")]
+    # Known by all peers now, so never announced to them
+    node.announce(INV_BLOCK, item_hash)
+    assert len(node.sent) == 1
+    # Known items are not asked for
+    node.on_receive_message(f"b:2002 inv {INV_BLOCK} {get_genesis_block().hash}", None)
+    assert len(node.sent) == 1
+
+    # Nothing to retry until a does not send it in time
+    node.retry_requests()
+    assert len(node.sent) == 1
+    # Then asked from the other announcers, one at a time
+    for peer_id in ["b", "c"]:
+        node.requested.get(item_hash).requested_at -= RELAY_REQUEST_TIMEOUT
+        node.retry_requests()
+        assert node.sent[-1] == (peer_id, f"{node.nid}:{node.port} getdata {INV_BLOCK} {item_hash}")
+    assert len(node.sent) == 3
+    # Given up on once no announcer sent it
+    node.requested.get(item_hash).requested_at -= RELAY_REQUEST_TIMEOUT
+    node.retry_requests()
+    assert len(node.sent) == 3 and item_hash not in node.requested
+
+
+def test_txn_invs_batched():
+    node = make_node()
+    node.peers = {"a": 2001, "b": 2002}
+    node.relay_batch_size = node.txn_invs.max_size = 3
+    node.announce(INV_TXN, "t1")
+    node.announce(INV_TXN, "t2")
+    assert node.sent == []
+    node.flush_txn_invs()
+    assert sorted(node.sent) == [(x, f"{node.nid}:{node.port} inv {INV_TXN} t1,t2") for x in "ab"]
+    # A full batch goes right away
+    for x in ["t3", "t4", "t5"]:
+        node.announce(INV_TXN, x)
+    assert len(node.sent) == 4 and node.sent[-1][1].endswith(" t3,t4,t5")
+    # Blocks are never held back
+    node.announce(INV_BLOCK, "b1")
+    assert len(node.sent) == 6
+
+
+def test_txns_fetched_and_validated_in_one_batch():
+    wallet = make_wallet(100, 200, 300, 400)
+    wallet.nid = "wallet"
+    wallet.sent = []
+    wallet.send = lambda port, data, peer_id="<na>": wallet.sent.append((peer_id, data))
+    wallet.peers = {"receiver": 2002}
+    wallet.peer_encodings = {"receiver": ENCODING_JSON}
+    for amt in [100, 200, 300]:
+        assert wallet.pay_to(OTHER_PKH, amt)
+    wallet.flush_txn_invs()
+    [(_, inv)] = wallet.sent
+
+    receiver = make_node()
+    receiver.nid = "receiver"
+    receiver.utxo_set = wallet.utxo_set
+    receiver.peer_encodings = {"wallet": ENCODING_JSON}
+    batches = []
+    validate = receiver.validator.validate
+
+    def counting_validate(items, **kwargs):
+        batches.append(len(items))
+        return validate(items, **kwargs)
+    receiver.validator.validate = counting_validate
+    receiver.on_receive_message(inv, None)
+    [(_, getdata)] = receiver.sent
+    wallet.on_receive_message(getdata, None)
+    [(_, txns)] = wallet.sent[1:]
+    assert txns.split(" ")[1] == "txns"
+
+    receiver.on_receive_message(txns, None)
+    assert sorted(x.txid for x in receiver.mem_pool) == sorted(x.txid for x in wallet.mem_pool)
+    assert batches == [3]
+    # Relayed on, but not back to the wallet
+    receiver.flush_txn_invs()
+    assert len(receiver.sent) == 1
+    # Seen already, so not validated again
+    receiver.on_receive_message(txns, None)
+    assert batches == [3]
+
+
+def test_rejected_txns_asked_again_after_a_block():
+    wallet = make_wallet(100)
+    assert wallet.pay_to(OTHER_PKH, 100)
+    [txn] = wallet.mem_pool
+    # The node is behind, it does not have the txn's inputs yet
+    node = make_node()
+    node.on_receive_message(f"a:2001 txns {encode_transactions([txn], ENCODING_JSON)}", None)
+    assert len(node.mem_pool) == 0
+    node.on_receive_message(f"b:2002 inv {INV_TXN} {txn.txid}", None)
+    assert node.sent == []
+
+    node.add_block(mine_block(get_genesis_block(), "b1"))
+    node.utxo_set = wallet.utxo_set
+    node.on_receive_message(f"c:2003 inv {INV_TXN} {txn.txid}", None)
+    assert node.sent == [("c", f"{node.nid}:{node.port} getdata {INV_TXN} {txn.txid}")]
+    node.on_receive_message(f"c:2003 txns {encode_transactions([txn], ENCODING_JSON)}", None)
+    assert [x.txid for x in node.mem_pool] == [txn.txid]
+
+
+def test_unreachable_peer_skipped():
+    node = make_node()
+    node.peers = {"app": 8080, "a": 2001}
+
+    def send(port, data, peer_id="<na>"):
+        if port == 8080:
+            raise ConnectionRefusedError()
+        node.sent.append((peer_id, data))
+    node.send = send
+    node.announce(INV_BLOCK, "b1")
+    assert node.sent == [("a", f"{node.nid}:{node.port} inv {INV_BLOCK} b1")]
+
+
+def test_txn_spent_by_a_block_during_checks_rejected():
+    wallet = make_wallet(100)
+    assert wallet.pay_to(OTHER_PKH, 100)
+    [txn] = wallet.mem_pool
+    node = make_node()
+    node.utxo_set = wallet.utxo_set.copy()
+    validate = node.validator.validate
+
+    def validate_then_spend(items, **kwargs):
+        # A block connected by another thread, spending the txn's input
+        node.utxo_set.spend(txn.vin[0].transaction_id, txn.vin[0].vout)
+        return validate(items, **kwargs)
+    node.validator.validate = validate_then_spend
+    node.on_receive_message(f"a:2001 txns {encode_transactions([txn], ENCODING_JSON)}", None)
+    # The scripts checked out against what the input was, the mempool sees it gone
+    assert len(node.mem_pool) == 0 and txn.txid in node.rejected_txns
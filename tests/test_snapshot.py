@@ -0,0 +1,84 @@
+import pytest
+
+from bitcoin_rollup_sim.block import get_genesis_block
+from bitcoin_rollup_sim.node import Node
+from bitcoin_rollup_sim.snapshot import SNAPSHOT_BLOCKS, SnapshotError, UtxoSnapshot, validate_history
+from bitcoin_rollup_sim.utxo import UtxoSet, connect_block
+
+from .test_chain import mine_block
+
+
+def make_chain(length: int):
+    blocks = [get_genesis_block()]
+    for height in range(1, length):
+        blocks.append(mine_block(blocks[-1], f"b{height}"))
+    utxos = UtxoSet()
+    for block in blocks[1:]:
+        connect_block(utxos, block)
+    return blocks, utxos
+
+
+def make_snapshot_node(path, **kwargs) -> Node:
+    node = Node(peers={}, snapshot=str(path), **kwargs)
+    node.socket.close()
+    node.send = lambda *args, **kwargs: None
+    return node
+
+
+def test_save_and_load(tmp_path):
+    blocks, utxos = make_chain(15)
+    snapshot = UtxoSnapshot.create(blocks, utxos)
+    assert snapshot.height == 14 and snapshot.tip_hash == blocks[-1].hash
+    assert len(snapshot.blocks) == SNAPSHOT_BLOCKS
+
+    snapshot.save(tmp_path / "utxo.snapshot")
+    loaded = UtxoSnapshot.load(tmp_path / "utxo.snapshot", snapshot.commitment)
+    assert loaded == snapshot
+    # The commitment does not depend on the order of the outputs
+    reordered = UtxoSet(reversed(list(utxos.items())))
+    assert UtxoSnapshot.create(blocks, reordered).commitment == snapshot.commitment
+
+    with pytest.raises(SnapshotError):
+        UtxoSnapshot.load(tmp_path / "utxo.snapshot", "00" * 32)
+    snapshot.outputs.pop()
+    snapshot.save(tmp_path / "utxo.snapshot")
+    with pytest.raises(SnapshotError):
+        UtxoSnapshot.load(tmp_path / "utxo.snapshot")
+
+
+def test_node_follows_tip_from_snapshot(tmp_path):
+    blocks, utxos = make_chain(15)
+    UtxoSnapshot.create(blocks, utxos).save(tmp_path / "utxo.snapshot")
+    node = make_snapshot_node(tmp_path / "utxo.snapshot")
+    assert len(node.blocks) == 15 and node.blocks[-1].hash == blocks[-1].hash
+    assert node.utxo_set == utxos
+    assert node.block_index[blocks[-1].hash].height == 14
+    # Blocks before the snapshot tip are not known
+    assert blocks[-2].hash not in node.block_index
+
+    block = mine_block(blocks[-1], "next")
+    node.process_new_block(block.serialize())
+    assert node.blocks[-1].hash == block.hash and len(node.blocks) == 16
+    connect_block(utxos, block)
+    assert node.utxo_set == utxos
+
+
+def test_validate_history(tmp_path):
+    blocks, utxos = make_chain(15)
+    snapshot = UtxoSnapshot.create(blocks[:12], UtxoSet())
+    assert not validate_history(blocks, snapshot)
+
+    utxos = UtxoSet()
+    for block in blocks[1:12]:
+        connect_block(utxos, block)
+    snapshot = UtxoSnapshot.create(blocks[:12], utxos)
+    assert validate_history(blocks, snapshot)
+    assert not validate_history(blocks[:11], snapshot)
+    assert not validate_history(blocks[:5] + blocks[6:], snapshot)
+
+    snapshot.save(tmp_path / "utxo.snapshot")
+    node = make_snapshot_node(tmp_path / "utxo.snapshot")
+    node.peers = {"bad": 1, "good": 2}
+    node.fetch_blocks = lambda port: blocks[:5] if port == 1 else blocks
+    assert node.validate_snapshot_history()
+    assert node.history_validated
@@ -0,0 +1,156 @@
+import os
+
+import pytest
+
+from bitcoin_rollup_sim.block import Block, get_genesis_block
+from bitcoin_rollup_sim.chain import BlockIndex
+from bitcoin_rollup_sim.node import WalletNode
+from bitcoin_rollup_sim.storage import BLOCK_FILE, ChainStorage, StoredBlocks
+from bitcoin_rollup_sim.transaction import Transaction, VIn, VOut
+from bitcoin_rollup_sim.utxo import BlockUndo, UtxoSet, connect_block
+
+PKH = "42146bb6914e3e723742e6f79d56116186f86aab"
+
+
+def make_chain(length: int):
+    blocks = [get_genesis_block()]
+    for height in range(1, length):
+        coinbase = Transaction.create_coinbase(PKH, f"test {height}", height)
+        blocks.append(Block.new(blocks[-1].hash, [coinbase]))
+    return blocks
+
+
+def test_blocks_survive_reopen(tmp_path):
+    storage = ChainStorage(str(tmp_path), block_cache_size=2)
+    chain = make_chain(5)
+    assert len(storage.blocks) == 1
+    assert storage.blocks[0].hash == chain[0].hash
+    for block in chain[1:]:
+        storage.blocks.append(block)
+    storage.close()
+
+    storage = ChainStorage(str(tmp_path), block_cache_size=2)
+    assert len(storage.blocks) == 5
+    assert [x.hash for x in storage.blocks] == [x.hash for x in chain]
+    assert [x.hash for x in storage.blocks[-2:]] == [x.hash for x in chain[-2:]]
+    assert storage.blocks[1].hash == chain[1].hash
+    assert chain[3] in storage.blocks
+    assert storage.blocks.get_height(chain[3].hash) == 3
+    storage.close()
+
+
+def test_pop_and_append(tmp_path):
+    storage = ChainStorage(str(tmp_path))
+    chain = make_chain(3)
+    other = [Block.new(chain[0].hash, [Transaction.create_coinbase(PKH, "other", 1)])]
+    for block in chain[1:]:
+        storage.blocks.append(block)
+    assert storage.blocks.pop().hash == chain[2].hash
+    assert storage.blocks.pop().hash == chain[1].hash
+    assert chain[1] not in storage.blocks
+    storage.blocks.append(other[0])
+    storage.close()
+
+    storage = ChainStorage(str(tmp_path))
+    assert [x.hash for x in storage.blocks] == [chain[0].hash, other[0].hash]
+    storage.close()
+
+
+def test_uncommitted_blocks_are_dropped(tmp_path):
+    storage = ChainStorage(str(tmp_path))
+    chain = make_chain(3)
+    storage.blocks.append(chain[1])
+    storage.commit()
+    size = os.path.getsize(tmp_path / BLOCK_FILE)
+    storage.blocks.append(chain[2])
+    storage.block_file.flush()
+    # Crash before commit
+    storage._db.close()
+    storage._db = None
+
+    storage = ChainStorage(str(tmp_path))
+    assert len(storage.blocks) == 2
+    assert os.path.getsize(tmp_path / BLOCK_FILE) == size
+    storage.close()
+
+
+def test_sqlite_utxo_set(tmp_path):
+    storage = ChainStorage(str(tmp_path))
+    utxos = storage.utxos
+    txn = Transaction.new(
+        vin=[VIn.get_coinbase_input("funding", 1)],
+        vout=[VOut.get_for_p2pkh(PKH, 1000 + n, ind=n) for n in range(3)],
+    )
+    utxos.add_txn(txn)
+    assert len(utxos) == 3
+    assert utxos.get(txn.txid, 1) == txn.vout[1]
+    assert utxos.get_many([(txn.txid, 2), (txn.txid, 5), (txn.txid, 0)]) == [txn.vout[2], None, txn.vout[0]]
+    assert utxos.index.get_balance(PKH) == 3003
+    assert utxos.spend(txn.txid, 1) == txn.vout[1]
+    assert utxos.spend(txn.txid, 1) is None
+    assert (txn.txid, 1) not in utxos
+    assert utxos.index.get_inputs_for(PKH, 2000) == [(txn.txid, txn.vout[0]), (txn.txid, txn.vout[2])]
+
+
+def test_undo_round_trip():
+    utxos = UtxoSet()
+    [_, block] = make_chain(2)
+    utxos.add_txn(block.transactions[0])
+    undo = connect_block(utxos, block)
+    assert undo.replaced
+    assert BlockUndo.deserialize_binary(undo.serialize_binary()) == undo
+
+
+def test_node_restarts_from_data_dir(tmp_path):
+    node = WalletNode(peers={}, data_dir=str(tmp_path))
+    node.socket.close()
+    pkh = node.pubkeyhash
+    coinbase = Transaction.create_coinbase(pkh, "test", 1)
+    block = Block.new(get_genesis_block().hash, [coinbase])
+    node.add_block(block)
+    balance = node.get_balance()
+    assert balance > 0
+    node.storage.close()
+
+    node = WalletNode(peers={}, data_dir=str(tmp_path))
+    node.socket.close()
+    assert node.pubkeyhash == pkh
+    assert node.get_balance() == balance
+    assert node.blocks[-1].hash == block.hash
+    node.revert_utxo(block)
+    assert node.get_balance() == 0
+    node.storage.close()
+
+
+def index_of(index: BlockIndex):
+    return [(x.hash, x.prev_hash, x.height, x.chain_work) for x in index.entries.values()]
+
+
+def test_block_index_stored(tmp_path, monkeypatch):
+    storage = ChainStorage(str(tmp_path))
+    chain = make_chain(5)
+    for block in chain[1:]:
+        storage.blocks.append(block)
+    storage.close()
+
+    node = WalletNode(peers={}, data_dir=str(tmp_path))
+    node.socket.close()
+    # Loaded without reading a block
+    monkeypatch.setattr(StoredBlocks, "_read", lambda *args: pytest.fail("block read"))
+    assert index_of(node.block_index) == index_of(BlockIndex.from_chain(chain))
+    assert node.block_index.best.hash == chain[-1].hash
+    node.storage.close()
+
+
+def test_block_index_filled_for_old_data_dirs(tmp_path):
+    storage = ChainStorage(str(tmp_path))
+    chain = make_chain(3)
+    for block in chain[1:]:
+        storage.blocks.append(block)
+    storage.db.execute("UPDATE blocks SET prev_hash = NULL, chain_work = NULL")
+    storage.close()
+
+    storage = ChainStorage(str(tmp_path))
+    index = BlockIndex.from_stored(storage.blocks.get_index())
+    assert index_of(index) == index_of(BlockIndex.from_chain(chain))
+    storage.close()
@@ -0,0 +1,153 @@
+from collections import deque
+from dataclasses import replace
+import json
+
+from bitcoin_rollup_sim.node import ENCODING_BINARY, ENCODING_JSON, Node, decode_headers, encode_headers
+from bitcoin_rollup_sim.sync import BLOCKS_PER_REQUEST, HeaderSync, get_locator
+from bitcoin_rollup_sim.utils.common import FrameReader
+
+from .test_chain import mine_block
+from .test_connection import ChunkedConn
+from .test_node import make_node, utxos_of
+from .test_snapshot import make_chain
+
+
+class Network:
+    """Nodes sending messages to each other through a queue, by port"""
+
+    def __init__(self):
+        self.nodes: dict[int, Node] = {}
+        self.queue = deque()
+        self.delivered = []
+
+    def add(self, nid: str, port: int, blocks) -> Node:
+        node = make_node()
+        node.nid, node.port = nid, port
+        node.blocks = list(blocks)
+        node.utxo_set = utxos_of(blocks[1:])
+        node.send = lambda port, data, peer_id="<na>": self.queue.append((port, data))
+        self.nodes[port] = node
+        return node
+
+    def run(self):
+        while self.queue:
+            port, data = self.queue.popleft()
+            self.delivered.append((port, data))
+            self.nodes[port].on_receive_message(data, None)
+
+
+def test_locator():
+    blocks, _ = make_chain(40)
+    locator = get_locator(blocks)
+    assert locator[:10] == [x.hash for x in blocks[:-11:-1]]
+    assert locator[-1] == blocks[0].hash
+    assert len(locator) < 20
+    assert get_locator(blocks, first=35)[-1] == blocks[35].hash
+
+
+def test_headers_encoding():
+    blocks, _ = make_chain(5)
+    items = [(x.hash, x.block_header) for x in blocks]
+    for encoding in [ENCODING_BINARY, ENCODING_JSON]:
+        assert decode_headers(encode_headers(items, encoding), encoding) == items
+
+
+def test_invalid_headers_rejected():
+    blocks, _ = make_chain(5)
+    items = [(x.hash, x.block_header) for x in blocks[1:]]
+    is_known = {blocks[0].hash}.__contains__
+
+    sync = HeaderSync()
+    assert sync.add_headers(items[1:], is_known) is None  # parent not known
+    assert sync.add_headers([items[0], items[2]], is_known) is None  # do not link up
+    bad_pow = replace(items[1][1], difficulty_target=1)
+    assert sync.add_headers([items[0], (items[1][0], bad_pow)], is_known) is None
+    assert len(sync) == 0
+
+    assert sync.add_headers(items, is_known) == 4
+    assert sync.add_headers(items, is_known) == 0
+    assert sync.last_hash == blocks[-1].hash
+
+
+def test_ranges_spread_over_peers():
+    blocks, _ = make_chain(40)
+    sync = HeaderSync()
+    sync.add_headers([(x.hash, x.block_header) for x in blocks[1:]], {blocks[0].hash}.__contains__)
+    requests = sync.next_requests(["a", "b"], now=0)
+    assert [x.peer_id for x in requests] == ["a", "b", "a"]
+    assert [len(x.hashes) for x in requests] == [BLOCKS_PER_REQUEST, BLOCKS_PER_REQUEST, 39 - 32]
+
+    # Ranges not received in time are asked from the other peer
+    sync.add_blocks(requests[1].hashes[0], blocks[17:33])
+    retries = sync.next_requests(["a", "b"], now=100)
+    assert [x.hashes for x in retries] == [requests[0].hashes, requests[2].hashes]
+    assert [x.peer_id for x in retries] == ["b", "b"]
+    # Blocks are handed over in chain order, only once their parent is known
+    assert sync.pop_ready({blocks[0].hash}.__contains__) == []
+    sync.add_blocks(retries[0].hashes[0], blocks[1:17])
+    assert sync.pop_ready({blocks[0].hash}.__contains__) == blocks[1:33]
+
+
+def test_catch_up_from_peers():
+    blocks, utxos = make_chain(40)
+    network = Network()
+    network.add("a", 1, blocks)
+    network.add("b", 2, blocks)
+    node = network.add("new", 3, blocks[:1])
+    node.peers = {"a": 1, "b": 2}
+    node.send_get_headers(1, "a")
+    node.send_get_headers(2, "b")
+    network.run()
+
+    assert [x.hash for x in node.blocks] == [x.hash for x in blocks]
+    assert node.utxo_set == utxos
+    assert node.sync.is_idle() and len(node.sync) == 0
+    # Blocks were downloaded from both peers
+    getblocks = [port for port, data in network.delivered if data.split(" ")[1] == "getblocks"]
+    assert set(getblocks) == {1, 2}
+
+
+def test_catch_up_over_several_headers_messages(monkeypatch):
+    monkeypatch.setattr("bitcoin_rollup_sim.node.MAX_HEADERS", 8)
+    blocks, _ = make_chain(30)
+    network = Network()
+    network.add("a", 1, blocks)
+    node = network.add("new", 2, blocks[:3])
+    node.peers = {"a": 1}
+    node.send_get_headers(1, "a")
+    network.run()
+    assert [x.hash for x in node.blocks] == [x.hash for x in blocks]
+
+
+def test_orphan_block_triggers_sync():
+    blocks, _ = make_chain(10)
+    network = Network()
+    peer = network.add("a", 1, blocks)
+    node = network.add("new", 2, blocks[:4])
+    node.peers = {"a": 1}
+    peer.peers = {"new": 2}
+    tip = mine_block(blocks[-1], "tip")
+    peer.process_new_block(tip.serialize())
+    network.run()
+    assert node.blocks[-1].hash == tip.hash and len(node.blocks) == 11
+
+
+class FakeConn:
+    def __init__(self):
+        self.data = b""
+
+    def sendall(self, data: bytes):
+        self.data += data
+
+    def close(self):
+        pass
+
+
+def test_app_block_ranges():
+    blocks, _ = make_chain(10)
+    node = make_node()
+    node.blocks = blocks
+    conn = FakeConn()
+    node.on_receive_message("app-1:2001 app:getblocks 4 3", conn)
+    payload = FrameReader(ChunkedConn(conn.data, len(conn.data))).read_frame()[1]
+    assert [x for x in json.loads(payload)] == [x.serialize() for x in blocks[4:7]]
@@ -0,0 +1,118 @@
+from bitcoin_rollup_sim.block import Block, get_genesis_block
+from bitcoin_rollup_sim.transaction import Transaction, VIn, VOut
+from bitcoin_rollup_sim.utxo import AddressIndex, UtxoSet, connect_block, disconnect_block
+
+PKH = "42146bb6914e3e723742e6f79d56116186f86aab"
+OTHER_PKH = "00146bb6914e3e723742e6f79d56116186f86a00"
+
+
+def make_utxos(num: int, outputs: int = 2, index=None):
+    utxos = UtxoSet(index=index)
+    for i in range(num):
+        txn = Transaction.new(
+            vin=[VIn.get_coinbase_input(f"funding {i}", 1)],
+            vout=[VOut.get_for_p2pkh(PKH, 1000, ind=n) for n in range(outputs)],
+        )
+        utxos.add_txn(txn)
+    return utxos
+
+
+def txids_of(utxos: UtxoSet):
+    return list(dict.fromkeys(txid for txid, _ in utxos))
+
+
+def spend(txid: str, vout: int, value: int = 900, pkh: str = PKH):
+    vin = VIn(transaction_id=txid, vout=vout, script_sig="", sequence=1)
+    return Transaction.new([vin], [VOut.get_for_p2pkh(pkh, value, ind=0)])
+
+
+def make_block(txns):
+    coinbase = Transaction.create_coinbase(PKH, "test", 1)
+    return Block.new(get_genesis_block().hash, [coinbase, *txns])
+
+
+def test_utxo_set_operations():
+    utxos = make_utxos(2)
+    [a, b] = txids_of(utxos)
+    assert len(utxos) == 4
+    assert (a, 1) in utxos
+    assert utxos.get(a, 1).n == 1
+    assert utxos.get(a, 2) is None
+    assert [x and x.n for x in utxos.get_many([(b, 0), ("00" * 32, 0), (a, 1)])] == [0, None, 1]
+
+    vout = utxos.spend(a, 1)
+    assert vout.n == 1
+    assert (a, 1) not in utxos
+    assert utxos.spend(a, 1) is None
+    utxos.add(a, vout)
+    assert utxos.get(a, 1) == vout
+
+
+def test_connect_and_disconnect():
+    utxos = make_utxos(3)
+    before = utxos.copy()
+    [a, b, c] = txids_of(utxos)
+    txn1, txn2, txn3 = spend(a, 0), spend(a, 1), spend(b, 1)
+    block = make_block([txn1, txn2, txn3])
+
+    undo = connect_block(utxos, block)
+    assert (a, 0) not in utxos and (a, 1) not in utxos
+    assert (b, 0) in utxos and (b, 1) not in utxos
+    assert utxos.get(c, 1) == before.get(c, 1)
+    for txn in block.transactions:
+        assert utxos.get(txn.txid, 0) == txn.vout[0]
+    assert sum(len(x) for x in undo.spent) == 3
+
+    disconnect_block(utxos, block, undo)
+    assert utxos == before
+
+
+def test_spend_of_output_created_in_same_block():
+    utxos = make_utxos(1)
+    before = utxos.copy()
+    [a] = txids_of(utxos)
+    parent = spend(a, 0)
+    child = spend(parent.txid, 0, value=800)
+    block = make_block([parent, child])
+
+    undo = connect_block(utxos, block)
+    assert (parent.txid, 0) not in utxos
+    assert (child.txid, 0) in utxos
+
+    disconnect_block(utxos, block, undo)
+    assert utxos == before
+
+
+def assert_index_matches(utxos: UtxoSet):
+    expected = AddressIndex.from_utxos(utxos)
+    assert utxos.index.balances == expected.balances
+    assert utxos.index.coins == expected.coins
+
+
+def test_address_index_follows_blocks():
+    utxos = make_utxos(3, index=AddressIndex())
+    index = utxos.index
+    assert index.get_balance(PKH) == 6000
+    [a, b, _] = txids_of(utxos)
+    block = make_block([spend(a, 0, pkh=OTHER_PKH), spend(b, 1, value=500, pkh=OTHER_PKH)])
+
+    undo = connect_block(utxos, block)
+    assert_index_matches(utxos)
+    assert index.get_balance(OTHER_PKH) == 1400
+    coinbase_value = block.transactions[0].vout[0].value
+    assert index.get_balance(PKH) == 4000 + coinbase_value
+
+    disconnect_block(utxos, block, undo)
+    assert_index_matches(utxos)
+    assert index.get_balance(OTHER_PKH) == 0
+    assert OTHER_PKH not in index.coins
+
+
+def test_address_index_inputs():
+    utxos = make_utxos(3)
+    index = AddressIndex.from_utxos(utxos)
+    inputs = index.get_inputs_for(PKH, 2500)
+    assert len(inputs) == 3
+    assert sum(x.value for _, x in inputs) >= 2500
+    assert index.get_inputs_for(PKH, 6001) == []
+    assert index.get_inputs_for(OTHER_PKH, 1) == []
@@ -0,0 +1,110 @@
+from bitcoin_rollup_sim.block import Block, get_genesis_block
+from bitcoin_rollup_sim.keys import KeysAddress
+from bitcoin_rollup_sim.transaction import Transaction, VIn, VOut
+from bitcoin_rollup_sim.utils.common import get_signature
+from bitcoin_rollup_sim.utxo import UtxoSet
+from bitcoin_rollup_sim.validation import (
+    BatchValidator, validate_new_block, validate_new_transaction,
+)
+
+KEYS = KeysAddress.from_priv_key(0x1234567890ABCDEF)
+
+
+def make_utxos(num: int, value: int = 10_000):
+    utxos = UtxoSet()
+    for i in range(num):
+        txn = Transaction.new(
+            vin=[VIn.get_coinbase_input(f"funding {i}", 1)],
+            vout=[VOut.get_for_p2pkh(KEYS.pub_key_hash, value, ind=0)],
+        )
+        utxos.add_txn(txn)
+    return utxos
+
+
+def spend(txid: str, vout: VOut):
+    vin = VIn(
+        transaction_id=txid,
+        vout=vout.n,
+        script_sig=f"{get_signature(vout.serialize(), KEYS.priv_key)} {KEYS.pub_key_hex}",
+        sequence=1,
+    )
+    return Transaction.new([vin], [VOut.get_for_p2pkh(KEYS.pub_key_hash, vout.value - 100, ind=0)])
+
+
+def make_txns(utxos):
+    return [spend(txid, vout) for (txid, _), vout in utxos.items()]
+
+
+def bad_signature(txn: Transaction):
+    vin = txn.vin[0]
+    sig, pubkey = vin.script_sig.split()
+    r, s = sig.split(":")
+    bad_sig = f"{r}:{int(s, 16) + 1:X}"
+    return Transaction.new([VIn(vin.transaction_id, vin.vout, f"{bad_sig} {pubkey}", vin.sequence)], txn.vout)
+
+
+def test_batch_matches_single_validation():
+    utxos = make_utxos(6)
+    txns = make_txns(utxos)
+    txns[2] = bad_signature(txns[2])
+    vin = txns[4].vin[0]
+    txns[4] = Transaction.new([VIn(vin.transaction_id, 1, vin.script_sig, 1)], txns[4].vout)  # missing output
+    expected = [validate_new_transaction(x, utxos) for x in txns]
+    assert expected == [True, True, False, True, False, True]
+
+    for workers in (1, 2):
+        validator = BatchValidator(workers)
+        try:
+            assert validator.validate([(x, utxos) for x in txns]) == expected
+        finally:
+            validator.close()
+
+
+def test_batch_fail_fast():
+    utxos = make_utxos(8)
+    txns = make_txns(utxos)
+    txns[0] = bad_signature(txns[0])
+    validator = BatchValidator(2)
+    try:
+        results = validator.validate([(x, utxos) for x in txns], fail_fast=True)
+    finally:
+        validator.close()
+    assert results[0] is False
+    # Every txn reported valid really is
+    assert all(validate_new_transaction(x, utxos) for x, ok in zip(txns, results) if ok)
+
+
+def test_validate_new_block():
+    utxos = make_utxos(4)
+    txns = make_txns(utxos)
+    coinbase = Transaction.create_coinbase(KEYS.pub_key_hash, "test", 1)
+    genesis_hash = get_genesis_block().hash
+
+    assert validate_new_block(Block.new(genesis_hash, [coinbase, *txns]), utxos)
+    bad = Block.new(genesis_hash, [coinbase, *txns[:3], bad_signature(txns[3])])
+    assert not validate_new_block(bad, utxos)
+    # Unless the txn is known to be valid already
+    assert validate_new_block(bad, utxos, known_valid=[bad.transactions[-1].txid])
+
+    # The same output spent twice
+    double_spend = Transaction.new(txns[0].vin, [VOut.get_for_p2pkh(KEYS.pub_key_hash, 1, ind=0)])
+    assert not validate_new_block(Block.new(genesis_hash, [coinbase, txns[0], double_spend]), utxos)
+
+
+def test_block_commits_to_its_txns():
+    utxos = make_utxos(4)
+    txns = make_txns(utxos)
+    coinbase = Transaction.create_coinbase(KEYS.pub_key_hash, "test", 1)
+    genesis_hash = get_genesis_block().hash
+    block = Block.new(genesis_hash, [coinbase, *txns])
+    # Same header, so same hash, with other txns
+    assert not validate_new_block(Block.with_size(block.block_header, [coinbase, *txns[:3]]))
+    assert not validate_new_block(Block.with_size(block.block_header, []))
+
+    # The coinbase claims the reward and the fees, no more
+    assert validate_new_block(block, utxos, height=1)
+    assert not validate_new_block(block, utxos, height=5)  # the reward halved
+    for fees, is_valid in [(400, True), (401, False)]:
+        claim = VOut.get_for_p2pkh(KEYS.pub_key_hash, coinbase.vout[0].value + fees, ind=0)
+        block = Block.new(genesis_hash, [Transaction.new(coinbase.vin, [claim]), *txns])
+        assert validate_new_block(block, utxos, height=1) is is_valid